@@ -0,0 +1,98 @@
+-- Moves LoggedData (Name, Time, Data JSON) into the typed, partitioned
+-- MachineStats table from schema.sql.
+--
+--   psql -f migrations/001_loggeddata_to_machinestats.sql
+--
+-- Rows of machines that have since been deleted are left behind, since
+-- MachineStats references Machines by ID. The old table is kept as
+-- LoggedData_Old; drop it once the new one looks right.
+
+\c status_database
+
+BEGIN;
+
+CREATE TABLE IF NOT EXISTS MachineStats (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Time TIMESTAMP WITH TIME ZONE NOT NULL,
+  CPU1m REAL,
+  CPU5m REAL,
+  CPU15m REAL,
+  RamUsed BIGINT,
+  RamTotal BIGINT,
+  DiskUsed BIGINT,
+  DiskTotal BIGINT,
+  NetIn DOUBLE PRECISION,
+  NetOut DOUBLE PRECISION,
+  Extras JSONB
+) PARTITION BY RANGE (Time);
+
+CREATE TABLE IF NOT EXISTS MachineStats_Default PARTITION OF MachineStats DEFAULT;
+
+-- Monthly partitions covering the old data and the next two months, the
+-- server's default layout. Match [srv.timeseries] if that was changed.
+DO $$
+DECLARE
+  month TIMESTAMP WITH TIME ZONE;
+BEGIN
+  SELECT date_trunc('month', COALESCE(min(Time), now()) AT TIME ZONE 'UTC') AT TIME ZONE 'UTC'
+    INTO month FROM LoggedData;
+  WHILE month < date_trunc('month', now() AT TIME ZONE 'UTC') AT TIME ZONE 'UTC' + INTERVAL '3 months' LOOP
+    EXECUTE format(
+      'CREATE TABLE IF NOT EXISTS %I PARTITION OF MachineStats FOR VALUES FROM (%L) TO (%L);',
+      'machinestats_p' || to_char(month AT TIME ZONE 'UTC', 'YYYY_MM'),
+      month,
+      month + INTERVAL '1 month'
+    );
+    month := month + INTERVAL '1 month';
+  END LOOP;
+END $$;
+
+-- Old clients sent load averages as strings, anything that isn't a plain
+-- number becomes NULL. Checked up front rather than by catching the cast
+-- error, which costs a subtransaction per value.
+CREATE FUNCTION pg_temp.num(value TEXT) RETURNS DOUBLE PRECISION
+LANGUAGE sql IMMUTABLE AS $$
+  SELECT CASE
+    WHEN value ~ '^\s*[-+]?(\d{1,30}(\.\d*)?|\.\d+)([eE][-+]?\d{1,2})?\s*$'
+    THEN value::DOUBLE PRECISION
+  END;
+$$;
+
+-- Byte counts, NULL when they don't fit a BIGINT.
+CREATE FUNCTION pg_temp.bytes(value TEXT) RETURNS BIGINT
+LANGUAGE sql IMMUTABLE AS $$
+  SELECT CASE
+    WHEN pg_temp.num(value) BETWEEN -9.2e18 AND 9.2e18 THEN pg_temp.num(value)::BIGINT
+  END;
+$$;
+
+INSERT INTO MachineStats (
+  MachineID, Time, CPU1m, CPU5m, CPU15m, RamUsed, RamTotal,
+  DiskUsed, DiskTotal, NetIn, NetOut, Extras
+)
+SELECT
+  m.ID,
+  l.Time,
+  pg_temp.num(l.Data -> 'raw' -> 'stats' -> 'cpu' ->> '1m'),
+  pg_temp.num(l.Data -> 'raw' -> 'stats' -> 'cpu' ->> '5m'),
+  pg_temp.num(l.Data -> 'raw' -> 'stats' -> 'cpu' ->> '15m'),
+  pg_temp.bytes(l.Data -> 'raw' -> 'stats' -> 'ram' ->> 'used'),
+  pg_temp.bytes(l.Data -> 'raw' -> 'stats' -> 'ram' ->> 'total'),
+  pg_temp.bytes(l.Data -> 'raw' -> 'stats' -> 'disk' ->> 'used'),
+  pg_temp.bytes(l.Data -> 'raw' -> 'stats' -> 'disk' ->> 'total'),
+  pg_temp.num(l.Data -> 'raw' -> 'stats' -> 'internet' -> 'current' ->> 'incoming'),
+  pg_temp.num(l.Data -> 'raw' -> 'stats' -> 'internet' -> 'current' ->> 'outgoing'),
+  NULLIF((l.Data -> 'processed' -> 'extras')::JSONB, '{}'::JSONB)
+FROM LoggedData l
+JOIN Machines m ON lower(m.Name) = lower(l.Name)
+WHERE l.Time IS NOT NULL
+ORDER BY l.Time;
+
+CREATE INDEX IF NOT EXISTS MachineStats_Machine_Time ON MachineStats (MachineID, Time);
+CREATE INDEX IF NOT EXISTS MachineStats_Time ON MachineStats USING BRIN (Time);
+
+ALTER TABLE LoggedData RENAME TO LoggedData_Old;
+
+COMMIT;
+
+ANALYZE MachineStats;
@@ -0,0 +1,54 @@
+-- Adds the 1m/1h/1d rollup tiers of MachineStats, from schema.sql. The
+-- server fills them from whatever MachineStats already holds on its first
+-- run, oldest first.
+--
+--   psql -f migrations/002_rollups.sql
+
+\c status_database
+
+-- Rollups of MachineStats, one row per machine, metric and bucket. Kept up
+-- to date and pruned by the server, see [srv.rollups] in config.toml.
+CREATE TABLE IF NOT EXISTS MachineStats_1m (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Metric TEXT NOT NULL, -- MachineStats column name, like 'cpu1m'
+  Bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+  MinValue DOUBLE PRECISION,
+  MaxValue DOUBLE PRECISION,
+  AvgValue DOUBLE PRECISION,
+  LastValue DOUBLE PRECISION,
+  Samples BIGINT NOT NULL,
+  PRIMARY KEY (MachineID, Metric, Bucket)
+);
+CREATE INDEX IF NOT EXISTS MachineStats_1m_Bucket ON MachineStats_1m USING BRIN (Bucket);
+
+CREATE TABLE IF NOT EXISTS MachineStats_1h (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Metric TEXT NOT NULL, -- MachineStats column name, like 'cpu1m'
+  Bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+  MinValue DOUBLE PRECISION,
+  MaxValue DOUBLE PRECISION,
+  AvgValue DOUBLE PRECISION,
+  LastValue DOUBLE PRECISION,
+  Samples BIGINT NOT NULL,
+  PRIMARY KEY (MachineID, Metric, Bucket)
+);
+CREATE INDEX IF NOT EXISTS MachineStats_1h_Bucket ON MachineStats_1h USING BRIN (Bucket);
+
+CREATE TABLE IF NOT EXISTS MachineStats_1d (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Metric TEXT NOT NULL, -- MachineStats column name, like 'cpu1m'
+  Bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+  MinValue DOUBLE PRECISION,
+  MaxValue DOUBLE PRECISION,
+  AvgValue DOUBLE PRECISION,
+  LastValue DOUBLE PRECISION,
+  Samples BIGINT NOT NULL,
+  PRIMARY KEY (MachineID, Metric, Bucket)
+);
+CREATE INDEX IF NOT EXISTS MachineStats_1d_Bucket ON MachineStats_1d USING BRIN (Bucket);
+
+-- How far each rollup tier has got.
+CREATE TABLE IF NOT EXISTS RollupState (
+  Tier TEXT PRIMARY KEY,
+  Done TIMESTAMP WITH TIME ZONE NOT NULL
+);
@@ -12,8 +12,74 @@ CREATE TABLE IF NOT EXISTS Machines (
   CollectStats BOOLEAN
 );
 
-CREATE TABLE IF NOT EXISTS LoggedData (
-  Name TEXT, -- Machine name
-  Time TIMESTAMP WITH TIME ZONE,
-  Data JSON
-);
\ No newline at end of file
+-- Written by the logger script. Partitioned by time, the server creates the
+-- partitions ahead of time (see [srv.timeseries] in config.toml).
+CREATE TABLE IF NOT EXISTS MachineStats (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Time TIMESTAMP WITH TIME ZONE NOT NULL,
+  CPU1m REAL, -- Load averages
+  CPU5m REAL,
+  CPU15m REAL,
+  RamUsed BIGINT, -- Bytes
+  RamTotal BIGINT,
+  DiskUsed BIGINT,
+  DiskTotal BIGINT,
+  NetIn DOUBLE PRECISION,
+  NetOut DOUBLE PRECISION,
+  Extras JSONB -- Plugin output
+) PARTITION BY RANGE (Time);
+
+-- Catches rows outside every partition, should stay empty.
+CREATE TABLE IF NOT EXISTS MachineStats_Default PARTITION OF MachineStats DEFAULT;
+
+-- History of one machine over a time range.
+CREATE INDEX IF NOT EXISTS MachineStats_Machine_Time ON MachineStats (MachineID, Time);
+-- Fleet-wide time ranges. Rows arrive in time order, so BRIN stays tiny.
+CREATE INDEX IF NOT EXISTS MachineStats_Time ON MachineStats USING BRIN (Time);
+
+-- Rollups of MachineStats, one row per machine, metric and bucket. Kept up
+-- to date and pruned by the server, see [srv.rollups] in config.toml.
+CREATE TABLE IF NOT EXISTS MachineStats_1m (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Metric TEXT NOT NULL, -- MachineStats column name, like 'cpu1m'
+  Bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+  MinValue DOUBLE PRECISION,
+  MaxValue DOUBLE PRECISION,
+  AvgValue DOUBLE PRECISION,
+  LastValue DOUBLE PRECISION,
+  Samples BIGINT NOT NULL,
+  PRIMARY KEY (MachineID, Metric, Bucket)
+);
+CREATE INDEX IF NOT EXISTS MachineStats_1m_Bucket ON MachineStats_1m USING BRIN (Bucket);
+
+CREATE TABLE IF NOT EXISTS MachineStats_1h (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Metric TEXT NOT NULL, -- MachineStats column name, like 'cpu1m'
+  Bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+  MinValue DOUBLE PRECISION,
+  MaxValue DOUBLE PRECISION,
+  AvgValue DOUBLE PRECISION,
+  LastValue DOUBLE PRECISION,
+  Samples BIGINT NOT NULL,
+  PRIMARY KEY (MachineID, Metric, Bucket)
+);
+CREATE INDEX IF NOT EXISTS MachineStats_1h_Bucket ON MachineStats_1h USING BRIN (Bucket);
+
+CREATE TABLE IF NOT EXISTS MachineStats_1d (
+  MachineID BIGINT NOT NULL REFERENCES Machines (ID) ON DELETE CASCADE,
+  Metric TEXT NOT NULL, -- MachineStats column name, like 'cpu1m'
+  Bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+  MinValue DOUBLE PRECISION,
+  MaxValue DOUBLE PRECISION,
+  AvgValue DOUBLE PRECISION,
+  LastValue DOUBLE PRECISION,
+  Samples BIGINT NOT NULL,
+  PRIMARY KEY (MachineID, Metric, Bucket)
+);
+CREATE INDEX IF NOT EXISTS MachineStats_1d_Bucket ON MachineStats_1d USING BRIN (Bucket);
+
+-- How far each rollup tier has got.
+CREATE TABLE IF NOT EXISTS RollupState (
+  Tier TEXT PRIMARY KEY,
+  Done TIMESTAMP WITH TIME ZONE NOT NULL
+);
@@ -0,0 +1,282 @@
+from __future__ import annotations
+
+import csv
+import datetime
+import io
+import urllib.parse
+from typing import TYPE_CHECKING
+
+from aiohttp import hdrs, web
+from aiohttp.web import ContentCoding, Response
+
+from utils import codec
+
+from .utils.downsample import METHODS, downsample
+from .utils.rollups import DEFAULT_RETENTION, TIERS
+from .utils.timeseries import COLUMNS, METRICS, TABLE
+
+if TYPE_CHECKING:
+  from .utils.rollups import Tier
+  from utils.extra_request import Request
+
+routes = web.RouteTableDef()
+
+MAX_POINTS = 5000
+
+# Exportable fields. `name` is filled in from the registry, the rest are
+# MachineStats columns.
+EXPORT_FIELDS = ("name", *(column for column in COLUMNS if column != "machineid"))
+EXPORT_FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+# Rows fetched from the cursor at a time, and bytes buffered per write.
+EXPORT_PREFETCH = 1000
+EXPORT_CHUNK = 64 * 1024
+
+
+def parse_time(value: str) -> datetime.datetime:
+  "Unix seconds or ISO 8601, naive times are taken as UTC."
+  try:
+    return datetime.datetime.fromtimestamp(float(value), datetime.UTC)
+  except (ValueError, OverflowError, OSError):
+    # Not a number, or one too far out for a datetime.
+    moment = datetime.datetime.fromisoformat(value)
+  if moment.tzinfo is None:
+    moment = moment.replace(tzinfo=datetime.UTC)
+  return moment
+
+
+def parse_time_range(
+  query: dict, *, default: datetime.timedelta
+) -> tuple[datetime.datetime, datetime.datetime]:
+  "`from` and `to` from the query, the last `default` if they're missing."
+  end = parse_time(query["to"]) if "to" in query else datetime.datetime.now(datetime.UTC)
+  try:
+    start = parse_time(query["from"]) if "from" in query else end - default
+  except OverflowError:
+    raise ValueError("time out of range") from None
+  return start, end
+
+
+def pick_tier(
+  start: datetime.datetime,
+  end: datetime.datetime,
+  points: int,
+  *,
+  retention: dict[str, float],
+) -> Tier | None:
+  """The coarsest tier that still gives `points` points over the range, or
+  None for the raw rows. Falls back to coarser tiers when `start` is older
+  than a tier keeps data for."""
+  wanted = (end - start) / max(points, 1)
+  now = datetime.datetime.now(datetime.UTC)
+
+  def covers(name: str) -> bool:
+    days = retention.get(name, 0)
+    return not days or start >= now - datetime.timedelta(days=days)
+
+  candidates: list[Tier | None] = [None, *TIERS]
+  chosen = 0
+  for i, tier in enumerate(candidates[1:], start=1):
+    if tier.bucket <= wanted:
+      chosen = i
+  while chosen < len(TIERS) and not covers(
+    "raw" if candidates[chosen] is None else candidates[chosen].name
+  ):
+    chosen += 1
+  return candidates[chosen]
+
+
+@routes.get("/machines/history/")
+async def get_machines_history(request: Request) -> Response:
+  """pass `name`, and optionally `from`, `to` (unix seconds or ISO 8601,
+  default the last day), `points` (default 500), `metrics` (comma separated,
+  default all) and `method` (lttb or minmax) in query.
+  returns {"name", "tier", "from", "to", "method", "series": {"cpu1m": [[time, value], ...]}}
+  streamed, with at most `points` points per metric.
+  """
+  query = request.query
+  name = query.get("name", None)
+  if name is None:
+    return Response(status=400, text="must pass machine name in query")
+  record = request.app.machine_registry.get(urllib.parse.unquote_plus(name))
+  if record is None:
+    return Response(status=404, text="machine not found")
+
+  try:
+    start, end = parse_time_range(query, default=datetime.timedelta(days=1))
+  except ValueError:
+    return Response(status=400, text="from and to must be unix seconds or ISO 8601!")
+  if start >= end:
+    return Response(status=400, text="from must be before to")
+
+  try:
+    points = min(MAX_POINTS, max(3, int(query.get("points", "500"))))
+  except ValueError:
+    return Response(status=400, text="points must be integer!")
+
+  method = query.get("method", "lttb")
+  if method not in METHODS:
+    return Response(status=400, text=f"method must be one of {', '.join(METHODS)}")
+
+  metrics = query.get("metrics", None)
+  metrics = metrics.split(",") if metrics else list(METRICS)
+  unknown = [metric for metric in metrics if metric not in METRICS]
+  if unknown:
+    return Response(status=400, text=f"unknown metrics {','.join(unknown)}")
+
+  rollups_config: dict = request.app.config.srv.rollups or {}
+  # The same retention RollupJob prunes with, or a pruned tier gets picked.
+  retention = {**DEFAULT_RETENTION, **(rollups_config.get("retention") or {})}
+  tier = pick_tier(start, end, points, retention=retention)
+
+  # One indexed range query, on (MachineID, Time) or (MachineID, Metric, Bucket).
+  series: dict[str, list[tuple[float, float]]] = {metric: [] for metric in metrics}
+  if tier is None:
+    rows = await request.conn.fetch(
+      f"""
+      SELECT extract(epoch FROM Time)::DOUBLE PRECISION AS t, {', '.join(metrics)}
+      FROM {TABLE}
+      WHERE MachineID = $1 AND Time >= $2 AND Time < $3
+      ORDER BY Time;
+      """,
+      record.id,
+      start,
+      end,
+    )
+    for row in rows:
+      for metric in metrics:
+        value = row.get(metric)
+        if value is not None:
+          series[metric].append((row.get("t"), value))
+  else:
+    rows = await request.conn.fetch(
+      f"""
+      SELECT Metric, extract(epoch FROM Bucket)::DOUBLE PRECISION AS t, AvgValue
+      FROM {tier.table}
+      WHERE MachineID = $1 AND Metric = ANY($2::TEXT[]) AND Bucket >= $3 AND Bucket < $4
+      ORDER BY Metric, Bucket;
+      """,
+      record.id,
+      metrics,
+      start,
+      end,
+    )
+    for row in rows:
+      series[row.get("metric")].append((row.get("t"), row.get("avgvalue")))
+
+  response = web.StreamResponse(headers={"Content-Type": "application/json"})
+  # gzip or deflate, if the client asked for it.
+  response.enable_compression()
+  await response.prepare(request)
+  header = {
+    "name": record.name,
+    "tier": "raw" if tier is None else tier.name,
+    "from": start.timestamp(),
+    "to": end.timestamp(),
+    "method": method,
+  }
+  # The header object without its closing brace, then one metric at a time.
+  await response.write(codec.dumps(header)[:-1] + b',"series":{')
+  for i, (metric, data) in enumerate(series.items()):
+    body = codec.dumps(metric) + b":" + codec.dumps(downsample(data, points, method))
+    await response.write(body if i == 0 else b"," + body)
+  await response.write(b"}}")
+  await response.write_eof()
+  return response
+
+
+@routes.get("/machines/export/")
+async def get_machines_export(request: Request) -> Response:
+  """optionally pass `name` (comma separated), `category`, `from`, `to` (unix
+  seconds or ISO 8601, default the last day), `fields` (comma separated,
+  default all), `format` (ndjson or csv, default ndjson) and `gzip` in query.
+  Streams every matching logged row, oldest first. Rows come from a server
+  side cursor, so memory stays flat however much is exported.
+  """
+  query = request.query
+
+  records = request.app.machine_registry.all()
+  if "name" in query:
+    names = {name.lower() for name in urllib.parse.unquote_plus(query["name"]).split(",")}
+    records = [record for record in records if record.name.lower() in names]
+  if "category" in query:
+    category = urllib.parse.unquote_plus(query["category"])
+    records = [record for record in records if record.category == category]
+  names_by_id = {record.id: record.name for record in records}
+
+  try:
+    start, end = parse_time_range(query, default=datetime.timedelta(days=1))
+  except ValueError:
+    return Response(status=400, text="from and to must be unix seconds or ISO 8601!")
+  if start >= end:
+    return Response(status=400, text="from must be before to")
+
+  fields = query.get("fields", None)
+  fields = fields.split(",") if fields else list(EXPORT_FIELDS)
+  unknown = [field for field in fields if field not in EXPORT_FIELDS]
+  if unknown:
+    return Response(status=400, text=f"unknown fields {','.join(unknown)}")
+
+  export_format = query.get("format", "ndjson")
+  if export_format not in EXPORT_FORMATS:
+    return Response(status=400, text="format must be ndjson or csv")
+
+  response = web.StreamResponse(
+    headers={
+      hdrs.CONTENT_TYPE: EXPORT_FORMATS[export_format],
+      hdrs.CONTENT_DISPOSITION: f'attachment; filename="export.{export_format}"',
+    }
+  )
+  if query.get("gzip", "false").lower() in ("1", "true"):
+    response.enable_compression(ContentCoding.gzip)
+  await response.prepare(request)
+
+  columns = [field for field in fields if field != "name"]
+  sql = f"""
+    SELECT machineid{''.join(f', {column}' for column in columns)}
+    FROM {TABLE}
+    WHERE MachineID = ANY($1::BIGINT[]) AND Time >= $2 AND Time < $3
+    ORDER BY Time;
+  """
+
+  buffer = io.StringIO()
+  writer = csv.writer(buffer)
+  if export_format == "csv":
+    writer.writerow(fields)
+
+  def render(row: dict) -> None:
+    if export_format == "csv":
+      writer.writerow(
+        ["" if row[field] is None else row[field] for field in fields]
+      )
+    else:
+      buffer.write(codec.dumps_str({field: row[field] for field in fields}))
+      buffer.write("\n")
+
+  # Cursors only live inside a transaction.
+  async with request.conn.transaction(readonly=True):
+    async for record in request.conn.cursor(
+      sql, list(names_by_id), start, end, prefetch=EXPORT_PREFETCH
+    ):
+      row = dict(record)
+      row["name"] = names_by_id.get(row["machineid"])
+      if row.get("time") is not None:
+        row["time"] = row["time"].isoformat()
+      if export_format == "ndjson" and row.get("extras") is not None:
+        row["extras"] = codec.loads(row["extras"])
+      render(row)
+      if buffer.tell() >= EXPORT_CHUNK:
+        # Waits for the client to take it, so a slow reader slows the cursor
+        # down instead of piling rows up in memory.
+        await response.write(buffer.getvalue().encode())
+        buffer.seek(0)
+        buffer.truncate()
+
+  await response.write(buffer.getvalue().encode())
+  await response.write_eof()
+  return response
+
+
+async def setup(app: web.Application) -> None:
+  for route in routes:
+    app.LOG.info(f"  ↳ {route}")
+  app.add_routes(routes)
@@ -1,6 +1,5 @@
 from __future__ import annotations
 
-import json
 import urllib.parse
 from typing import TYPE_CHECKING
 import asyncio
@@ -9,48 +8,207 @@ from aiohttp import web
 from aiohttp.web import Response
 
 
+from .utils.fleet_index import VIEWS, project
 from .utils.plugins import ALL_PLUGINS
 from .utils.scripts import ALL_SCRIPTS
+from utils import codec
+from utils.pg_pool_middleware import no_pool
 from utils.utils import validate_parameters
 
 if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
+
   from utils.extra_request import Request
-  from asyncpg import Record
 
 routes = web.RouteTableDef()
 
 
 @routes.get("/machines/get/all/")
+@no_pool
 async def get_machines_get_all(request: Request) -> Response:
+  "Every machine in the fleet. Supports If-None-Match, and gzip when accepted."
+  handler = request.app.websocket_handler
+  await handler.feed.prime()
+  snapshot = handler.snapshot
+
+  headers = {"ETag": snapshot.etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+  if snapshot.etag in request.headers.get("If-None-Match", ""):
+    snapshot.not_modified += 1
+    return Response(status=304, headers=headers)
+
+  snapshot.served += 1
+  if "gzip" in request.headers.get("Accept-Encoding", ""):
+    headers["Content-Encoding"] = "gzip"
+    body = snapshot.gzipped()
+  else:
+    body = snapshot.body()
+  return Response(body=body, content_type="application/json", headers=headers)
+
+
+@routes.get("/machines/feed/")
+@no_pool
+async def get_machines_feed(request: Request) -> web.StreamResponse:
+  """optionally pass `categories` (comma separated) in query.
+  server-sent events: a snapshot of every machine first, then only what
+  changes. See api/utils/feed.py for the events.
+  """
+  categories = request.query.get("categories", None)
+  if categories:
+    categories = set(urllib.parse.unquote_plus(categories).split(","))
+  else:
+    categories = None
+
+  feed_config: dict = request.app.config.srv.feed or {}
+  keepalive = feed_config.get("keepalive", 15)
+  feed = request.app.websocket_handler.feed
+  await feed.prime()
+
+  response = web.StreamResponse(
+    headers={
+      "Content-Type": "text/event-stream",
+      "Cache-Control": "no-cache",
+      # Don't let a reverse proxy hold events back.
+      "X-Accel-Buffering": "no",
+    }
+  )
+  await response.prepare(request)
+
+  subscriber = feed.subscribe(categories)
+  try:
+    await response.write(feed.snapshot(subscriber))
+    while True:
+      try:
+        async with asyncio.timeout(keepalive):
+          event = await subscriber.queue.get()
+      except TimeoutError:
+        # Comment line, keeps proxies from timing the stream out.
+        await response.write(b": keepalive\n\n")
+        continue
+      if event is None:
+        event = feed.snapshot(subscriber)
+      await response.write(event)
+  except ConnectionResetError:
+    pass
+  finally:
+    feed.unsubscribe(subscriber)
+  return response
+
+
+def parse_bool(value: str | None) -> bool | None:
+  "Optional true/false query parameter, raises ValueError for anything else."
+  if value is None:
+    return None
+  if value.lower() in ("1", "true"):
+    return True
+  if value.lower() in ("0", "false"):
+    return False
+  raise ValueError(value)
+
+
+@routes.get("/machines/list/")
+@no_pool
+async def get_machines_list(request: Request) -> Response:
+  """optionally pass `category`, `online`, `warning` (true/false), `prefix`,
+  `fields` (full, noextras, stats or names), `limit` (default 100, at most
+  1000) and `after` (the `next` of the previous page) in query.
+  returns {"machines": [...], "next": str | None} in name order.
+  """
+  query = request.query
   try:
-    async with asyncio.timeout(3):
-      packet = await request.app.websocket_handler.get_all_data()
-      return web.json_response(packet)
-  except asyncio.TimeoutError:
-    return Response(status=500, text="top level timeout reached")
+    online = parse_bool(query.get("online", None))
+    warning = parse_bool(query.get("warning", None))
+  except ValueError:
+    return Response(status=400, text="online and warning must be true or false!")
+
+  try:
+    limit = min(1000, max(1, int(query.get("limit", "100"))))
+  except ValueError:
+    return Response(status=400, text="limit must be integer!")
+
+  view = query.get("fields", "full")
+  if view not in VIEWS:
+    return Response(status=400, text=f"fields must be one of {', '.join(VIEWS)}")
+
+  category = query.get("category", None)
+  if category is not None:
+    category = urllib.parse.unquote_plus(category)
+
+  handler = request.app.websocket_handler
+  await handler.feed.prime()
+  cards, after = handler.index.query(
+    category=category,
+    online=online,
+    warning=warning,
+    prefix=query.get("prefix", None),
+    after=query.get("after", None),
+    limit=limit,
+  )
+  return codec.json_response(
+    {"machines": [project(card, view) for card in cards], "next": after}
+  )
 
 
 @routes.get("/machines/get/")
+@no_pool
 async def get_machines_get(request: Request) -> Response:
+  """pass `name`, or `names` (comma separated) and optionally `fields`
+  (full, noextras, stats or names) in query. `names` returns {name: machine}
+  with null for unknown machines.
+  """
   query = request.query
 
+  names = query.get("names", None)
+  if names is not None:
+    view = query.get("fields", "full")
+    if view not in VIEWS:
+      return Response(status=400, text=f"fields must be one of {', '.join(VIEWS)}")
+    handler = request.app.websocket_handler
+    await handler.feed.prime()
+    packet = {}
+    for name in urllib.parse.unquote_plus(names).split(","):
+      card = handler.index.get(name)
+      packet[name] = None if card is None else project(card, view)
+    return codec.json_response(packet)
+
   machine_name = query.get("name", None)
   if machine_name is None:
     return Response(status=400, text="missing name in query")
 
   parsed_name = urllib.parse.unquote_plus(machine_name)
 
-  packet = await request.app.websocket_handler.get_data(parsed_name)
-  if parsed_name in request.app.websocket_handler.connected_machines:
-    print(
-      request.app.websocket_handler.connected_machines[parsed_name].ws.closed
-    )
-  else:
-    print("not connected")
+  packet = await request.app.websocket_handler.find_data(parsed_name)
   if packet is None:
     return web.Response(status=404)
   else:
-    return web.json_response(packet)
+    return codec.json_response(packet)
+
+
+@routes.get("/machines/recent/")
+@no_pool
+async def get_machines_recent(request: Request) -> Response:
+  """pass `name`, and optionally `fields` (comma separated) and `points` in query.
+  returns {"capacity": int, "time": [...], "series": {"cpu.1m": [...], ...}}
+  straight from memory, oldest first, with null where a sample was missing.
+  """
+  name = request.query.get("name", None)
+  if name is None:
+    return Response(status=400, text="must pass machine name in query")
+
+  name = urllib.parse.unquote_plus(name)
+
+  fields = request.query.get("fields", None)
+  fields = fields.split(",") if fields else None
+
+  try:
+    points = request.query.get("points", None)
+    points = None if points is None else max(0, int(points))
+  except ValueError:
+    return Response(status=400, text="points must be integer!")
+
+  packet = await request.app.websocket_handler.find_recent(name, fields, points)
+  if packet is None:
+    return Response(status=404, text="machine not connected")
+  return codec.json_response(packet)
 
 
 @routes.post("/machines/create/")
@@ -66,7 +224,7 @@ async def post_machines_create(request: Request) -> Response:
   }
   """
   try:
-    data: dict = await request.json()
+    data: dict = await request.json(loads=codec.loads)
   except ValueError:
     return Response(status=400, text="invalid json body")
 
@@ -83,18 +241,14 @@ async def post_machines_create(request: Request) -> Response:
   extra_config: dict = data.get("extra_config", {})
 
   # Check if the name and category already exist.
-  machine_exists = await request.conn.fetchrow(
-    "SELECT * FROM Machines WHERE Name ILIKE $1;",
-    name,
-  )
-  if machine_exists is not None:
+  if name in request.app.machine_registry:
     return Response(status=400, text="name already registered")
 
   # Now just throw it into the database.
-  extra_str = json.dumps(extra_config)
+  extra_str = codec.dumps_str(extra_config)
 
-  result = await request.conn.execute(
-    "INSERT INTO Machines (Name, Category, CollectStats, Addons, Scripts, ExtraConfig) VALUES ($1,$2,$3,$4,$5,$6);",
+  record = await request.conn.fetchrow(
+    "INSERT INTO Machines (Name, Category, CollectStats, Addons, Scripts, ExtraConfig) VALUES ($1,$2,$3,$4,$5,$6) RETURNING *;",
     name,
     category,
     stats_enabled,
@@ -103,10 +257,11 @@ async def post_machines_create(request: Request) -> Response:
     extra_str,
   )
 
-  if result == "INSERT 0 1":
+  if record is not None:
+    request.app.machine_registry.put(record)
     return Response()
   else:
-    request.LOG.error(f"POST /machines/create/ failed; SQL result: {result}")
+    request.LOG.error("POST /machines/create/ failed; nothing was inserted")
     return Response(status=500)
 
 
@@ -121,28 +276,21 @@ async def get_machines_info(request: Request) -> Response:
 
   name = urllib.parse.unquote_plus(name)
 
-  record = await request.conn.fetchrow(
-    "SELECT * FROM Machines WHERE Name ILIKE $1;",
-    name,
-  )
+  record = request.app.machine_registry.get(name)
 
   if record is None:
     return Response(status=404, text="machine not found")
 
   packet = {
-    "name": record.get("name"),
-    "category": record.get("category"),
-    "stats_enabled": record.get("collectstats"),
-    "plugins": record.get("addons"),
-    "scripts": record.get("scripts"),
+    "name": record.name,
+    "category": record.category,
+    "stats_enabled": record.collect_stats,
+    "plugins": record.addons,
+    "scripts": record.scripts,
+    "extra_config": record.extra_config,
   }
 
-  try:
-    packet["extra_config"] = json.loads(record.get("extraconfig", "{}"))
-  except TypeError:
-    packet["extra_config"] = {}
-
-  return web.json_response(packet)
+  return codec.json_response(packet)
 
 
 @routes.post("/machines/update/")
@@ -160,7 +308,7 @@ async def post_machines_update(request: Request) -> Response:
   }
   """
   try:
-    data: dict = await request.json()
+    data: dict = await request.json(loads=codec.loads)
   except ValueError:
     return Response(status=400, text="invalid json body")
 
@@ -174,28 +322,31 @@ async def post_machines_update(request: Request) -> Response:
   new: dict = data.get("new")
 
   # Check if the name and category already exist.
-  machine_exists: Record = await request.conn.fetchrow(
-    "SELECT * FROM Machines WHERE Name ILIKE $1;",
-    name,
-  )
+  machine_exists = request.app.machine_registry.get(name)
 
   if machine_exists is None:
     return Response(status=400, text="machine not found")
 
-  new_name: str = new.get("name", machine_exists.get("name"))
-  new_category: str = new.get("category", machine_exists.get("category"))
+  new_name: str = new.get("name", machine_exists.name)
+  new_category: str = new.get("category", machine_exists.category)
   new_stats_enabled: bool = new.get(
-    "stats_enabled", machine_exists.get("collectstats")
+    "stats_enabled", machine_exists.collect_stats
   )
-  new_plugins: str = new.get("plugins", machine_exists.get("addons"))
-  new_scripts: str = new.get("scripts", machine_exists.get("scripts"))
+  new_plugins: str = new.get("plugins", machine_exists.addons)
+  new_scripts: str = new.get("scripts", machine_exists.scripts)
   new_extra_config: dict = new.get(
-    "extra_config", machine_exists.get("extraconfig")
+    "extra_config", machine_exists.extra_config
   )
 
+  if (
+    new_name.lower() != machine_exists.name.lower()
+    and new_name in request.app.machine_registry
+  ):
+    return Response(status=400, text="name already registered")
+
   # Now just throw it into the database.
 
-  result = await request.conn.execute(
+  record = await request.conn.fetchrow(
     """
     UPDATE
       Machines
@@ -207,7 +358,8 @@ async def post_machines_update(request: Request) -> Response:
       Scripts = $6,
       ExtraConfig = $7
     WHERE
-      Name ILIKE $1;
+      Name ILIKE $1
+    RETURNING *;
     """,
     name,
     new_name,
@@ -215,13 +367,17 @@ async def post_machines_update(request: Request) -> Response:
     new_stats_enabled,
     new_plugins,
     new_scripts,
-    json.dumps(new_extra_config),
+    codec.dumps_str(new_extra_config),
   )
 
-  if result == "UPDATE 1":
+  if record is not None:
+    # Only a rename is a remove and an add, anything else is changed in place.
+    if new_name.lower() != machine_exists.name.lower():
+      request.app.machine_registry.remove(name)
+    request.app.machine_registry.put(record)
     return Response()
   else:
-    request.LOG.error(f"POST /machines/update/ failed; SQL result: {result}")
+    request.LOG.error("POST /machines/update/ failed; nothing was updated")
     return Response(status=500)
 
 
@@ -234,12 +390,7 @@ async def delete_machines_delete(request: Request) -> Response:
 
   name = urllib.parse.unquote_plus(name)
 
-  record = await request.conn.fetchrow(
-    "SELECT * FROM Machines WHERE Name ILIKE $2;",
-    name,
-  )
-
-  if record is None:
+  if name not in request.app.machine_registry:
     return Response(status=404, text="machine not found")
 
   result = await request.conn.execute(
@@ -248,12 +399,20 @@ async def delete_machines_delete(request: Request) -> Response:
   )
 
   if result == "DELETE 1":
+    request.app.machine_registry.remove(name)
     return Response()
   else:
     request.LOG.error(f"DELETE /machines/delete/ failed; SQL result: {result}")
     return Response(status=500)
 
 
+@routes.post("/machines/reload/")
+async def post_machines_reload(request: Request) -> Response:
+  "Reload the machine registry, for when the Machines table was edited by hand."
+  await request.app.cluster.reload_registry(request.app.machine_registry)
+  return Response()
+
+
 @routes.post("/machines/disconnect/")
 async def post_machines_disconnect(request: Request) -> Response:
   "pass `name` in query."
@@ -263,27 +422,62 @@ async def post_machines_disconnect(request: Request) -> Response:
 
   name = urllib.parse.unquote_plus(name)
 
-  if (
-    name not in request.app.websocket_handler.connected_machines
-    or not request.app.websocket_handler.connected_machines[name].online
-  ):
+  ws_handler = request.app.websocket_handler
+  owner = await ws_handler.find_owner(name)
+  if owner is None:
     return Response(status=409, text="machine not connected")
 
-  await request.app.websocket_handler.remove_machine(name)
+  await ws_handler.command(owner, "disconnect", name)
   return Response()
 
 
-@routes.post("/machines/disconnect/all/")
-async def post_machines_disconnect_all(request: Request) -> Response:
-  names = list(request.app.websocket_handler.connected_machines.keys())
+async def fleet_command(
+  request: Request,
+  action: str,
+  names: list[str],
+  func: Callable[[str], Awaitable[bool | None]],
+  *,
+  details: dict = None,
+) -> Response:
+  """Run a command against many machines through the fan-out executor.
+
+  With `async=true` in query this returns a job straight away (HTTP 202),
+  poll it with GET /machines/jobs/get/?id=. Otherwise it waits and returns
+  the per-machine report."""
+  fanout = request.app.websocket_handler.fanout
+  if request.query.get("async", "false").lower() == "true":
+    job = fanout.start(action, names, func, details=details)
+    return codec.json_response(job.report(), status=202)
+  job = await fanout.run(action, names, func, details=details)
+  return codec.json_response(job.report())
+
+
+@routes.get("/machines/jobs/get/")
+async def get_machines_jobs_get(request: Request) -> Response:
+  "pass `id` in query."
+  job_id = request.query.get("id", None)
+  if job_id is None:
+    return Response(status=400, text="must pass job id in query")
+
+  # The job may have been started by another worker.
+  report = await request.app.websocket_handler.find_job(job_id)
+  if report is None:
+    return Response(status=404, text="job not found")
+  return codec.json_response(report)
 
-  for name in names:
-    try:
-      await request.app.websocket_handler.remove_machine(name)
-    except Exception:
-      request.LOG.error(f"failed to reconnect {name}")
 
-  return Response()
+@routes.post("/machines/disconnect/all/")
+async def post_machines_disconnect_all(request: Request) -> Response:
+  "optionally pass `async` in query."
+  ws_handler = request.app.websocket_handler
+  owners = await ws_handler.fleet_owners()
+
+  return await fleet_command(
+    request,
+    "disconnect",
+    list(owners),
+    lambda name: ws_handler.command(owners[name], "disconnect", name),
+  )
 
 
 @routes.post("/machines/reconnect/")
@@ -300,37 +494,57 @@ async def post_machines_reconnect(request: Request) -> Response:
   except ValueError:
     return Response(status=400, text="after must be integer!")
 
-  if (
-    name not in request.app.websocket_handler.connected_machines
-    or not request.app.websocket_handler.connected_machines[name].online
-  ):
+  ws_handler = request.app.websocket_handler
+  owner = await ws_handler.find_owner(name)
+  if owner is None:
     return Response(status=409, text="machine not connected")
 
-  await request.app.websocket_handler.reconnect_machine(
-    name, reconnect_after=reconnect_after
+  await ws_handler.command(
+    owner, "reconnect", name, reconnect_after=reconnect_after
   )
   return Response()
 
 
+def parse_spread(request: Request) -> tuple[float | None, str]:
+  """`spread` is the window in seconds machines are spread over, defaulting to
+  however long the handshake admission rate needs for the whole fleet.
+  `mode` is "spread" (evenly placed) or "jitter" (random)."""
+  spread = request.query.get("spread", None)
+  mode = request.query.get("mode", "spread")
+  if mode not in ("spread", "jitter"):
+    raise ValueError("mode must be spread or jitter!")
+  return (None if spread is None else float(spread)), mode
+
+
 @routes.post("/machines/reconnect/all/")
 async def post_machines_reconnect_all(request: Request) -> Response:
-  "pass `name` in query."
+  "pass `after`, and optionally `spread`, `mode` and `async` in query."
   try:
     reconnect_after = int(request.query.get("after", "5"))
   except ValueError:
     return Response(status=400, text="after must be integer!")
 
-  names = list(request.app.websocket_handler.connected_machines.keys())
-
-  for name in names:
-    try:
-      await request.app.websocket_handler.reconnect_machine(
-        name, reconnect_after=reconnect_after
-      )
-    except Exception:
-      request.LOG.exception(f"failed to reconnect {name}")
+  try:
+    spread, mode = parse_spread(request)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  ws_handler = request.app.websocket_handler
+  owners = await ws_handler.fleet_owners()
+  names = list(owners)
+  delays = ws_handler.reconnect_delays(
+    names, after=reconnect_after, spread=spread, mode=mode
+  )
 
-  return Response()
+  return await fleet_command(
+    request,
+    "reconnect",
+    names,
+    lambda name: ws_handler.command(
+      owners[name], "reconnect", name, reconnect_after=delays[name]
+    ),
+    details={"reconnect_after": delays},
+  )
 
 
 @routes.post("/machines/updateclient/")
@@ -342,27 +556,37 @@ async def post_machines_updateclient(request: Request) -> Response:
 
   name = urllib.parse.unquote_plus(name)
 
-  if (
-    name not in request.app.websocket_handler.connected_machines
-    or not request.app.websocket_handler.connected_machines[name].online
-  ):
+  ws_handler = request.app.websocket_handler
+  owner = await ws_handler.find_owner(name)
+  if owner is None:
     return Response(status=409, text="machine not connected")
 
-  await request.app.websocket_handler.update_client(name)
+  await ws_handler.command(owner, "updateclient", name, reconnect_after=0)
   return Response()
 
 
 @routes.post("/machines/updateclient/all/")
 async def post_machines_updateclient_all(request: Request) -> Response:
-  names = list(request.app.websocket_handler.connected_machines.keys())
-
-  for name in names:
-    try:
-      await request.app.websocket_handler.update_client(name)
-    except Exception:
-      request.LOG.exception(f"failed to update {name}")
-
-  return Response()
+  "optionally pass `spread`, `mode` and `async` in query."
+  try:
+    spread, mode = parse_spread(request)
+  except ValueError as e:
+    return Response(status=400, text=str(e))
+
+  ws_handler = request.app.websocket_handler
+  owners = await ws_handler.fleet_owners()
+  names = list(owners)
+  delays = ws_handler.reconnect_delays(names, after=0, spread=spread, mode=mode)
+
+  return await fleet_command(
+    request,
+    "updateclient",
+    names,
+    lambda name: ws_handler.command(
+      owners[name], "updateclient", name, reconnect_after=delays[name]
+    ),
+    details={"reconnect_after": delays},
+  )
 
 
 @routes.get("/machines/get/scripts/")
@@ -371,7 +595,7 @@ async def get_machines_get_scripts(request: Request) -> Response:
   script_names = list(ALL_SCRIPTS.keys())
   plugin_names = list(ALL_PLUGINS.keys())
   
-  return web.json_response({
+  return codec.json_response({
     "plugins": plugin_names,
     "scripts": script_names
   })
@@ -385,27 +609,27 @@ async def post_machines_clearwarnings(request: Request) -> Response:
 
   name = urllib.parse.unquote_plus(name)
 
-  if (
-    name not in request.app.websocket_handler.connected_machines
-    or not request.app.websocket_handler.connected_machines[name].online
-  ):
+  ws_handler = request.app.websocket_handler
+  owner = await ws_handler.find_owner(name)
+  if owner is None:
     return Response(status=409, text="machine not connected")
 
-  request.app.websocket_handler.connected_machines[name]._warnings.clear()
+  await ws_handler.command(owner, "clearwarnings", name)
   return Response()
 
 
 @routes.post("/machines/clearwarnings/all/")
 async def post_machines_clearwarnings_all(request: Request) -> Response:
-  names = list(request.app.websocket_handler.connected_machines.keys())
-
-  for name in names:
-    try:
-      request.app.websocket_handler.connected_machines[name]._warnings.clear()
-    except Exception:
-      request.LOG.exception(f"failed to clear warnings for {name}")
-
-  return Response()
+  "optionally pass `async` in query."
+  ws_handler = request.app.websocket_handler
+  owners = await ws_handler.fleet_owners()
+
+  return await fleet_command(
+    request,
+    "clearwarnings",
+    list(owners),
+    lambda name: ws_handler.command(owners[name], "clearwarnings", name),
+  )
 
 
 async def setup(app: web.Application) -> None:
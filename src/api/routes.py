@@ -6,6 +6,11 @@ from typing import TYPE_CHECKING
 from aiohttp import web
 from aiohttp.web import Response
 
+from utils import codec
+from utils.pg_pool_middleware import no_pool
+
+from .utils.fleet_counters import merge_counters
+
 if TYPE_CHECKING:
   from utils.extra_request import Request
 
@@ -13,29 +18,37 @@ routes = web.RouteTableDef()
 
 
 @routes.get("/srv/get/")
+@no_pool
 async def get_lp_get(request: Request) -> Response:
   packet = {
     "frontend_version": request.app.config.pages.frontend_version,
     "api_version": request.app.config.pages.api_version,
   }
 
+  # Kept up to date as machines change, so this doesn't grow with the fleet.
+  counters = request.app.fleet_counters
   if request.app.POSTGRES_ENABLED:
-    database_size_record = await request.conn.fetchrow(
-      "SELECT pg_size_pretty ( pg_database_size ( current_database() ) );"
-    )
-    packet["db_size"] = database_size_record.get("pg_size_pretty", "-1 kB")
-
-  total_machines_record = await request.conn.fetchrow("SELECT COUNT(*) FROM Machines;")
-
-  packet["total_machines"] = total_machines_record.get("count")
-  packet["online_machines"] = len(
-    [
-      cm
-      for cm in request.app.websocket_handler.connected_machines.values()
-      if cm.online
-    ]
-  )
-  return web.json_response(packet)
+    packet["db_size"] = counters.db_size or "-1 kB"
+  fleet = counters.out()
+  for other in (await request.app.cluster.broadcast("counters")).values():
+    merge_counters(fleet, other)
+  packet.update(fleet)
+  return codec.json_response(packet)
+
+
+@routes.get("/srv/metrics/")
+async def get_srv_metrics(request: Request) -> Response:
+  packet = {name: provider() for name, provider in request.app.metrics.items()}
+  return codec.json_response(packet)
+
+
+@routes.get("/srv/notifications/")
+async def get_srv_notifications(request: Request) -> Response:
+  "Notification queue counters and the notifications that couldn't be sent."
+  notifier = request.app.notifier
+  packet = notifier.metrics()
+  packet["dead_letters"] = list(notifier.dead_letters)
+  return codec.json_response(packet)
 
 
 async def setup(app: web.Application) -> None:
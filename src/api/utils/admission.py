@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import math
+import random
+import time
+
+# How quickly the recent-rejection and handshake-rate estimates decay.
+WINDOW = 10.0
+
+
+class TokenBucket:
+  rate: float  # Tokens added per second.
+  burst: float  # Maximum number of tokens held.
+  tokens: float
+  updated: float
+
+  def __init__(self, rate: float, burst: float) -> None:
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+
+  def _refill(self, now: float) -> None:
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def take(self) -> float:
+    "Take a token. Returns 0 on success, or seconds until one is available."
+    now = time.monotonic()
+    self._refill(now)
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0.0
+    return (1 - self.tokens) / self.rate
+
+
+class DecayingCounter:
+  "Exponentially decaying event count, roughly 'events in the last WINDOW s'."
+  value: float
+  updated: float
+
+  def __init__(self) -> None:
+    self.value = 0.0
+    self.updated = time.monotonic()
+
+  def _decay(self, now: float) -> None:
+    self.value *= math.exp(-(now - self.updated) / WINDOW)
+    self.updated = now
+
+  def add(self, amount: float = 1.0) -> None:
+    self._decay(time.monotonic())
+    self.value += amount
+
+  def get(self) -> float:
+    self._decay(time.monotonic())
+    return self.value
+
+
+class AdmissionController:
+  "Rate limits handshakes so a reconnect storm can't flatten the server."
+
+  bucket: TokenBucket
+  admitted: int
+  rejected: int
+  _recent_handshakes: DecayingCounter
+  _recent_rejections: DecayingCounter
+
+  def __init__(self, *, rate: float = 50, burst: float = 100) -> None:
+    self.bucket = TokenBucket(rate, burst)
+    self.admitted = 0
+    self.rejected = 0
+    self._recent_handshakes = DecayingCounter()
+    self._recent_rejections = DecayingCounter()
+
+  @property
+  def rate(self) -> float:
+    return self.bucket.rate
+
+  def admit(self) -> float | None:
+    """Returns None if the handshake may go ahead, or a retry-after hint.
+
+    The hint is jittered over the backlog of recently rejected clients, so
+    they don't all come back in the same second.
+    """
+    wait = self.bucket.take()
+    if wait == 0:
+      self.admitted += 1
+      self._recent_handshakes.add()
+      return None
+    self.rejected += 1
+    self._recent_rejections.add()
+    backlog = self._recent_rejections.get() / self.bucket.rate
+    return wait + random.uniform(0, max(1.0, backlog))
+
+  def metrics(self) -> dict:
+    return {
+      "rate_limit": self.bucket.rate,
+      "burst": self.bucket.burst,
+      "tokens": round(self.bucket.tokens, 2),
+      "admitted": self.admitted,
+      "rejected": self.rejected,
+      "handshakes_per_second": round(self._recent_handshakes.get() / WINDOW, 2),
+      "rejections_per_second": round(self._recent_rejections.get() / WINDOW, 2),
+    }
+
+
+def reconnect_delays(
+  names: list[str],
+  *,
+  after: float,
+  spread: float,
+  mode: str = "spread",
+) -> dict[str, float]:
+  """Give every machine its own reconnect delay between after and after+spread.
+
+  "spread" places machines evenly over the window in a random order,
+  "jitter" picks an independent random delay for each machine.
+  """
+  if mode not in ("spread", "jitter"):
+    raise ValueError(f"unknown reconnect mode {mode!r}")
+  if not names or spread <= 0:
+    return {name: after for name in names}
+  if mode == "jitter":
+    return {name: round(after + random.uniform(0, spread), 2) for name in names}
+  shuffled = random.sample(names, len(names))
+  step = spread / len(shuffled)
+  return {name: round(after + i * step, 2) for i, name in enumerate(shuffled)}
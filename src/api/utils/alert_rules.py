@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import logging
+from typing import TYPE_CHECKING
+
+import py_expression_eval
+
+from utils.utils import validate_parameters
+
+if TYPE_CHECKING:
+  from collections.abc import Callable
+  from typing import Any
+
+  from .data_classes import ConnectedMachine
+
+LOG = logging.getLogger(__name__)
+
+# extra_config["usagealert"] sections holding expression rules, and the part
+# of the packet each one reads from.
+SECTIONS = ("raw_alert", "processed_alert")
+
+
+def compile_path(key: str) -> tuple[str, ...]:
+  "Split a `a/b/c/` key once. Empty parts, like from a trailing /, are dropped."
+  return tuple(part for part in key.split("/") if part)
+
+
+def resolve(data: dict, path: tuple[str, ...]) -> dict | None:
+  "Follow a compiled path into nested dicts. None unless it ends at a dict."
+  for part in path:
+    if not isinstance(data, dict):
+      return None
+    data = data.get(part)
+  return data if isinstance(data, dict) else None
+
+
+def compile_expression(
+  expression: py_expression_eval.Expression,
+) -> Callable[[dict], Any]:
+  """Turn a parsed expression into nested closures, so evaluating it is a few
+  calls rather than a walk over its tokens. Operators and functions are the
+  parser's own, so results match `Expression.evaluate`."""
+  ops1 = expression.ops1
+  ops2 = expression.ops2
+  functions = expression.functions
+  stack: list[Callable[[dict], Any]] = []
+
+  for token in expression.tokens:
+    kind = token.type_
+    if kind == py_expression_eval.TNUMBER:
+      number = token.number_
+      stack.append(lambda values, number=number: number)
+    elif kind == py_expression_eval.TVAR:
+      name = token.index_
+      if name in functions:
+        function = functions[name]
+        stack.append(
+          lambda values, name=name, function=function: values.get(name, function)
+        )
+      else:
+        stack.append(lambda values, name=name: values[name])
+    elif kind == py_expression_eval.TOP1:
+      op = ops1[token.index_]
+      operand = stack.pop()
+      stack.append(lambda values, op=op, operand=operand: op(operand(values)))
+    elif kind == py_expression_eval.TOP2:
+      op = ops2[token.index_]
+      right = stack.pop()
+      left = stack.pop()
+      stack.append(
+        lambda values, op=op, left=left, right=right: op(left(values), right(values))
+      )
+    elif kind == py_expression_eval.TFUNCALL:
+      arguments = stack.pop()
+      function = stack.pop()
+      stack.append(
+        lambda values, function=function, arguments=arguments: _call(
+          function(values), arguments(values)
+        )
+      )
+    else:
+      raise ValueError("invalid expression")
+
+  if len(stack) != 1:
+    raise ValueError("invalid expression (parity)")
+  return stack[0]
+
+
+def _call(function: Any, arguments: Any) -> Any:
+  if not callable(function):
+    raise ValueError(f"{function} is not a function")
+  if type(arguments) is list:
+    return function(*arguments)
+  return function(arguments)
+
+
+class AlertRule:
+  "One raw_alert/processed_alert entry, parsed and ready to check."
+
+  key: str
+  path: tuple[str, ...]
+  # Names the expression reads, the only ones worth pulling out of the data.
+  # Function names too, a value in the data wins over the function, as it
+  # does in `Expression.evaluate`.
+  variables: tuple[str, ...]
+  evaluate: Callable[[dict], Any]
+  threshold: float
+  message: str
+
+  def __init__(
+    self,
+    key: str,
+    expression: py_expression_eval.Expression,
+    threshold: float,
+    message: str,
+  ) -> None:
+    self.key = key
+    self.path = compile_path(key)
+    self.variables = tuple(expression.symbols())
+    self.evaluate = compile_expression(expression)
+    self.threshold = threshold
+    self.message = message if message.endswith("\n") else message + "\n"
+
+  def check(self, data: dict) -> bool:
+    "Whether the expression, fed the numbers in `data`, is over the threshold."
+    values = {}
+    for name in self.variables:
+      value = data.get(name)
+      if isinstance(value, (int, float)):
+        values[name] = value
+    return self.evaluate(values) > self.threshold
+
+
+class CompiledRules:
+  "Every expression rule of one machine, as of one version of its extra_config."
+
+  version: int
+  raw_alert: list[AlertRule]
+  processed_alert: list[AlertRule]
+
+  def __init__(self, version: int) -> None:
+    self.version = version
+    self.raw_alert = []
+    self.processed_alert = []
+
+
+class AlertRuleCache:
+  """Keeps each machine's alert rules compiled.
+
+  Rules are parsed once per `ConnectedMachine.config_version`, which changes
+  whenever the machine's extra_config is loaded or written, and rebuilt on the
+  next packet after that. Broken rules are logged once, when compiled, and
+  left out."""
+
+  parser: py_expression_eval.Parser
+  # Machine name -> its rules
+  machines: dict[str, CompiledRules]
+  compiles: int
+  hits: int
+  errors: int
+
+  def __init__(self) -> None:
+    self.parser = py_expression_eval.Parser()
+    self.machines = {}
+    self.compiles = 0
+    self.hits = 0
+    self.errors = 0
+
+  def get(self, machine: ConnectedMachine, alert_config: dict) -> CompiledRules:
+    rules = self.machines.get(machine.name)
+    if rules is not None and rules.version == machine.config_version:
+      self.hits += 1
+      return rules
+    rules = self.compile(machine.name, machine.config_version, alert_config)
+    self.machines[machine.name] = rules
+    return rules
+
+  def compile(self, machine_name: str, version: int, alert_config: dict) -> CompiledRules:
+    self.compiles += 1
+    rules = CompiledRules(version)
+    for section in SECTIONS:
+      compiled: list[AlertRule] = getattr(rules, section)
+      for key, data in (alert_config.get(section) or {}).items():
+        # First check if all required values are present.
+        ok, missing = validate_parameters(data, ["value", "message", "threshold"])
+        if not ok:
+          self.errors += 1
+          LOG.warning(f"{machine_name} {section} for {key} is missing parameter {missing}!")
+          continue
+        try:
+          expression = self.parser.parse(data["value"])
+          compiled.append(AlertRule(key, expression, data["threshold"], data["message"]))
+        except Exception as e:
+          self.errors += 1
+          LOG.warning(f"{machine_name} {section} for {key} doesn't compile: {e}")
+    return rules
+
+  def forget(self, machine_name: str) -> None:
+    self.machines.pop(machine_name, None)
+
+  def metrics(self) -> dict:
+    return {
+      "machines": len(self.machines),
+      "compiles": self.compiles,
+      "hits": self.hits,
+      "errors": self.errors,
+    }
@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import os
+import secrets
+import shutil
+import signal
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import TYPE_CHECKING
+
+from utils import codec
+
+from .machine_registry import MachineRecord
+
+if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
+  from typing import Any
+
+  from .machine_registry import MachineRegistry
+
+LOG = logging.getLogger(__name__)
+
+# Environment variables the supervisor hands to every worker.
+WORKER_ID_ENV = "STATUS_WORKER_ID"
+WORKERS_ENV = "STATUS_WORKERS"
+DIRECTORY_ENV = "STATUS_CLUSTER_DIR"
+# /ws/start/ and /ws/connect/ can land on different workers, so they have to
+# agree on the connect token secret.
+TOKEN_SECRET_ENV = "STATUS_TOKEN_SECRET"
+
+# Every frame is a 4 byte big endian length followed by a JSON body.
+HEADER = struct.Struct(">I")
+
+
+class ClusterError(Exception):
+  "A peer couldn't be reached, or failed to answer a request."
+
+
+async def _read_frame(reader: asyncio.StreamReader) -> dict:
+  (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+  return codec.loads(await reader.readexactly(length))
+
+
+def _write_frame(writer: asyncio.StreamWriter, data: dict) -> None:
+  body = codec.dumps(data)
+  writer.write(HEADER.pack(len(body)) + body)
+
+
+class Peer:
+  """One persistent connection to another worker.
+
+  Requests carry an id so any number of them can be in flight at once, the
+  reader task matches each reply back to the future waiting on it."""
+
+  worker_id: int
+  path: str
+  reader: asyncio.StreamReader | None
+  writer: asyncio.StreamWriter | None
+  reader_task: asyncio.Task | None
+  pending: dict[int, asyncio.Future]
+  ids: itertools.count
+  _connect_lock: asyncio.Lock
+
+  def __init__(self, worker_id: int, path: str) -> None:
+    self.worker_id = worker_id
+    self.path = path
+    self.reader = None
+    self.writer = None
+    self.reader_task = None
+    self.pending = {}
+    self.ids = itertools.count()
+    self._connect_lock = asyncio.Lock()
+
+  async def _connect(self) -> None:
+    async with self._connect_lock:
+      if self.writer is not None and not self.writer.is_closing():
+        return
+      try:
+        self.reader, self.writer = await asyncio.open_unix_connection(self.path)
+      except OSError as e:
+        raise ClusterError(f"worker {self.worker_id} unreachable: {e}") from e
+      self.reader_task = asyncio.create_task(self._read_replies())
+
+  async def _read_replies(self) -> None:
+    try:
+      while True:
+        reply = await _read_frame(self.reader)
+        future = self.pending.pop(reply.get("id"), None)
+        if future is None or future.done():
+          continue
+        if "error" in reply:
+          future.set_exception(ClusterError(reply["error"]))
+        else:
+          future.set_result(reply.get("result"))
+    except (asyncio.IncompleteReadError, OSError, ValueError):
+      pass
+    finally:
+      # Whatever was waiting on this connection will never get an answer.
+      self.writer.close()
+      for future in self.pending.values():
+        if not future.done():
+          future.set_exception(ClusterError(f"worker {self.worker_id} went away"))
+      self.pending.clear()
+
+  async def call(self, op: str, args: dict, timeout: float) -> Any:
+    await self._connect()
+    request_id = next(self.ids)
+    future = asyncio.get_running_loop().create_future()
+    self.pending[request_id] = future
+    _write_frame(self.writer, {"id": request_id, "op": op, "args": args})
+    try:
+      async with asyncio.timeout(timeout):
+        return await future
+    except TimeoutError as e:
+      raise ClusterError(f"worker {self.worker_id} timed out on {op}") from e
+    finally:
+      self.pending.pop(request_id, None)
+
+  def close(self) -> None:
+    if self.reader_task is not None:
+      self.reader_task.cancel()
+    if self.writer is not None:
+      self.writer.close()
+
+
+class Cluster:
+  """Lets the worker processes of one server answer for each other.
+
+  Every worker listens on a unix socket in a shared directory. A machine
+  belongs to whichever worker accepted its websocket, so anything that needs
+  that machine is sent to the worker holding it. With a single worker every
+  call stays local and nothing is listening."""
+
+  worker_id: int
+  workers: int
+  directory: str | None
+  timeout: float  # Seconds a peer gets to answer before it is skipped.
+  handlers: dict[str, Callable[..., Awaitable[Any] | Any]]
+  peers: dict[int, Peer]
+  server: asyncio.AbstractServer | None
+  calls: int
+  served: int
+  failures: int
+  _quiet: bool
+  # Fire-and-forget tasks, kept so they aren't garbage collected mid-flight.
+  _tasks: set[asyncio.Task]
+
+  def __init__(
+    self,
+    *,
+    worker_id: int = 0,
+    workers: int = 1,
+    directory: str | None = None,
+    timeout: float = 2,
+  ) -> None:
+    self.worker_id = worker_id
+    self.workers = workers
+    self.directory = directory
+    self.timeout = timeout
+    self.handlers = {}
+    self.peers = {
+      peer_id: Peer(peer_id, self.socket_path(peer_id))
+      for peer_id in range(workers)
+      if peer_id != worker_id
+    }
+    self.server = None
+    self.calls = 0
+    self.served = 0
+    self.failures = 0
+    self._quiet = False
+    self._tasks = set()
+
+  @classmethod
+  def from_environment(cls, *, timeout: float = 2) -> Cluster:
+    "The cluster this process was started into by `supervise`, if any."
+    if WORKER_ID_ENV not in os.environ:
+      return cls(timeout=timeout)
+    return cls(
+      worker_id=int(os.environ[WORKER_ID_ENV]),
+      workers=int(os.environ[WORKERS_ENV]),
+      directory=os.environ[DIRECTORY_ENV],
+      timeout=timeout,
+    )
+
+  @property
+  def enabled(self) -> bool:
+    return self.workers > 1
+
+  @property
+  def primary(self) -> bool:
+    "Jobs that must only run once per server run on the primary worker."
+    return self.worker_id == 0
+
+  def socket_path(self, worker_id: int) -> str:
+    return os.path.join(self.directory or "", f"worker-{worker_id}.sock")
+
+  def _spawn(self, coro: Awaitable[Any]) -> None:
+    task = asyncio.create_task(coro)
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  def register(self, op: str, handler: Callable[..., Awaitable[Any] | Any]) -> None:
+    "Answer `op` from peers. The handler is called with the request's args."
+    self.handlers[op] = handler
+
+  async def start(self) -> None:
+    if not self.enabled:
+      return
+    path = self.socket_path(self.worker_id)
+    with contextlib.suppress(FileNotFoundError):
+      os.unlink(path)
+    self.server = await asyncio.start_unix_server(self._serve, path=path)
+    LOG.info(f"[CLUSTER] worker {self.worker_id}/{self.workers} listening on {path}")
+
+  async def close(self) -> None:
+    for peer in self.peers.values():
+      peer.close()
+    if self.server is not None:
+      self.server.close()
+
+  async def _serve(
+    self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+  ) -> None:
+    try:
+      while True:
+        request = await _read_frame(reader)
+        # Answer concurrently, a slow command mustn't hold up the rest.
+        self._spawn(self._answer(request, writer))
+    except (asyncio.IncompleteReadError, OSError, ValueError):
+      pass
+    finally:
+      writer.close()
+
+  async def _answer(self, request: dict, writer: asyncio.StreamWriter) -> None:
+    self.served += 1
+    reply = {"id": request.get("id")}
+    handler = self.handlers.get(request.get("op"))
+    if handler is None:
+      reply["error"] = f"unknown op {request.get('op')!r}"
+    else:
+      try:
+        result = handler(**request.get("args", {}))
+        if asyncio.iscoroutine(result):
+          result = await result
+        reply["result"] = result
+      except Exception as e:
+        LOG.exception(f"[CLUSTER] failed to answer {request.get('op')}")
+        reply["error"] = str(e)
+    if not writer.is_closing():
+      _write_frame(writer, reply)
+
+  async def call(
+    self, worker_id: int, op: str, *, timeout: float | None = None, **args: Any
+  ) -> Any:
+    """Run `op` on one worker, this one included. Raises ClusterError.
+    `timeout` overrides the cluster's for ops that take longer by design."""
+    if worker_id == self.worker_id:
+      result = self.handlers[op](**args)
+      return await result if asyncio.iscoroutine(result) else result
+    self.calls += 1
+    try:
+      return await self.peers[worker_id].call(op, args, timeout or self.timeout)
+    except ClusterError:
+      self.failures += 1
+      raise
+
+  async def broadcast(
+    self, op: str, *, timeout: float | None = None, **args: Any
+  ) -> dict[int, Any]:
+    """Run `op` on every other worker. Workers that fail or time out are
+    logged and left out of the result, so one stuck worker can't take the
+    whole server's answers down with it."""
+    if not self.peers:
+      return {}
+    peer_ids = list(self.peers)
+    results = await asyncio.gather(
+      *(self.call(peer_id, op, timeout=timeout, **args) for peer_id in peer_ids),
+      return_exceptions=True,
+    )
+    replies = {}
+    for peer_id, result in zip(peer_ids, results, strict=True):
+      if isinstance(result, Exception):
+        LOG.warning(f"[CLUSTER] worker {peer_id} failed {op}: {result}")
+      else:
+        replies[peer_id] = result
+    return replies
+
+  def watch_registry(self, registry: MachineRegistry) -> None:
+    "Keep the other workers' registries in step with changes made on this one."
+
+    def changed(old: MachineRecord | None, new: MachineRecord | None) -> None:
+      if self._quiet or not self.enabled:
+        return
+      if new is None:
+        self._spawn(self.broadcast("registry_remove", name=old.name))
+      else:
+        self._spawn(self.broadcast("registry_put", record=new.out()))
+
+    def put(record: dict) -> None:
+      with self.quiet():
+        registry.put(MachineRecord(**record))
+
+    def remove(name: str) -> None:
+      with self.quiet():
+        registry.remove(name)
+
+    async def reload() -> None:
+      records = await registry.fetch()
+      with self.quiet():
+        registry.replace(records)
+
+    registry.listeners.append(changed)
+    self.register("registry_put", put)
+    self.register("registry_remove", remove)
+    self.register("registry_reload", reload)
+
+  @contextlib.contextmanager
+  def quiet(self):
+    "Registry changes made inside this block aren't passed on to peers."
+    self._quiet = True
+    try:
+      yield
+    finally:
+      self._quiet = False
+
+  async def reload_registry(self, registry: MachineRegistry) -> None:
+    "Reload the registry here and on every other worker."
+    # Only the reload's own changes are kept quiet, not whatever else happens
+    # on this worker while the rows are fetched.
+    records = await registry.fetch()
+    with self.quiet():
+      registry.replace(records)
+    await self.broadcast("registry_reload")
+
+  def metrics(self) -> dict:
+    return {
+      "worker_id": self.worker_id,
+      "workers": self.workers,
+      "calls": self.calls,
+      "served": self.served,
+      "failures": self.failures,
+    }
+
+
+def supervise(workers: int, argv: list[str]) -> None:
+  """Run `workers` copies of the server sharing one listen port, restarting
+  any that die, until interrupted."""
+  directory = tempfile.mkdtemp(prefix="status-cluster-")
+  env = {
+    **os.environ,
+    WORKERS_ENV: str(workers),
+    DIRECTORY_ENV: directory,
+    TOKEN_SECRET_ENV: os.environ.get(TOKEN_SECRET_ENV) or secrets.token_hex(32),
+  }
+
+  def spawn(worker_id: int) -> subprocess.Popen:
+    LOG.info(f"[CLUSTER] starting worker {worker_id}")
+    # In their own session, so a ^C in the terminal only reaches the
+    # supervisor, which passes it on once.
+    return subprocess.Popen(
+      [sys.executable, *argv],
+      env={**env, WORKER_ID_ENV: str(worker_id)},
+      start_new_session=True,
+    )
+
+  processes = {worker_id: spawn(worker_id) for worker_id in range(workers)}
+  stopping = False
+
+  def stop(signum: int, frame: Any) -> None:
+    nonlocal stopping
+    stopping = True
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  try:
+    while not stopping:
+      time.sleep(1)
+      for worker_id, process in processes.items():
+        code = process.poll()
+        if code is not None and not stopping:
+          LOG.error(f"[CLUSTER] worker {worker_id} exited with {code}, restarting")
+          processes[worker_id] = spawn(worker_id)
+  finally:
+    for process in processes.values():
+      process.send_signal(signal.SIGINT)
+    for process in processes.values():
+      try:
+        process.wait(timeout=30)
+      except subprocess.TimeoutExpired:
+        process.kill()
+    shutil.rmtree(directory, ignore_errors=True)
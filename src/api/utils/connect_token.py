@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import hmac
+import secrets
+import time
+from typing import TYPE_CHECKING
+
+from utils import codec
+
+if TYPE_CHECKING:
+  from typing import Any
+
+# A connect token is `base64(payload).base64(hmac_sha256(payload))`.
+# /ws/start/ resolves everything about a machine once and signs it, so
+# /ws/connect/ only has to check the signature instead of asking Postgres.
+
+
+def _b64encode(data: bytes) -> str:
+  return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+  return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class ConnectTokenSigner:
+  secret: bytes
+  ttl: int  # Seconds a token stays valid for.
+  issued: int
+  verified: int
+  rejected: int
+
+  def __init__(self, secret: str | bytes | None = None, *, ttl: int = 60) -> None:
+    if not secret:
+      # Tokens only need to survive the few seconds between /ws/start/ and
+      # /ws/connect/, so a random per-process secret is fine for one server.
+      secret = secrets.token_bytes(32)
+    elif isinstance(secret, str):
+      secret = secret.encode()
+    self.secret = secret
+    self.ttl = ttl
+    self.issued = 0
+    self.verified = 0
+    self.rejected = 0
+
+  def _sign(self, payload: bytes) -> bytes:
+    return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+  def issue(self, claims: dict[str, Any]) -> str:
+    payload = codec.dumps({**claims, "exp": int(time.time()) + self.ttl})
+    self.issued += 1
+    return f"{_b64encode(payload)}.{_b64encode(self._sign(payload))}"
+
+  def verify(self, token: str) -> dict[str, Any]:
+    "Returns the claims of a valid token, raises ValueError otherwise."
+    try:
+      encoded_payload, encoded_signature = token.split(".")
+      payload = _b64decode(encoded_payload)
+      signature = _b64decode(encoded_signature)
+    except ValueError:
+      self.rejected += 1
+      raise ValueError("malformed token")
+
+    if not hmac.compare_digest(signature, self._sign(payload)):
+      self.rejected += 1
+      raise ValueError("bad token signature")
+
+    claims: dict = codec.loads(payload)
+    if claims.get("exp", 0) < time.time():
+      self.rejected += 1
+      raise ValueError("token expired")
+
+    self.verified += 1
+    return claims
+
+  def metrics(self) -> dict:
+    return {
+      "issued": self.issued,
+      "verified": self.verified,
+      "rejected": self.rejected,
+    }
@@ -1,11 +1,16 @@
 from __future__ import annotations
 
-import json
+import itertools
 import logging
 from typing import TYPE_CHECKING
 
 import yarl
 
+from utils import codec
+
+from .delta import DeltaState, copy_tree
+from .recent import RecentSamples
+
 if TYPE_CHECKING:
   from asyncio import Task
   from logging import Logger
@@ -17,8 +22,15 @@ if TYPE_CHECKING:
 
   from utils.extra_request import Application
 
+  from .machine_registry import MachineRecord
+  from .plugin_timing import PluginTimings
+  from .wire import WireFormat
+
 LOG = logging.getLogger(__name__)
 
+# Shared by every ConnectedMachine, so a reconnect never reuses a version.
+_config_versions = itertools.count(1)
+
 class Plugin:
   pool: asyncpg.Pool
   name: str  # Name used for referencing plugins
@@ -56,7 +68,10 @@ class Script:
   cs: aiohttp.ClientSession
   app: Application
   name: str  # Name used for referencing scripts
-  priority: int  # When to run the plugin.
+  # When to run the script. Scripts of equal priority run concurrently, after
+  # every script of a higher priority has finished.
+  priority: int
+  timeout: float | None  # Seconds per run, None for [srv.scripts] timeout.
   _ntfy_url: str
   _ntfy_token: str
   _ntfy_topic: str
@@ -66,11 +81,17 @@ class Script:
     self.cs = app.cs
     self.app = app
 
+  async def setup(self) -> None:
+    "Called once, after the script is created. Start background tasks here."
+
+  async def close(self) -> None:
+    "Called when the server shuts down."
+
   async def run(self, packet: MonitorPacket, machine: ConnectedMachine) -> None:
     pass
 
   def __init_subclass__(
-    cls, *, name: str = None, priority: int = 0, **kwargs
+    cls, *, name: str = None, priority: int = 0, timeout: float = None, **kwargs
   ) -> None:
     super().__init_subclass__(**kwargs)
     if name is None:
@@ -78,6 +99,7 @@ class Script:
 
     cls.name = name
     cls.priority = priority
+    cls.timeout = timeout
 
   async def send_ntfy_notification(
     self,
@@ -104,42 +126,34 @@ class Script:
     filename: str: Filename of attach URL.
     delay: str: How long to delay the notification for. formatted like "30min" or "9am"
     topic: str: Topic to send on. Defaults to config.toml topic.
+
+    Queued and sent in the background, see notifier.py. Returns False if the
+    queue was full and the notification was dropped.
     """
 
-    headers = {"Authorization": self.app.config.notify.token}
-
-    if topic is None:
-      topic = self.app.config.notify.topic
-
-    data = {
-      "topic": topic,
-      "message": body,
-      "priority": priority,
-      "title": title,
-      "tags": tags,
-      "click": click,
-      "markdown": markdown,
-      "attach": attach,
-      "filename": filename,
-      "delay": delay,
-    }
-
-    for key in list(data.keys()):
-      if data[key] is None:
-        data.pop(key)
-
-    async with self.app.cs.post(
-      self.app.config.notify.url, headers=headers, data=json.dumps(data)
-    ) as resp:
-      if resp.status != 200:
-        self.app.LOG.warning(f"{self.app.config.notify.topic} {headers} {data}")
-        self.app.LOG.warning(f"Failed to send ntfy! HTTP{resp.status}: {await resp.text()}")
-      return resp.status == 200
+    return self.app.notifier.submit(
+      {
+        "topic": topic,
+        "message": body,
+        "priority": priority,
+        "title": title,
+        "tags": tags,
+        "click": click,
+        "markdown": markdown,
+        "attach": attach,
+        "filename": filename,
+        "delay": delay,
+      }
+    )
 
 
 class ConnectedMachine:
   name: str
   ws: WebSocketResponse
+  wire: WireFormat
+  delta: DeltaState
+  # Last few samples of every numeric stat, for sparklines.
+  recent: RecentSamples
   plugins: list[Plugin]
   scripts: list[Script]
   reader_task: Task
@@ -148,6 +162,8 @@ class ConnectedMachine:
   last_communication: float
   category: str
   extra_config: dict
+  # Changes whenever extra_config is loaded or written, for caches built from it.
+  config_version: int
   online: bool
   app: Application
   _warnings: set
@@ -160,22 +176,30 @@ class ConnectedMachine:
     scripts: list[Script],
     name: str,
     app: Application,
+    wire: WireFormat,
   ) -> None:
     self.ws = ws
+    self.wire = wire
+    self.delta = DeltaState()
+    recent_config: dict = app.config.srv.recent or {}
+    self.recent = RecentSamples(
+      capacity=recent_config.get("capacity", 120),
+      max_series=recent_config.get("max_series", 32),
+    )
     self.plugins = plugins
     self.scripts = scripts
     self.name = name
     self.app = app
     self.running = True
+    self.online = False
     self._warnings = set()
 
-  def fill_data(self, record: asyncpg.Record) -> None:
-    self.category = record.get("category", None)
-    try:
-      extra_config = record.get("extraconfig", "{}")
-      self.extra_config = json.loads(extra_config)
-    except Exception:
-      self.extra_config = {}
+  def fill_data(self, record: MachineRecord) -> None:
+    self.category = record.category
+    # Scripts modify their own copy, the registry is only updated once the
+    # change has been written to the database.
+    self.extra_config = copy_tree(record.extra_config)
+    self.config_version = next(_config_versions)
 
   def url(self, open_tabs: list[str]) -> str:
     url = (
@@ -186,22 +210,46 @@ class ConnectedMachine:
     return str(url)
 
   async def write_extra_config(self, pool: asyncpg.Pool) -> bool:
-    data = json.dumps(self.extra_config)
+    # Scripts change extra_config in place and then write it.
+    self.config_version = next(_config_versions)
+    data = codec.dumps_str(self.extra_config)
     async with pool.acquire() as conn:
       conn: asyncpg.Connection
       result = await conn.execute(
         "UPDATE Machines SET ExtraConfig=$2 WHERE Name=$1;", self.name, data
       )
-      return result == "UPDATE 1"
+    if result != "UPDATE 1":
+      return False
+    record = self.app.machine_registry.get(self.name)
+    if record is not None:
+      record.extra_config = copy_tree(self.extra_config)
+      # Put it back so listeners, like the other workers, hear about it.
+      self.app.machine_registry.put(record)
+    return True
+
+  async def send(self, data: dict) -> None:
+    "Send a packet to the machine in its negotiated wire format."
+    await self.wire.send(self.ws, data)
 
   def add_warning(self, source: str) -> None:
-    self._warnings.add(source)
+    if not self._warnings:
+      self._warnings.add(source)
+      self.app.websocket_handler.warnings_changed(self)
+    else:
+      self._warnings.add(source)
 
   def remove_warning(self, source: str) -> None:
     try:
       self._warnings.remove(source)
     except KeyError:
-      pass
+      return
+    if not self._warnings:
+      self.app.websocket_handler.warnings_changed(self)
+
+  def clear_warnings(self) -> None:
+    if self._warnings:
+      self._warnings.clear()
+      self.app.websocket_handler.warnings_changed(self)
 
 class InternetStats:
   current: dict[str, float]
@@ -227,7 +275,9 @@ class MonitorPacket:
   internet: InternetStats
   extras: dict
   raw: dict
-  _cached_out: Any
+  # Stats and plugin output, built once by `process` on the ingest side.
+  # Online state isn't in here, it changes without a new packet.
+  _cached_out: dict
   _log: Logger
 
   def __init__(self, packet: dict, *, log: Logger = None) -> None:
@@ -250,35 +300,27 @@ class MonitorPacket:
 
     self._log = log
 
-  async def process_extras(
-    self, plugins: list[Plugin], connected_machine: ConnectedMachine
+  async def process(
+    self,
+    plugins: list[Plugin],
+    connected_machine: ConnectedMachine,
+    *,
+    timings: PluginTimings,
+    previous: MonitorPacket | None = None,
   ) -> None:
+    """Run every plugin and build the output readers get. A plugin that times
+    out or fails keeps its output from the previous packet."""
+    deadline = timings.deadline()
     for plugin in plugins:
       # This is expected to modify `extras` in place.
-      await plugin.run(self.extras, connected_machine)
-
-  async def run_scripts(
-    self, scripts: list[Script], connected_machine: ConnectedMachine
-  ) -> None:
-    for script in scripts:
-      try:
-        if hasattr(self,"_log"):
-          self._log.info(f"[SCRIPTS] Running {script.name} for {connected_machine.name}.")
-        await script.run(self, connected_machine)
-      except Exception:
-        if hasattr(self,"_log"):
-          self._log.exception(f"Failed running {script.name}!")
-
-  async def out(
-    self, plugins: list[Plugin], connected_machine: ConnectedMachine
-  ) -> dict:
-    if hasattr(self, "_cached_out"):
-      return self._cached_out
+      await timings.call(
+        plugin.name,
+        "run",
+        lambda plugin=plugin: plugin.run(self.extras, connected_machine),
+        deadline,
+      )
 
     out = {}
-
-    out["online"] = connected_machine.online
-
     if self.stats_valid:
       out["stats"] = {
         "cpu": self.cpu,
@@ -291,14 +333,31 @@ class MonitorPacket:
       out["stats"] = "invalid stats"
 
     out["extras"] = {}
-
+    previous_extras = {}
+    if previous is not None and hasattr(previous, "_cached_out"):
+      previous_extras = previous._cached_out["extras"]
     for plugin in plugins:
-      out["extras"][plugin.name] = await plugin.out(
-        self.extras, connected_machine
+      ok, value = await timings.call(
+        plugin.name,
+        "out",
+        lambda plugin=plugin: plugin.out(self.extras, connected_machine),
+        deadline,
       )
+      out["extras"][plugin.name] = value if ok else previous_extras.get(plugin.name)
 
     self._cached_out = out
-    return out
+
+  def current(self, connected_machine: ConnectedMachine) -> dict:
+    "What readers get. Never runs plugin code."
+    if not hasattr(self, "_cached_out"):
+      return {"online": connected_machine.online, "stats": "invalid stats", "extras": {}}
+    return {"online": connected_machine.online, **self._cached_out}
+
+  async def out(
+    self, plugins: list[Plugin], connected_machine: ConnectedMachine
+  ) -> dict:
+    "Kept for scripts written against the old lazy output, same as `current`."
+    return self.current(connected_machine)
 
 
 class Packet:
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from typing import Any
+
+# Delta protocol, see tools/client-daemon/statuscd.py for the sending side.
+#
+# Keyframe: {"type": "monitor", "seq": 0, "data": {...full packet...}}
+# Delta:    {"type": "monitor_delta", "seq": 1, "data": {
+#             "set": [[["stats", "ram", "used"], 123], ...],
+#             "unset": [["extras", "xmrig"], ...],
+#           }}
+#
+# Every leaf (anything that isn't a dict) is replaced as a whole. Sequence
+# numbers increase by one per packet; any gap means the server asks for a
+# fresh keyframe with {"type": "resync"}.
+
+
+def copy_tree(tree: Any) -> Any:
+  "Copy decoded JSON/msgpack data. Much cheaper than copy.deepcopy."
+  if isinstance(tree, dict):
+    return {key: copy_tree(value) for key, value in tree.items()}
+  if isinstance(tree, list):
+    return [copy_tree(value) for value in tree]
+  return tree
+
+
+def diff_tree(old: dict, new: dict, path: tuple = ()) -> dict:
+  "The delta that turns `old` into `new`, the same shape apply_delta takes."
+  changed = []
+  removed = []
+  for key, value in new.items():
+    key_path = (*path, key)
+    if key not in old:
+      changed.append([list(key_path), value])
+    elif isinstance(value, dict) and isinstance(old[key], dict):
+      sub = diff_tree(old[key], value, key_path)
+      changed.extend(sub["set"])
+      removed.extend(sub["unset"])
+    elif old[key] != value:
+      changed.append([list(key_path), value])
+  for key in old:
+    if key not in new:
+      removed.append(list((*path, key)))
+  return {"set": changed, "unset": removed}
+
+
+def apply_delta(base: dict, delta: dict) -> None:
+  "Apply a delta to `base` in place."
+  for path, value in delta.get("set", ()):
+    node = base
+    for key in path[:-1]:
+      child = node.get(key)
+      if not isinstance(child, dict):
+        child = {}
+        node[key] = child
+      node = child
+    node[path[-1]] = value
+
+  for path in delta.get("unset", ()):
+    node = base
+    for key in path[:-1]:
+      node = node.get(key)
+      if not isinstance(node, dict):
+        break
+    else:
+      node.pop(path[-1], None)
+
+
+class DeltaState:
+  # Last full packet rebuilt for this machine, None until a keyframe arrives.
+  base: dict | None
+  seq: int | None
+  # Set once a resync was requested, so we only ask once per gap.
+  awaiting_keyframe: bool
+
+  def __init__(self) -> None:
+    self.base = None
+    self.seq = None
+    self.awaiting_keyframe = False
+
+  def keyframe(self, seq: int, packet: dict) -> dict:
+    "Store a full packet, returns a copy that is safe for plugins to modify."
+    self.base = packet
+    self.seq = seq
+    self.awaiting_keyframe = False
+    return copy_tree(packet)
+
+  def apply(self, seq: int, delta: dict) -> dict | None:
+    "Rebuild the full packet, or return None if a resync is needed."
+    if self.base is None or self.seq is None or seq != self.seq + 1:
+      self.base = None
+      self.seq = None
+      return None
+    try:
+      apply_delta(self.base, delta)
+    except (TypeError, IndexError, AttributeError):
+      self.base = None
+      self.seq = None
+      return None
+    self.seq = seq
+    return copy_tree(self.base)
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+### Reduce a time series to a fixed number of points for charting. Both take
+# [(time, value), ...] sorted by time and return the same shape.
+
+METHODS = ("lttb", "minmax")
+
+
+def lttb(data: list[tuple[float, float]], threshold: int) -> list[tuple[float, float]]:
+  """Largest-Triangle-Three-Buckets. Keeps the first and last points, and from
+  every bucket in between the point forming the largest triangle with the
+  point kept before it and the average of the next bucket. Peaks survive,
+  flat stretches collapse."""
+  if threshold >= len(data) or threshold < 3:
+    return data
+
+  sampled = [data[0]]
+  # Buckets for everything but the first and last point.
+  every = (len(data) - 2) / (threshold - 2)
+  kept = 0
+  for i in range(threshold - 2):
+    start = int(i * every) + 1
+    end = int((i + 1) * every) + 1
+
+    following_start = end
+    following_end = min(int((i + 2) * every) + 1, len(data))
+    following = data[following_start:following_end] or data[-1:]
+    avg_x = sum(point[0] for point in following) / len(following)
+    avg_y = sum(point[1] for point in following) / len(following)
+
+    kept_x, kept_y = data[kept]
+    largest = -1.0
+    chosen = start
+    for j in range(start, end):
+      x, y = data[j]
+      area = abs((kept_x - avg_x) * (y - kept_y) - (kept_x - x) * (avg_y - kept_y))
+      if area > largest:
+        largest = area
+        chosen = j
+    sampled.append(data[chosen])
+    kept = chosen
+
+  sampled.append(data[-1])
+  return sampled
+
+
+def min_max(data: list[tuple[float, float]], threshold: int) -> list[tuple[float, float]]:
+  """Split into threshold/2 buckets and keep each bucket's lowest and highest
+  point, in time order. Cheaper than LTTB and never hides a spike."""
+  if threshold >= len(data) or threshold < 2:
+    return data
+
+  buckets = threshold // 2
+  every = len(data) / buckets
+  sampled = []
+  for i in range(buckets):
+    bucket = data[int(i * every) : int((i + 1) * every)]
+    if not bucket:
+      continue
+    low = min(range(len(bucket)), key=lambda j: bucket[j][1])
+    high = max(range(len(bucket)), key=lambda j: bucket[j][1])
+    for j in sorted({low, high}):
+      sampled.append(bucket[j])
+  return sampled
+
+
+def downsample(
+  data: list[tuple[float, float]], threshold: int, method: str = "lttb"
+) -> list[tuple[float, float]]:
+  if method == "minmax":
+    return min_max(data, threshold)
+  return lttb(data, threshold)
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import secrets
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
+  from typing import Any
+
+LOG = logging.getLogger(__name__)
+
+
+class FanOutJob:
+  id: str
+  action: str
+  names: list[str]
+  # Machine name -> "ok", "timeout", "not connected" or "error: ..."
+  results: dict[str, str]
+  # Anything extra the caller wants reported, like reconnect delays.
+  details: dict[str, Any]
+  started: float
+  finished: float | None
+  task: asyncio.Task | None
+
+  def __init__(
+    self, action: str, names: list[str], details: dict[str, Any] = None
+  ) -> None:
+    self.id = secrets.token_urlsafe(8)
+    self.action = action
+    self.names = names
+    self.results = {}
+    self.details = details or {}
+    self.started = time.time()
+    self.finished = None
+    self.task = None
+
+  def report(self) -> dict:
+    packet = {
+      "id": self.id,
+      "action": self.action,
+      "total": len(self.names),
+      "done": len(self.results),
+      "finished": self.finished is not None,
+      "elapsed": round((self.finished or time.time()) - self.started, 3),
+      "results": self.results,
+    }
+    if self.details:
+      packet["details"] = self.details
+    return packet
+
+
+class FanOut:
+  "Runs one action against many machines with bounded concurrency."
+
+  concurrency: int
+  timeout: float  # Seconds each machine gets before it is reported as a timeout.
+  jobs: collections.OrderedDict[str, FanOutJob]
+  keep_jobs: int
+  counters: dict[str, int]
+
+  def __init__(
+    self, *, concurrency: int = 64, timeout: float = 5, keep_jobs: int = 50
+  ) -> None:
+    self.concurrency = max(1, concurrency)
+    self.timeout = timeout
+    self.keep_jobs = keep_jobs
+    self.jobs = collections.OrderedDict()
+    self.counters = {"ok": 0, "timeout": 0, "error": 0, "not connected": 0}
+
+  async def _run(
+    self, job: FanOutJob, func: Callable[[str], Awaitable[bool | None]]
+  ) -> FanOutJob:
+    semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def one(name: str) -> None:
+      async with semaphore:
+        try:
+          async with asyncio.timeout(self.timeout):
+            result = await func(name)
+          status = "not connected" if result is False else "ok"
+        except TimeoutError:
+          status = "timeout"
+        except Exception as e:
+          LOG.exception(f"[FANOUT] {job.action} failed for {name}")
+          status = f"error: {e}"
+      job.results[name] = status
+      self.counters[status if not status.startswith("error") else "error"] += 1
+
+    await asyncio.gather(*(one(name) for name in job.names))
+    job.finished = time.time()
+    self._trim()
+    return job
+
+  def _remember(self, job: FanOutJob) -> None:
+    self.jobs[job.id] = job
+    self._trim()
+
+  def _trim(self) -> None:
+    """Forget the oldest finished jobs past `keep_jobs`. Running jobs are
+    kept however many there are, they hold the only reference to their task
+    and someone may still be polling them. They go once they're done."""
+    excess = len(self.jobs) - self.keep_jobs
+    if excess <= 0:
+      return
+    finished = [job_id for job_id, job in self.jobs.items() if job.finished is not None]
+    for job_id in finished[:excess]:
+      del self.jobs[job_id]
+
+  async def run(
+    self,
+    action: str,
+    names: list[str],
+    func: Callable[[str], Awaitable[bool | None]],
+    *,
+    details: dict[str, Any] = None,
+  ) -> FanOutJob:
+    "Run to completion. `func` returning False means the machine wasn't there."
+    job = FanOutJob(action, names, details)
+    self._remember(job)
+    return await self._run(job, func)
+
+  def start(
+    self,
+    action: str,
+    names: list[str],
+    func: Callable[[str], Awaitable[bool | None]],
+    *,
+    details: dict[str, Any] = None,
+  ) -> FanOutJob:
+    "Run in the background, poll the returned job for progress."
+    job = FanOutJob(action, names, details)
+    self._remember(job)
+    job.task = asyncio.create_task(self._run(job, func))
+    return job
+
+  def get(self, job_id: str) -> FanOutJob | None:
+    return self.jobs.get(job_id)
+
+  def metrics(self) -> dict:
+    return {
+      "concurrency": self.concurrency,
+      "timeout": self.timeout,
+      "running_jobs": sum(1 for job in self.jobs.values() if job.finished is None),
+      "results": dict(self.counters),
+    }
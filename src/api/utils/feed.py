@@ -0,0 +1,365 @@
+from __future__ import annotations
+
+import asyncio
+from typing import TYPE_CHECKING
+
+from utils import codec
+
+from .cluster import ClusterError
+from .delta import apply_delta, copy_tree, diff_tree
+
+if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
+  from typing import Any
+
+  from .cluster import Cluster
+  from .data_classes import ConnectedMachine
+  from .machine_registry import MachineRecord, MachineRegistry
+
+# Dashboard feed, sent as server-sent events. Every event is one JSON object:
+#
+# {"type": "snapshot", "machines": {name: card, ...}, "categories": [...]}
+# {"type": "machine", "name": ..., "data": card}   (new to this subscriber)
+# {"type": "delta", "name": ..., "data": {"set": [...], "unset": [...]}}
+# {"type": "remove", "name": ...}
+# {"type": "categories", "data": [...]}
+#
+# A card is what /machines/get/all/ returns per machine. Deltas are in the
+# same format as the client delta protocol, see delta.py.
+
+
+def offline_card(record: MachineRecord) -> dict:
+  "Card for a machine no worker is holding."
+  return {
+    "name": record.name,
+    "category": record.category,
+    "warning": [],
+    "data": {"online": False, "stats": "invalid stats"},
+  }
+
+
+def machine_card(cm: ConnectedMachine) -> dict:
+  "Card for a machine connected to this worker."
+  card = {
+    "name": cm.name,
+    "category": cm.category,
+    "warning": sorted(cm._warnings),
+  }
+  if not hasattr(cm, "stats"):
+    card["data"] = {"online": cm.online, "stats": "invalid stats"}
+  else:
+    card["data"] = cm.stats.latest_packet.current(cm)
+  return card
+
+
+def _event(body: dict) -> bytes:
+  return b"data: " + codec.dumps(body) + b"\n\n"
+
+
+def _online(card: dict | None) -> bool:
+  return card is not None and bool(card["data"].get("online"))
+
+
+class FeedSubscriber:
+  # None means every category.
+  categories: set[str] | None
+  # Encoded events. None asks the sender for a fresh snapshot.
+  queue: asyncio.Queue[bytes | None]
+  # Fell behind and was dropped to a snapshot, nothing is queued until it's sent.
+  stale: bool
+
+  def __init__(self, categories: set[str] | None, queue_size: int) -> None:
+    self.categories = categories
+    self.queue = asyncio.Queue(queue_size)
+    self.stale = False
+
+  def wants(self, card: dict | None) -> bool:
+    return card is not None and (
+      self.categories is None or card["category"] in self.categories
+    )
+
+  def offer(self, event: bytes) -> bool:
+    "Queue an event. Returns False if the subscriber had to be resynced."
+    if self.stale:
+      return True
+    try:
+      self.queue.put_nowait(event)
+      return True
+    except asyncio.QueueFull:
+      pass
+    # A slow browser. Rather than buffer without limit, throw its backlog away
+    # and send it the current state once it catches up.
+    while not self.queue.empty():
+      self.queue.get_nowait()
+    self.queue.put_nowait(None)
+    self.stale = True
+    return False
+
+
+class DashboardFeed:
+  """Keeps the latest card of every machine in the fleet and pushes changes
+  to dashboards, so an open tab costs one event per change instead of a
+  full poll of the fleet.
+
+  Machines held by this worker are pushed by the websocket handler. Cards
+  for machines held by other workers arrive through the cluster, and
+  machines nobody holds get an offline card from the registry."""
+
+  worker_id: int
+  cluster: Cluster
+  cards: dict[str, dict]
+  # Machine name -> worker that last sent its card
+  owners: dict[str, int]
+  # Peers are sent deltas against the last card relayed, numbered per machine
+  # so a gap is noticed. Machine name -> (seq, card) of machines on this
+  # worker, and -> (worker, seq, card) as last heard from other workers.
+  relayed: dict[str, tuple[int, dict]]
+  remote: dict[str, tuple[int, int, dict]]
+  categories: list[str]
+  subscribers: set[FeedSubscriber]
+  # Called with (name, card) whenever a card changes, card is None once removed.
+  listeners: list[Callable[[str, dict | None], None]]
+  queue_size: int
+  counters: dict[str, int]
+  _primed: bool
+  # Machines whose full card is being fetched from their worker
+  _fetching: set[str]
+  _tasks: set[asyncio.Task]
+
+  def __init__(
+    self, registry: MachineRegistry, cluster: Cluster, *, queue_size: int = 64
+  ) -> None:
+    self.worker_id = cluster.worker_id
+    self.cluster = cluster
+    self.cards = {record.name: offline_card(record) for record in registry.all()}
+    self.owners = {}
+    self.relayed = {}
+    self.remote = {}
+    self.categories = self._categories()
+    self.subscribers = set()
+    self.listeners = []
+    self.queue_size = queue_size
+    self.counters = {
+      "events": 0,
+      "snapshots": 0,
+      "resyncs": 0,
+      "bytes": 0,
+      "relayed": 0,
+      "refetched": 0,
+    }
+    self._primed = not cluster.enabled
+    self._fetching = set()
+    self._tasks = set()
+
+    registry.listeners.append(self.registry_changed)
+    cluster.register("feed", self._remote_update)
+    cluster.register("feed_card", self._local_card)
+    cluster.register("feed_cards", self._local_cards)
+
+  def _categories(self) -> list[str]:
+    return sorted({card["category"] for card in self.cards.values()})
+
+  def _update(self, card: dict, worker_id: int | None) -> None:
+    name = card["name"]
+    old = self.cards.get(name)
+    owner = self.owners.get(name)
+    if (
+      worker_id is not None
+      and owner is not None
+      and owner != worker_id
+      and _online(old)
+      and not _online(card)
+    ):
+      # The copy left behind on the worker the machine moved away from.
+      return
+    if worker_id is not None:
+      self.owners[name] = worker_id
+    if old is not None and old == card:
+      return
+    self.cards[name] = card
+    self._deliver(name, old, card)
+
+  def _remove(self, name: str) -> None:
+    old = self.cards.pop(name, None)
+    self.owners.pop(name, None)
+    self.relayed.pop(name, None)
+    self.remote.pop(name, None)
+    if old is not None:
+      self._deliver(name, old, None)
+
+  def _deliver(self, name: str, old: dict | None, new: dict | None) -> None:
+    for listener in self.listeners:
+      listener(name, new)
+
+    encoded: dict[str, bytes] = {}
+
+    def event(kind: str) -> bytes:
+      # Encoded once, however many subscribers get it.
+      if kind not in encoded:
+        if kind == "delta":
+          body = {"type": "delta", "name": name, "data": diff_tree(old, new)}
+        elif kind == "machine":
+          body = {"type": "machine", "name": name, "data": new}
+        else:
+          body = {"type": "remove", "name": name}
+        encoded[kind] = _event(body)
+      return encoded[kind]
+
+    for subscriber in self.subscribers:
+      was, now = subscriber.wants(old), subscriber.wants(new)
+      if was and now:
+        self._offer(subscriber, event("delta"))
+      elif now:
+        self._offer(subscriber, event("machine"))
+      elif was:
+        self._offer(subscriber, event("remove"))
+
+    categories = self._categories()
+    if categories != self.categories:
+      self.categories = categories
+      categories_event = _event({"type": "categories", "data": categories})
+      for subscriber in self.subscribers:
+        self._offer(subscriber, categories_event)
+
+  def _offer(self, subscriber: FeedSubscriber, event: bytes) -> None:
+    self.counters["events"] += 1
+    self.counters["bytes"] += len(event)
+    if not subscriber.offer(event):
+      self.counters["resyncs"] += 1
+
+  def _spawn(self, coro: Awaitable[Any]) -> None:
+    task = asyncio.create_task(coro)
+    self._tasks.add(task)
+    task.add_done_callback(self._tasks.discard)
+
+  def local_update(self, card: dict) -> None:
+    """A card for a machine on this worker, passed on to the other workers
+    too. They get only what changed since the last card relayed, a packet
+    usually touches a handful of stats, not the whole card."""
+    self._update(card, self.worker_id)
+    if not self.cluster.peers:
+      return
+    name = card["name"]
+    seq, base = self.relayed.get(name, (-1, None))
+    if base is not None and base == card:
+      return
+    seq += 1
+    self.relayed[name] = (seq, card)
+    self.counters["relayed"] += 1
+    if base is None:
+      update = {"card": card}
+    else:
+      update = {"delta": diff_tree(base, card)}
+    self._spawn(
+      self.cluster.broadcast("feed", name=name, seq=seq, worker_id=self.worker_id, **update)
+    )
+
+  def machine_changed(self, cm: ConnectedMachine) -> None:
+    """Online state or warnings changed. Patches the last card instead of
+    rebuilding it, the stats haven't changed."""
+    card = copy_tree(self.cards.get(cm.name)) or {"name": cm.name, "data": {}}
+    if not isinstance(card.get("data"), dict):
+      card["data"] = {"stats": "invalid stats"}
+    card["category"] = cm.category
+    card["warning"] = sorted(cm._warnings)
+    card["data"]["online"] = cm.online
+    self.local_update(card)
+
+  def _remote_update(
+    self,
+    name: str,
+    seq: int,
+    worker_id: int,
+    card: dict | None = None,
+    delta: dict | None = None,
+  ) -> None:
+    known = self.remote.get(name)
+    if known is not None and known[0] == worker_id and seq <= known[1]:
+      # Older than what we have, the full card was fetched in the meantime.
+      return
+    if card is None:
+      if known is None or known[:2] != (worker_id, seq - 1):
+        # Missed an update, or never had this worker's card to patch.
+        if name not in self._fetching:
+          self._fetching.add(name)
+          self._spawn(self._fetch(name, worker_id))
+        return
+      card = copy_tree(known[2])
+      apply_delta(card, delta)
+    self.remote[name] = (worker_id, seq, card)
+    self._update(card, worker_id)
+
+  async def _fetch(self, name: str, worker_id: int) -> None:
+    self.counters["refetched"] += 1
+    try:
+      reply = await self.cluster.call(worker_id, "feed_card", name=name)
+    except ClusterError:
+      # The next update tries again.
+      return
+    finally:
+      self._fetching.discard(name)
+    if reply is not None:
+      seq, card = reply
+      self._remote_update(name, seq, worker_id, card=card)
+
+  def _local_card(self, name: str) -> tuple[int, dict] | None:
+    return self.relayed.get(name)
+
+  def _local_cards(self) -> dict[str, tuple[int, dict]]:
+    return {
+      name: relayed
+      for name, relayed in self.relayed.items()
+      if self.owners.get(name) == self.worker_id
+    }
+
+  def registry_changed(self, old: MachineRecord | None, new: MachineRecord | None) -> None:
+    if new is None:
+      self._remove(old.name)
+      return
+    card = self.cards.get(new.name)
+    if card is None:
+      self._update(offline_card(new), None)
+    elif card["category"] != new.category:
+      card = copy_tree(card)
+      card["category"] = new.category
+      self._update(card, None)
+
+  async def prime(self) -> None:
+    "Pick up the cards held by the other workers, once, before the first snapshot."
+    if self._primed:
+      return
+    self._primed = True
+    for worker_id, cards in (await self.cluster.broadcast("feed_cards")).items():
+      for name, (seq, card) in cards.items():
+        if name in self.cards:
+          self._remote_update(name, seq, worker_id, card=card)
+
+  def subscribe(self, categories: set[str] | None = None) -> FeedSubscriber:
+    subscriber = FeedSubscriber(categories, self.queue_size)
+    self.subscribers.add(subscriber)
+    return subscriber
+
+  def unsubscribe(self, subscriber: FeedSubscriber) -> None:
+    self.subscribers.discard(subscriber)
+
+  def snapshot(self, subscriber: FeedSubscriber) -> bytes:
+    subscriber.stale = False
+    event = _event(
+      {
+        "type": "snapshot",
+        "machines": {
+          name: card for name, card in self.cards.items() if subscriber.wants(card)
+        },
+        "categories": self.categories,
+      }
+    )
+    self.counters["snapshots"] += 1
+    self.counters["bytes"] += len(event)
+    return event
+
+  def metrics(self) -> dict:
+    return {
+      "subscribers": len(self.subscribers),
+      "machines": len(self.cards),
+      **self.counters,
+    }
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  import asyncpg
+
+  from .data_classes import ConnectedMachine
+  from .machine_registry import MachineRecord
+
+LOG = logging.getLogger(__name__)
+
+
+class FleetCounters:
+  """Fleet totals kept up to date on every change, so reading them is O(1).
+
+  Online and warning machines remember the category they were counted under,
+  so a machine moving category while connected can't skew the numbers.
+  """
+
+  total_by_category: collections.Counter[str]
+  # Machine name -> category it was counted under
+  online: dict[str, str]
+  online_by_category: collections.Counter[str]
+  warning: dict[str, str]
+  warning_by_category: collections.Counter[str]
+  db_size: str | None
+  _db_size_task: asyncio.Task | None
+
+  def __init__(self) -> None:
+    self.total_by_category = collections.Counter()
+    self.online = {}
+    self.online_by_category = collections.Counter()
+    self.warning = {}
+    self.warning_by_category = collections.Counter()
+    self.db_size = None
+    self._db_size_task = None
+
+  @property
+  def total(self) -> int:
+    return sum(self.total_by_category.values())
+
+  def registry_changed(
+    self, old: MachineRecord | None, new: MachineRecord | None
+  ) -> None:
+    if old is not None:
+      self.total_by_category[old.category] -= 1
+      if not self.total_by_category[old.category]:
+        del self.total_by_category[old.category]
+    if new is not None:
+      self.total_by_category[new.category] += 1
+
+  @staticmethod
+  def _toggle(
+    members: dict[str, str],
+    by_category: collections.Counter[str],
+    cm: ConnectedMachine,
+    present: bool,
+  ) -> None:
+    if present and cm.name not in members:
+      members[cm.name] = cm.category
+      by_category[cm.category] += 1
+    elif not present and cm.name in members:
+      category = members.pop(cm.name)
+      by_category[category] -= 1
+      if not by_category[category]:
+        del by_category[category]
+
+  def online_changed(self, cm: ConnectedMachine, online: bool) -> None:
+    self._toggle(self.online, self.online_by_category, cm, online)
+
+  def warning_changed(self, cm: ConnectedMachine, has_warnings: bool) -> None:
+    self._toggle(self.warning, self.warning_by_category, cm, has_warnings)
+
+  def start_sampling_db_size(self, pool: asyncpg.Pool, interval: float) -> None:
+    self._db_size_task = asyncio.create_task(self._sample_db_size(pool, interval))
+
+  def stop(self) -> None:
+    if self._db_size_task is not None:
+      self._db_size_task.cancel()
+
+  async def _sample_db_size(self, pool: asyncpg.Pool, interval: float) -> None:
+    while True:
+      try:
+        async with pool.acquire() as conn:
+          conn: asyncpg.Connection
+          record = await conn.fetchrow(
+            "SELECT pg_size_pretty ( pg_database_size ( current_database() ) );"
+          )
+          self.db_size = record.get("pg_size_pretty", "-1 kB")
+      except Exception:
+        LOG.exception("[COUNTERS] Failed to sample database size")
+      await asyncio.sleep(interval)
+
+  def out(self) -> dict:
+    total = self.total
+    online = len(self.online)
+    categories = (
+      self.total_by_category.keys()
+      | self.online_by_category.keys()
+      | self.warning_by_category.keys()
+    )
+    return {
+      "total_machines": total,
+      "online_machines": online,
+      "offline_machines": max(0, total - online),
+      "warning_machines": len(self.warning),
+      "categories": {
+        category: {
+          "total": self.total_by_category[category],
+          "online": self.online_by_category[category],
+          "warning": self.warning_by_category[category],
+        }
+        for category in categories
+      },
+    }
+
+
+def merge_counters(out: dict, other: dict) -> dict:
+  """Add another worker's online and warning counts to `out`.
+
+  Every worker has the whole registry, so totals are taken from `out` alone."""
+  out["online_machines"] += other["online_machines"]
+  out["warning_machines"] += other["warning_machines"]
+  out["offline_machines"] = max(0, out["total_machines"] - out["online_machines"])
+  for category, counts in other["categories"].items():
+    merged = out["categories"].setdefault(
+      category, {"total": counts["total"], "online": 0, "warning": 0}
+    )
+    merged["online"] += counts["online"]
+    merged["warning"] += counts["warning"]
+  return out
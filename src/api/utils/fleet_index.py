@@ -0,0 +1,128 @@
+from __future__ import annotations
+
+import bisect
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from .feed import DashboardFeed
+
+# Projections for /machines/list/ and /machines/get/?names=
+VIEWS = ("full", "noextras", "stats", "names")
+
+# Index keys: every machine is in ("all",), and in one list per filter.
+ALL = ("all",)
+
+
+def _keys(card: dict) -> set[tuple]:
+  data = card["data"]
+  return {
+    ALL,
+    ("category", card["category"]),
+    ("online", bool(data.get("online"))),
+    ("warning", bool(card["warning"])),
+  }
+
+
+def project(card: dict, view: str) -> dict:
+  if view == "names":
+    return {"name": card["name"], "category": card["category"]}
+  data = card["data"]
+  if view == "stats":
+    return {
+      "name": card["name"],
+      "category": card["category"],
+      "online": data.get("online"),
+      "stats": data.get("stats"),
+    }
+  if view == "noextras":
+    return {**card, "data": {k: v for k, v in data.items() if k != "extras"}}
+  return card
+
+
+class FleetIndex:
+  """Sorted name lists per category, online state and warning state, kept in
+  step with the dashboard feed. A query walks the shortest list that applies
+  and checks the rest by lookup, so it never touches machines that can't
+  match. Names are sorted case-insensitively, which is also the cursor."""
+
+  feed: DashboardFeed
+  # Index key -> sorted lowercased names
+  lists: dict[tuple, list[str]]
+  # Lowercased name -> the keys it is listed under
+  keys: dict[str, set[tuple]]
+  # Lowercased name -> name as the feed has it
+  names: dict[str, str]
+
+  def __init__(self, feed: DashboardFeed) -> None:
+    self.feed = feed
+    self.lists = {ALL: []}
+    self.keys = {}
+    self.names = {}
+    for name, card in feed.cards.items():
+      self.changed(name, card)
+    feed.listeners.append(self.changed)
+
+  def changed(self, name: str, card: dict | None) -> None:
+    key = name.lower()
+    old = self.keys.pop(key, set())
+    new = set() if card is None else _keys(card)
+    for index_key in old - new:
+      names = self.lists[index_key]
+      del names[bisect.bisect_left(names, key)]
+      if not names and index_key != ALL:
+        del self.lists[index_key]
+    for index_key in new - old:
+      bisect.insort(self.lists.setdefault(index_key, []), key)
+    if new:
+      self.keys[key] = new
+      self.names[key] = name
+    else:
+      self.names.pop(key, None)
+
+  def query(
+    self,
+    *,
+    category: str | None = None,
+    online: bool | None = None,
+    warning: bool | None = None,
+    prefix: str | None = None,
+    after: str | None = None,
+    limit: int = 100,
+  ) -> tuple[list[dict], str | None]:
+    "Matching cards in name order, and the cursor for the next page or None."
+    wanted = []
+    if category is not None:
+      wanted.append(("category", category))
+    if online is not None:
+      wanted.append(("online", online))
+    if warning is not None:
+      wanted.append(("warning", warning))
+    base = min(
+      (self.lists.get(index_key, []) for index_key in wanted),
+      key=len,
+      default=self.lists[ALL],
+    )
+
+    start = 0
+    end = len(base)
+    if prefix:
+      prefix = prefix.lower()
+      start = bisect.bisect_left(base, prefix)
+      end = bisect.bisect_left(base, prefix + "\uffff")
+    if after is not None:
+      start = max(start, bisect.bisect_right(base, after.lower()))
+
+    cards = []
+    last = None
+    for i in range(start, end):
+      key = base[i]
+      if all(index_key in self.keys[key] for index_key in wanted):
+        if len(cards) == limit:
+          return cards, last
+        cards.append(self.feed.cards[self.names[key]])
+        last = key
+    return cards, None
+
+  def get(self, name: str) -> dict | None:
+    name = self.names.get(name.lower())
+    return None if name is None else self.feed.cards.get(name)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import bisect
+import math
+
+# Upper bounds in milliseconds, the last bucket catches everything slower.
+DEFAULT_BOUNDS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+  "Fixed-bucket latency histogram. Recording is a bisect and an increment."
+
+  bounds: tuple[float, ...]
+  counts: list[int]
+  count: int
+  total: float  # milliseconds
+  max: float
+
+  def __init__(self, bounds: tuple[float, ...] = DEFAULT_BOUNDS) -> None:
+    self.bounds = bounds
+    self.counts = [0] * (len(bounds) + 1)
+    self.count = 0
+    self.total = 0.0
+    self.max = 0.0
+
+  def record(self, seconds: float) -> None:
+    ms = seconds * 1000
+    self.counts[bisect.bisect_left(self.bounds, ms)] += 1
+    self.count += 1
+    self.total += ms
+    self.max = max(self.max, ms)
+
+  def quantile(self, q: float) -> float | None:
+    "Upper bound of the bucket holding the q-th quantile, in milliseconds."
+    if not self.count:
+      return None
+    rank = math.ceil(q * self.count)
+    seen = 0
+    for bound, count in zip(self.bounds, self.counts, strict=False):
+      seen += count
+      if seen >= rank:
+        return bound
+    return self.max
+
+  def metrics(self) -> dict:
+    return {
+      "count": self.count,
+      "avg_ms": round(self.total / self.count, 3) if self.count else None,
+      "p50_ms": self.quantile(0.5),
+      "p99_ms": self.quantile(0.99),
+      "max_ms": round(self.max, 3),
+      "buckets": {
+        **{f"le_{bound}": count for bound, count in zip(self.bounds, self.counts, strict=False)},
+        "inf": self.counts[-1],
+      },
+    }
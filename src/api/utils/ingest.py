@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
+
+  from aiohttp import WSMessage
+
+LOG = logging.getLogger(__name__)
+
+# When a machine's queue is full:
+# "coalesce" throws away everything still queued and keeps only the newest
+# frame, since a monitor packet supersedes all older ones.
+# "drop" throws away the incoming frame and keeps the queue as it is.
+POLICIES = ("coalesce", "drop")
+
+
+class MachineQueue:
+  name: str
+  frames: collections.deque[WSMessage]
+  # Whether the machine is waiting in the ready queue or being processed.
+  scheduled: bool
+  # The machine went away. The queue is dropped once no worker holds it.
+  forgotten: bool
+  received: int
+  processed: int
+  dropped: int
+
+  def __init__(self, name: str) -> None:
+    self.name = name
+    self.frames = collections.deque()
+    self.scheduled = False
+    self.forgotten = False
+    self.received = 0
+    self.processed = 0
+    self.dropped = 0
+
+
+class IngestPipeline:
+  # A dictionary of machine name -> pending frames
+  queues: dict[str, MachineQueue]
+  # Machines that have frames waiting, in arrival order.
+  ready: asyncio.Queue[MachineQueue]
+  workers: list[asyncio.Task]
+  worker_count: int
+  queue_size: int
+  policy: str
+  handler: Callable[[str, WSMessage], Awaitable[None]]
+  received: int
+  processed: int
+  dropped: int
+  failed: int
+  busy: int
+
+  def __init__(
+    self,
+    handler: Callable[[str, WSMessage], Awaitable[None]],
+    *,
+    workers: int = 8,
+    queue_size: int = 4,
+    policy: str = "coalesce",
+  ) -> None:
+    if policy not in POLICIES:
+      raise ValueError(f"unknown ingest policy {policy!r}")
+    self.handler = handler
+    self.worker_count = max(1, workers)
+    self.queue_size = max(1, queue_size)
+    self.policy = policy
+    self.queues = {}
+    self.ready = asyncio.Queue()
+    self.workers = []
+    self.received = 0
+    self.processed = 0
+    self.dropped = 0
+    self.failed = 0
+    self.busy = 0
+
+  def start(self) -> None:
+    for i in range(self.worker_count):
+      self.workers.append(asyncio.create_task(self._worker(i)))
+
+  async def close(self) -> None:
+    for task in self.workers:
+      task.cancel()
+    await asyncio.gather(*self.workers, return_exceptions=True)
+    self.workers.clear()
+
+  def submit(self, machine_name: str, message: WSMessage) -> None:
+    "Queue a frame for a machine. Never blocks the websocket reader."
+    mq = self.queues.get(machine_name)
+    if mq is None:
+      mq = MachineQueue(machine_name)
+      self.queues[machine_name] = mq
+    mq.forgotten = False
+
+    self.received += 1
+    mq.received += 1
+
+    if len(mq.frames) >= self.queue_size:
+      if self.policy == "coalesce":
+        dropped = len(mq.frames)
+        mq.frames.clear()
+        mq.frames.append(message)
+      else:
+        dropped = 1
+      mq.dropped += dropped
+      self.dropped += dropped
+      LOG.warning(
+        f"[INGEST][{machine_name}] falling behind, dropped {dropped} frame(s)"
+      )
+    else:
+      mq.frames.append(message)
+
+    if not mq.scheduled:
+      mq.scheduled = True
+      self.ready.put_nowait(mq)
+
+  def forget(self, machine_name: str) -> None:
+    """Discard anything still queued for a machine that went away. If a worker
+    is still on its last frame the queue stays until it's done, so a quick
+    reconnect queues behind that frame instead of racing it."""
+    mq = self.queues.get(machine_name)
+    if mq is None:
+      return
+    mq.frames.clear()
+    if mq.scheduled:
+      mq.forgotten = True
+    else:
+      del self.queues[machine_name]
+
+  def _release(self, mq: MachineQueue) -> None:
+    "No worker holds the queue any more."
+    mq.scheduled = False
+    if mq.forgotten and self.queues.get(mq.name) is mq:
+      del self.queues[mq.name]
+
+  async def _worker(self, worker_id: int) -> None:
+    while True:
+      mq = await self.ready.get()
+      machine_name = mq.name
+      if not mq.frames:
+        self._release(mq)
+        continue
+
+      message = mq.frames.popleft()
+      self.busy += 1
+      start = time.perf_counter()
+      try:
+        await self.handler(machine_name, message)
+        mq.processed += 1
+        self.processed += 1
+      except asyncio.CancelledError:
+        raise
+      except Exception:
+        self.failed += 1
+        LOG.exception(f"Failed handling packet for {machine_name}")
+      finally:
+        self.busy -= 1
+      LOG.debug(
+        f"[INGEST][{worker_id}] handling packet for {machine_name} took "
+        f"{time.perf_counter() - start}s."
+      )
+
+      # Only one worker handles a machine at a time, so packets from the same
+      # machine are always processed in order.
+      if mq.frames:
+        self.ready.put_nowait(mq)
+      else:
+        self._release(mq)
+
+  def depth(self, machine_name: str) -> int:
+    mq = self.queues.get(machine_name)
+    return 0 if mq is None else len(mq.frames)
+
+  def metrics(self) -> dict:
+    depths = [len(mq.frames) for mq in self.queues.values()]
+    return {
+      "workers": self.worker_count,
+      "busy_workers": self.busy,
+      "policy": self.policy,
+      "queue_size": self.queue_size,
+      "machines_waiting": self.ready.qsize(),
+      "queued_frames": sum(depths),
+      "max_queue_depth": max(depths, default=0),
+      "received": self.received,
+      "processed": self.processed,
+      "dropped": self.dropped,
+      "failed": self.failed,
+      "dropped_by_machine": {
+        mq.name: mq.dropped for mq in self.queues.values() if mq.dropped
+      },
+    }
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import asyncio
+import heapq
+import logging
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from collections.abc import Callable
+
+LOG = logging.getLogger(__name__)
+
+
+class LivenessTracker:
+  """Calls `on_expire(name)` once a machine's deadline passes without a touch.
+
+  Touching a machine only moves its deadline in a dict. The heap holds at most
+  one entry per machine, and an entry that turns out to have been extended is
+  pushed back when it comes up, so the task sleeps until the next deadline
+  that can actually expire instead of scanning every machine.
+  """
+
+  # Machine name -> monotonic deadline
+  deadlines: dict[str, float]
+  heap: list[tuple[float, str]]
+  # Names that currently have an entry in the heap.
+  scheduled: set[str]
+  on_expire: Callable[[str], None]
+  expirations: int
+  wakeups: int
+  _changed: asyncio.Event
+
+  def __init__(self, on_expire: Callable[[str], None]) -> None:
+    self.deadlines = {}
+    self.heap = []
+    self.scheduled = set()
+    self.on_expire = on_expire
+    self.expirations = 0
+    self.wakeups = 0
+    self._changed = asyncio.Event()
+
+  def touch(self, name: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    self.deadlines[name] = deadline
+    if name not in self.scheduled:
+      self.scheduled.add(name)
+      heapq.heappush(self.heap, (deadline, name))
+      if self.heap[0][1] == name:
+        # New earliest deadline, the sleeping task has to wake up sooner.
+        self._changed.set()
+
+  def forget(self, name: str) -> None:
+    # The heap entry is dropped lazily when it comes up.
+    self.deadlines.pop(name, None)
+
+  async def run(self) -> None:
+    while True:
+      if not self.heap:
+        await self._changed.wait()
+        self._changed.clear()
+        continue
+
+      delay = self.heap[0][0] - time.monotonic()
+      if delay > 0:
+        try:
+          async with asyncio.timeout(delay):
+            await self._changed.wait()
+        except TimeoutError:
+          pass
+        self._changed.clear()
+        continue
+
+      self.wakeups += 1
+      _, name = heapq.heappop(self.heap)
+      deadline = self.deadlines.get(name)
+      if deadline is None:
+        self.scheduled.discard(name)
+      elif deadline > time.monotonic():
+        heapq.heappush(self.heap, (deadline, name))
+      else:
+        self.scheduled.discard(name)
+        del self.deadlines[name]
+        self.expirations += 1
+        try:
+          self.on_expire(name)
+        except Exception:
+          LOG.exception(f"[LIVENESS] expiry handler failed for {name}")
+
+  def metrics(self) -> dict:
+    return {
+      "tracked": len(self.deadlines),
+      "scheduled": len(self.heap),
+      "expirations": self.expirations,
+      "wakeups": self.wakeups,
+    }
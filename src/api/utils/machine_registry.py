@@ -0,0 +1,185 @@
+from __future__ import annotations
+
+import hashlib
+import logging
+from typing import TYPE_CHECKING
+
+from utils import codec
+
+if TYPE_CHECKING:
+  from collections.abc import Callable
+
+  import asyncpg
+
+LOG = logging.getLogger(__name__)
+
+
+class MachineRecord:
+  "In-memory copy of one row of the Machines table."
+  id: int
+  name: str
+  category: str
+  addons: list[str]
+  scripts: list[str]
+  extra_config: dict
+  collect_stats: bool
+
+  def __init__(
+    self,
+    *,
+    id: int,
+    name: str,
+    category: str,
+    addons: list[str],
+    scripts: list[str],
+    extra_config: dict,
+    collect_stats: bool,
+  ) -> None:
+    self.id = id
+    self.name = name
+    self.category = category
+    self.addons = addons
+    self.scripts = scripts
+    self.extra_config = extra_config
+    self.collect_stats = collect_stats
+
+  @property
+  def version(self) -> str:
+    "Changes whenever anything a connected machine is built from changes."
+    fingerprint = codec.dumps(
+      [
+        self.id,
+        self.name,
+        self.category,
+        sorted(self.addons),
+        sorted(self.scripts),
+        self.collect_stats,
+      ]
+    )
+    return hashlib.blake2b(fingerprint, digest_size=8).hexdigest()
+
+  def out(self) -> dict:
+    return {
+      "id": self.id,
+      "name": self.name,
+      "category": self.category,
+      "addons": self.addons,
+      "scripts": self.scripts,
+      "extra_config": self.extra_config,
+      "collect_stats": self.collect_stats,
+    }
+
+  @classmethod
+  def from_record(cls, record: asyncpg.Record) -> MachineRecord:
+    try:
+      extra_config = codec.loads(record.get("extraconfig") or "{}")
+    except ValueError:
+      extra_config = {}
+    return cls(
+      id=record.get("id"),
+      name=record.get("name"),
+      category=record.get("category"),
+      addons=list(record.get("addons") or []),
+      scripts=list(record.get("scripts") or []),
+      extra_config=extra_config,
+      collect_stats=record.get("collectstats"),
+    )
+
+
+class MachineRegistry:
+  """Authoritative cache of the Machines table.
+
+  Loaded once at startup, and kept up to date by every handler that writes to
+  the table, so lookups on the hot paths never touch the database.
+  """
+
+  pool: asyncpg.Pool | None
+  # Lowercased name -> record. Names are matched case-insensitively, the same
+  # way the old `Name ILIKE $1` queries did.
+  _by_name: dict[str, MachineRecord]
+  hits: int
+  misses: int
+  reloads: int
+  # Called with (old, new) whenever a machine is added, replaced or removed.
+  listeners: list[Callable[[MachineRecord | None, MachineRecord | None], None]]
+
+  def __init__(self, pool: asyncpg.Pool | None) -> None:
+    self.pool = pool
+    self._by_name = {}
+    self.listeners = []
+    self.hits = 0
+    self.misses = 0
+    self.reloads = 0
+
+  async def load(self) -> None:
+    "(Re)load every machine from the database."
+    self.replace(await self.fetch())
+
+  async def fetch(self) -> list[MachineRecord] | None:
+    "Every machine in the database, None without one."
+    if self.pool is None:
+      return None
+    async with self.pool.acquire() as conn:
+      conn: asyncpg.Connection
+      records = await conn.fetch("SELECT * FROM Machines;")
+    return [MachineRecord.from_record(record) for record in records]
+
+  def replace(self, records: list[MachineRecord] | None) -> None:
+    "Swap in a fresh copy of the table from `fetch`, telling listeners what changed."
+    if records is None:
+      return
+    old = self._by_name
+    self._by_name = {record.name.lower(): record for record in records}
+    for name in old.keys() | self._by_name.keys():
+      self._changed(old.get(name), self._by_name.get(name))
+    self.reloads += 1
+    LOG.info(f"[REGISTRY] Loaded {len(self._by_name)} machines")
+
+  def get(self, name: str) -> MachineRecord | None:
+    record = self._by_name.get(name.lower())
+    if record is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return record
+
+  def _changed(self, old: MachineRecord | None, new: MachineRecord | None) -> None:
+    for listener in self.listeners:
+      try:
+        listener(old, new)
+      except Exception:
+        LOG.exception("[REGISTRY] Change listener failed")
+
+  def all(self) -> list[MachineRecord]:
+    return list(self._by_name.values())
+
+  def __len__(self) -> int:
+    return len(self._by_name)
+
+  def __contains__(self, name: str) -> bool:
+    return name.lower() in self._by_name
+
+  def put(self, record: asyncpg.Record | MachineRecord) -> MachineRecord:
+    "Insert or replace a machine, usually with the row from `RETURNING *`."
+    if not isinstance(record, MachineRecord):
+      record = MachineRecord.from_record(record)
+    old = self._by_name.get(record.name.lower())
+    self._by_name[record.name.lower()] = record
+    self._changed(old, record)
+    return record
+
+  def remove(self, name: str) -> MachineRecord | None:
+    old = self._by_name.pop(name.lower(), None)
+    if old is not None:
+      self._changed(old, None)
+    return old
+
+  def metrics(self) -> dict:
+    lookups = self.hits + self.misses
+    return {
+      "machines": len(self._by_name),
+      "hits": self.hits,
+      "misses": self.misses,
+      "hit_ratio": self.hits / lookups if lookups else None,
+      "reloads": self.reloads,
+    }
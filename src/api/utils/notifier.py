@@ -0,0 +1,271 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import aiohttp
+
+from utils import codec
+
+from .admission import TokenBucket
+
+LOG = logging.getLogger(__name__)
+
+# Statuses worth trying again, anything else in 4xx won't get better.
+RETRY_STATUSES = {408, 425, 429}
+
+
+def digest(notifications: list[dict]) -> dict:
+  """One message for several notifications to the same topic. The highest
+  priority wins, tags are merged and a click URL is kept if they all share it."""
+  if len(notifications) == 1:
+    return notifications[0]
+
+  lines = []
+  for notification in notifications:
+    title = notification.get("title")
+    if title:
+      lines.append(f"**{title}**")
+    lines.append(notification["message"].rstrip("\n"))
+    lines.append("")
+  tags = sorted(
+    {tag for notification in notifications for tag in notification.get("tags") or ()}
+  )
+  clicks = {notification.get("click") for notification in notifications}
+
+  message = {
+    "topic": notifications[0]["topic"],
+    "title": f"{len(notifications)} alerts",
+    "message": "\n".join(lines).rstrip("\n"),
+    "priority": max(notification.get("priority", 3) for notification in notifications),
+    "markdown": True,
+  }
+  if tags:
+    message["tags"] = tags
+  if len(clicks) == 1 and None not in clicks:
+    message["click"] = clicks.pop()
+  return message
+
+
+class NotificationDispatcher:
+  """Sends ntfy notifications from a background task, so a slow or down ntfy
+  server never holds up packet processing.
+
+  Notifications for the same topic arriving within `window` seconds of the
+  first are sent as one digest. Requests are capped at `rate` per second,
+  failures are retried with exponential backoff, and messages that run out
+  of retries (or are rejected outright) are kept in a small dead-letter
+  buffer for inspection."""
+
+  cs: aiohttp.ClientSession
+  url: str
+  token: str | None
+  default_topic: str
+  window: float
+  max_pending: int
+  retries: int
+  backoff: float
+  max_backoff: float
+  request_timeout: float
+  bucket: TokenBucket
+  # Topic -> (first arrival, notifications) waiting out the window
+  pending: dict[str, tuple[float, list[dict]]]
+  pending_count: int
+  # (due, seq, attempt, message) ready to send or waiting for a retry
+  outbox: list[tuple[float, int, int, dict]]
+  dead_letters: collections.deque[dict]
+  counters: dict[str, int]
+  task: asyncio.Task | None
+  _wake: asyncio.Event
+  _seq: itertools.count
+
+  def __init__(
+    self,
+    cs: aiohttp.ClientSession,
+    url: str,
+    *,
+    token: str | None = None,
+    default_topic: str,
+    window: float = 10,
+    max_pending: int = 1000,
+    rate: float = 1,
+    burst: float = 5,
+    retries: int = 5,
+    backoff: float = 1,
+    max_backoff: float = 60,
+    request_timeout: float = 10,
+    dead_letters: int = 100,
+  ) -> None:
+    self.cs = cs
+    self.url = url
+    self.token = token
+    self.default_topic = default_topic
+    self.window = window
+    self.max_pending = max_pending
+    self.retries = retries
+    self.backoff = backoff
+    self.max_backoff = max_backoff
+    self.request_timeout = request_timeout
+    self.bucket = TokenBucket(rate, burst)
+    self.pending = {}
+    self.pending_count = 0
+    self.outbox = []
+    self.dead_letters = collections.deque(maxlen=dead_letters)
+    self.counters = {
+      "submitted": 0,
+      "dropped": 0,
+      "sent": 0,
+      "digests": 0,
+      "retries": 0,
+      "dead": 0,
+    }
+    self.task = None
+    self._wake = asyncio.Event()
+    self._seq = itertools.count()
+
+  def start(self) -> None:
+    self.task = asyncio.create_task(self._run())
+
+  async def close(self, *, timeout: float = 5) -> None:
+    "Send whatever is waiting, for up to `timeout` seconds, then stop."
+    if self.task is None:
+      return
+    self.window = 0
+    self._wake.set()
+    try:
+      async with asyncio.timeout(timeout):
+        while self.pending or self.outbox:
+          await asyncio.sleep(0.1)
+    except TimeoutError:
+      LOG.warning(
+        f"[NOTIFY] Gave up on {self.pending_count + len(self.outbox)} notifications"
+      )
+    self.task.cancel()
+    await asyncio.gather(self.task, return_exceptions=True)
+    self.task = None
+
+  def submit(self, notification: dict) -> bool:
+    "Queue a notification. Returns False if too many are waiting and it was dropped."
+    if self.pending_count + len(self.outbox) >= self.max_pending:
+      self.counters["dropped"] += 1
+      LOG.warning(f"[NOTIFY] Queue full, dropped {notification.get('title')!r}")
+      return False
+    notification = {key: value for key, value in notification.items() if value is not None}
+    notification.setdefault("topic", self.default_topic)
+    topic = notification["topic"]
+    if topic in self.pending:
+      self.pending[topic][1].append(notification)
+    else:
+      self.pending[topic] = (time.monotonic(), [notification])
+    self.pending_count += 1
+    self.counters["submitted"] += 1
+    self._wake.set()
+    return True
+
+  def _flush_pending(self, now: float) -> float | None:
+    "Move topics whose window has passed to the outbox. Returns when the next is due."
+    next_due = None
+    for topic, (first, notifications) in list(self.pending.items()):
+      due = first + self.window
+      if due <= now:
+        del self.pending[topic]
+        self.pending_count -= len(notifications)
+        try:
+          message = digest(notifications)
+        except Exception as e:
+          LOG.exception(f"[NOTIFY] Couldn't build the message for {topic}")
+          for notification in notifications:
+            self._dead(notification, None, repr(e), 0)
+          continue
+        if len(notifications) > 1:
+          self.counters["digests"] += 1
+        self._queue(message, attempt=0, due=now)
+      elif next_due is None or due < next_due:
+        next_due = due
+    return next_due
+
+  def _queue(self, message: dict, *, attempt: int, due: float) -> None:
+    heapq.heappush(self.outbox, (due, next(self._seq), attempt, message))
+
+  async def _run(self) -> None:
+    while True:
+      now = time.monotonic()
+      next_due = self._flush_pending(now)
+      if self.outbox and self.outbox[0][0] <= now:
+        wait = self.bucket.take()
+        if wait:
+          await asyncio.sleep(wait)
+          continue
+        _, _, attempt, message = heapq.heappop(self.outbox)
+        try:
+          await self._send(message, attempt)
+        except Exception as e:
+          # Something a script put in the message, or a bug here. Either way
+          # retrying won't help, and the task has to keep going.
+          LOG.exception(f"[NOTIFY] Failed to send {message.get('title')!r}")
+          self._dead(message, None, repr(e), attempt)
+        continue
+
+      if self.outbox and (next_due is None or self.outbox[0][0] < next_due):
+        next_due = self.outbox[0][0]
+      self._wake.clear()
+      try:
+        async with asyncio.timeout(None if next_due is None else max(0, next_due - now)):
+          await self._wake.wait()
+      except TimeoutError:
+        pass
+
+  async def _send(self, message: dict, attempt: int) -> None:
+    headers = {"Content-Type": "application/json"}
+    if self.token:
+      headers["Authorization"] = self.token
+    try:
+      async with asyncio.timeout(self.request_timeout), self.cs.post(
+        self.url, headers=headers, data=codec.dumps(message)
+      ) as resp:
+        status = resp.status
+        text = "" if status == 200 else await resp.text()
+    except (aiohttp.ClientError, TimeoutError, OSError) as e:
+      status, text = None, repr(e)
+
+    if status == 200:
+      self.counters["sent"] += 1
+      return
+
+    retry = status is None or status >= 500 or status in RETRY_STATUSES
+    if retry and attempt < self.retries:
+      delay = min(self.max_backoff, self.backoff * 2**attempt)
+      # Full jitter, so retries from several workers don't line up.
+      delay = random.uniform(0, delay)
+      self.counters["retries"] += 1
+      LOG.info(f"[NOTIFY] Send failed ({status or text}), retrying in {delay:.1f}s")
+      self._queue(message, attempt=attempt + 1, due=time.monotonic() + delay)
+      return
+
+    LOG.warning(f"[NOTIFY] Giving up on {message.get('title')!r}: HTTP{status} {text}")
+    self._dead(message, status, text, attempt)
+
+  def _dead(self, message: dict, status: int | None, error: str, attempt: int) -> None:
+    self.counters["dead"] += 1
+    self.dead_letters.append(
+      {
+        "message": message,
+        "status": status,
+        "error": error,
+        "attempts": attempt + 1,
+        "time": time.time(),
+      }
+    )
+
+  def metrics(self) -> dict:
+    return {
+      "pending": self.pending_count,
+      "outbox": len(self.outbox),
+      "dead_letters": len(self.dead_letters),
+      **self.counters,
+    }
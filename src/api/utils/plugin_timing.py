@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import time
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from collections.abc import Awaitable, Callable
+  from typing import Any
+
+LOG = logging.getLogger(__name__)
+
+
+class PluginTimings:
+  """Runs plugin code on the ingest side with a time limit, and keeps how long
+  each plugin takes.
+
+  Every call gets at most `timeout` seconds, and all the plugins of one packet
+  share `budget` seconds. Once the budget is spent the remaining plugins are
+  skipped for that packet."""
+
+  timeout: float
+  budget: float
+  # "plugin.phase" -> calls, seconds, max_seconds, timeouts, errors, skipped
+  stats: dict[str, dict[str, float]]
+
+  def __init__(self, *, timeout: float = 0.5, budget: float = 2) -> None:
+    self.timeout = timeout
+    self.budget = budget
+    self.stats = {}
+
+  def deadline(self) -> float:
+    "When the budget of a packet starting now runs out."
+    return time.monotonic() + self.budget
+
+  async def call(
+    self, name: str, phase: str, func: Callable[[], Awaitable[Any]], deadline: float
+  ) -> tuple[bool, Any]:
+    "(True, result), or (False, None) if it timed out, failed or was skipped."
+    stats = self.stats.get(f"{name}.{phase}")
+    if stats is None:
+      stats = {
+        "calls": 0,
+        "seconds": 0.0,
+        "max_seconds": 0.0,
+        "timeouts": 0,
+        "errors": 0,
+        "skipped": 0,
+      }
+      self.stats[f"{name}.{phase}"] = stats
+
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      stats["skipped"] += 1
+      return False, None
+
+    started = time.perf_counter()
+    try:
+      async with asyncio.timeout(min(self.timeout, remaining)):
+        result = await func()
+    except TimeoutError:
+      stats["timeouts"] += 1
+      LOG.warning(f"[PLUGINS] {name}.{phase} timed out")
+      return False, None
+    except Exception:
+      stats["errors"] += 1
+      LOG.exception(f"[PLUGINS] {name}.{phase} failed")
+      return False, None
+    finally:
+      elapsed = time.perf_counter() - started
+      stats["calls"] += 1
+      stats["seconds"] += elapsed
+      stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+    return True, result
+
+  def metrics(self) -> dict:
+    return {
+      "timeout": self.timeout,
+      "budget": self.budget,
+      "plugins": {
+        key: {
+          "calls": stats["calls"],
+          "avg_ms": round(stats["seconds"] / stats["calls"] * 1000, 3) if stats["calls"] else None,
+          "max_ms": round(stats["max_seconds"] * 1000, 3),
+          "timeouts": stats["timeouts"],
+          "errors": stats["errors"],
+          "skipped": stats["skipped"],
+        }
+        for key, stats in self.stats.items()
+      },
+    }
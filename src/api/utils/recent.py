@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+import math
+from array import array
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from .data_classes import MonitorPacket
+
+NAN = math.nan
+
+
+class RecentSamples:
+  """The last `capacity` numeric samples of a machine, for sparklines.
+
+  Every series is a fixed size `array('d')` written in place at a shared head,
+  so memory is `capacity * (series + 1) * 8` bytes however long the machine
+  stays connected. A series missing from a sample holds NaN for it, and at
+  most `max_series` series are kept, the rest are ignored."""
+
+  capacity: int
+  max_series: int
+  head: int  # Index the next sample is written to.
+  count: int
+  times: array
+  series: dict[str, array]
+
+  def __init__(self, *, capacity: int = 120, max_series: int = 32) -> None:
+    self.capacity = max(1, capacity)
+    self.max_series = max_series
+    self.head = 0
+    self.count = 0
+    self.times = array("d", [NAN]) * self.capacity
+    self.series = {}
+
+  def add(self, timestamp: float, sample: dict[str, float]) -> None:
+    head = self.head
+    self.times[head] = timestamp
+    for name, values in self.series.items():
+      values[head] = sample.get(name, NAN)
+    for name, value in sample.items():
+      if name not in self.series and len(self.series) < self.max_series:
+        values = array("d", [NAN]) * self.capacity
+        values[head] = value
+        self.series[name] = values
+    self.head = (head + 1) % self.capacity
+    self.count = min(self.count + 1, self.capacity)
+
+  def _ordered(self, values: array, points: int) -> list[float | None]:
+    "The newest `points` values, oldest first, with gaps as None."
+    points = min(points, self.count)
+    start = (self.head - points) % self.capacity
+    if start + points <= self.capacity:
+      window = values[start : start + points]
+    else:
+      window = values[start:] + values[: self.head]
+    return [None if value != value else value for value in window]
+
+  def out(self, fields: list[str] | None = None, points: int | None = None) -> dict:
+    points = self.count if points is None else points
+    names = self.series.keys() if fields is None else fields
+    return {
+      "capacity": self.capacity,
+      "time": self._ordered(self.times, points),
+      "series": {
+        name: self._ordered(self.series[name], points)
+        for name in names
+        if name in self.series
+      },
+    }
+
+
+def as_number(value: object) -> float | None:
+  "A float for anything numeric, including numeric strings, else None."
+  if isinstance(value, bool):
+    return None
+  if isinstance(value, (int, float)):
+    return float(value)
+  if isinstance(value, str):
+    # The client sends load averages as strings.
+    try:
+      return float(value)
+    except ValueError:
+      return None
+  return None
+
+
+def _flatten(prefix: str, data: object, out: dict[str, float], depth: int) -> None:
+  if isinstance(data, dict):
+    if depth == 0:
+      return
+    for key, value in data.items():
+      _flatten(f"{prefix}.{key}", value, out, depth - 1)
+  elif not isinstance(data, str):
+    number = as_number(data)
+    if number is not None:
+      out[prefix] = number
+
+
+def extract_sample(packet: MonitorPacket) -> dict[str, float]:
+  "Pull the numbers worth plotting out of a monitor packet."
+  sample: dict[str, float] = {}
+  if packet.stats_valid:
+    for key in ("1m", "5m", "15m"):
+      value = as_number((packet.cpu or {}).get(key))
+      if value is not None:
+        sample[f"cpu.{key}"] = value
+    for name, stats in (("ram", packet.ram), ("disk", packet.disk)):
+      value = as_number((stats or {}).get("used"))
+      if value is not None:
+        sample[f"{name}.used"] = value
+    current = packet.internet.current or {}
+    for key, direction in (("net.in", "incoming"), ("net.out", "outgoing")):
+      value = as_number(current.get(direction))
+      if value is not None:
+        sample[key] = value
+  if isinstance(packet.extras, dict):
+    for plugin, data in packet.extras.items():
+      _flatten(f"extras.{plugin}", data, sample, 3)
+  return sample
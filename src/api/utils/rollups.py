@@ -0,0 +1,302 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import logging
+import time
+
+import asyncpg
+
+from .timeseries import METRICS, TABLE, partition_range
+
+LOG = logging.getLogger(__name__)
+
+
+class Tier:
+  name: str  # "1m", "1h" or "1d"
+  table: str
+  unit: str  # date_trunc unit of a bucket
+  bucket: datetime.timedelta
+  # How much of the source is rolled up per transaction.
+  step: datetime.timedelta
+  source: Tier | None  # None means the raw MachineStats table.
+
+  def __init__(
+    self,
+    name: str,
+    unit: str,
+    bucket: datetime.timedelta,
+    step: datetime.timedelta,
+    source: Tier | None,
+  ) -> None:
+    self.name = name
+    self.table = f"{TABLE}_{name}"
+    self.unit = unit
+    self.bucket = bucket
+    self.step = step
+    self.source = source
+
+  def truncate(self, moment: datetime.datetime) -> datetime.datetime:
+    "Start of the bucket holding `moment`, like date_trunc(unit, moment, 'UTC')."
+    moment = moment.astimezone(datetime.UTC)
+    if self.unit == "minute":
+      return moment.replace(second=0, microsecond=0)
+    if self.unit == "hour":
+      return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+  @property
+  def rollup_query(self) -> str:
+    if self.source is None:
+      values = ", ".join(
+        f"('{metric}', s.{metric}::DOUBLE PRECISION)" for metric in METRICS
+      )
+      select = f"""
+        SELECT
+          s.MachineID, m.Metric, date_trunc('{self.unit}', s.Time, 'UTC') AS Bucket,
+          min(m.Value), max(m.Value), avg(m.Value),
+          (array_agg(m.Value ORDER BY s.Time DESC))[1], count(*)
+        FROM {TABLE} s
+        CROSS JOIN LATERAL (VALUES {values}) AS m (Metric, Value)
+        WHERE s.Time >= $1 AND s.Time < $2 AND m.Value IS NOT NULL
+        GROUP BY s.MachineID, m.Metric, Bucket
+      """
+    else:
+      select = f"""
+        SELECT
+          MachineID, Metric, date_trunc('{self.unit}', Bucket, 'UTC') AS Coarse,
+          min(MinValue), max(MaxValue), sum(AvgValue * Samples) / sum(Samples),
+          (array_agg(LastValue ORDER BY Bucket DESC))[1], sum(Samples)
+        FROM {self.source.table}
+        WHERE Bucket >= $1 AND Bucket < $2
+        GROUP BY MachineID, Metric, Coarse
+      """
+    # Windows line up with buckets, so a bucket is always rebuilt from all
+    # of its rows and rolling a window up twice changes nothing.
+    return f"""
+      INSERT INTO {self.table}
+        (MachineID, Metric, Bucket, MinValue, MaxValue, AvgValue, LastValue, Samples)
+      {select}
+      ON CONFLICT (MachineID, Metric, Bucket) DO UPDATE SET
+        MinValue = EXCLUDED.MinValue,
+        MaxValue = EXCLUDED.MaxValue,
+        AvgValue = EXCLUDED.AvgValue,
+        LastValue = EXCLUDED.LastValue,
+        Samples = EXCLUDED.Samples;
+    """
+
+
+MINUTE = Tier(
+  "1m", "minute", datetime.timedelta(minutes=1), datetime.timedelta(hours=1), None
+)
+HOUR = Tier(
+  "1h", "hour", datetime.timedelta(hours=1), datetime.timedelta(days=1), MINUTE
+)
+DAY = Tier("1d", "day", datetime.timedelta(days=1), datetime.timedelta(days=30), HOUR)
+TIERS = (MINUTE, HOUR, DAY)
+# Days kept per tier when [srv.rollups.retention] doesn't say. 0 keeps forever.
+DEFAULT_RETENTION = {"raw": 30, "1m": 7, "1h": 90, "1d": 0}
+
+
+class RollupJob:
+  """Rolls logged stats up into the 1m, 1h and 1d tiers, and prunes every
+  tier past its retention. Runs on one worker only.
+
+  How far each tier got is kept in RollupState, so a restart carries on
+  where it left off. Pruning drops whole raw partitions where it can, and
+  deletes everything else in small batches, so ingest is never blocked for
+  long."""
+
+  pool: asyncpg.Pool
+  # Days kept per tier ("raw", "1m", "1h", "1d"). 0 keeps forever.
+  retention: dict[str, float]
+  interval: float  # Seconds between runs.
+  delay: datetime.timedelta  # How long to wait for late rows.
+  batch_size: int
+  batch_pause: float
+  task: asyncio.Task | None
+  rolled_up: dict[str, int]
+  pruned: dict[str, int]
+  partitions_dropped: int
+  lag: dict[str, float]
+  last_run: float | None
+  last_duration: float | None
+  failures: int
+
+  def __init__(
+    self,
+    pool: asyncpg.Pool,
+    *,
+    retention: dict[str, float] = None,
+    interval: float = 60,
+    delay: float = 60,
+    batch_size: int = 5000,
+    batch_pause: float = 0.1,
+  ) -> None:
+    self.pool = pool
+    self.retention = {**DEFAULT_RETENTION, **(retention or {})}
+    self.interval = interval
+    self.delay = datetime.timedelta(seconds=delay)
+    self.batch_size = batch_size
+    self.batch_pause = batch_pause
+    self.task = None
+    self.rolled_up = {tier.name: 0 for tier in TIERS}
+    self.pruned = {"raw": 0, **{tier.name: 0 for tier in TIERS}}
+    self.partitions_dropped = 0
+    self.lag = {}
+    self.last_run = None
+    self.last_duration = None
+    self.failures = 0
+
+  def start(self) -> None:
+    self.task = asyncio.create_task(self._run())
+
+  def stop(self) -> None:
+    if self.task is not None:
+      self.task.cancel()
+
+  async def _run(self) -> None:
+    while True:
+      started = time.perf_counter()
+      try:
+        for tier in TIERS:
+          await self.rollup(tier)
+        await self.prune()
+      except Exception:
+        self.failures += 1
+        LOG.exception("[ROLLUP] Run failed")
+      self.last_run = time.time()
+      self.last_duration = time.perf_counter() - started
+      await asyncio.sleep(self.interval)
+
+  async def _done(self, conn: asyncpg.Connection, tier: Tier) -> datetime.datetime | None:
+    done = await conn.fetchval("SELECT Done FROM RollupState WHERE Tier = $1;", tier.name)
+    if done is not None:
+      return done
+    # First run, start from the oldest data there is.
+    if tier.source is None:
+      oldest = await conn.fetchval(f"SELECT min(Time) FROM {TABLE};")
+    else:
+      oldest = await conn.fetchval(f"SELECT min(Bucket) FROM {tier.source.table};")
+    return None if oldest is None else tier.truncate(oldest)
+
+  async def rollup(self, tier: Tier) -> None:
+    "Roll every finished bucket of `tier` up, one short transaction per step."
+    async with self.pool.acquire() as conn:
+      conn: asyncpg.Connection
+      start = await self._done(conn, tier)
+      if start is None:
+        return
+      ready = datetime.datetime.now(datetime.UTC) - self.delay
+      if tier.source is not None:
+        # Only buckets the finer tier has completely covered.
+        source_done = await conn.fetchval(
+          "SELECT Done FROM RollupState WHERE Tier = $1;", tier.source.name
+        )
+        if source_done is None:
+          return
+        ready = min(ready, source_done)
+      end = tier.truncate(ready)
+
+      query = tier.rollup_query
+      while start < end:
+        stop = min(start + tier.step, end)
+        async with conn.transaction():
+          result = await conn.execute(query, start, stop)
+          await conn.execute(
+            """
+            INSERT INTO RollupState (Tier, Done) VALUES ($1, $2)
+            ON CONFLICT (Tier) DO UPDATE SET Done = EXCLUDED.Done;
+            """,
+            tier.name,
+            stop,
+          )
+        self.rolled_up[tier.name] += int(result.split()[-1])
+        start = stop
+      self.lag[tier.name] = round(
+        (datetime.datetime.now(datetime.UTC) - start).total_seconds(), 1
+      )
+
+  def _cutoff(self, tier_name: str) -> datetime.datetime | None:
+    days = self.retention.get(tier_name, 0)
+    if not days:
+      return None
+    return datetime.datetime.now(datetime.UTC) - datetime.timedelta(days=days)
+
+  async def _delete_in_batches(
+    self, table: str, column: str, cutoff: datetime.datetime
+  ) -> int:
+    deleted = 0
+    while True:
+      async with self.pool.acquire() as conn:
+        conn: asyncpg.Connection
+        result = await conn.execute(
+          f"""
+          DELETE FROM {table} WHERE ctid = ANY(ARRAY(
+            SELECT ctid FROM {table} WHERE {column} < $1 LIMIT $2
+          ));
+          """,
+          cutoff,
+          self.batch_size,
+        )
+      count = int(result.split()[-1])
+      deleted += count
+      if count < self.batch_size:
+        return deleted
+      # Let ingest and everything else at the table between batches.
+      await asyncio.sleep(self.batch_pause)
+
+  async def prune(self) -> None:
+    cutoff = self._cutoff("raw")
+    if cutoff is not None:
+      async with self.pool.acquire() as conn:
+        conn: asyncpg.Connection
+        partitions = await conn.fetch(
+          """
+          SELECT c.relname FROM pg_inherits i
+          JOIN pg_class c ON c.oid = i.inhrelid
+          WHERE i.inhparent = $1::regclass;
+          """,
+          TABLE,
+        )
+      for record in partitions:
+        name = record.get("relname")
+        bounds = partition_range(name)
+        if bounds is not None and bounds[1] <= cutoff:
+          await self._drop_partition(name)
+        elif bounds is None or bounds[0] < cutoff:
+          # Partly expired, or the default partition.
+          self.pruned["raw"] += await self._delete_in_batches(name, "Time", cutoff)
+
+    for tier in TIERS:
+      cutoff = self._cutoff(tier.name)
+      if cutoff is not None:
+        self.pruned[tier.name] += await self._delete_in_batches(
+          tier.table, "Bucket", cutoff
+        )
+
+  async def _drop_partition(self, name: str) -> None:
+    "Drop a whole expired partition, if ingest lets go of the table quickly."
+    async with self.pool.acquire() as conn:
+      conn: asyncpg.Connection
+      try:
+        async with conn.transaction():
+          await conn.execute("SET LOCAL lock_timeout = '1s';")
+          await conn.execute(f"DROP TABLE {name};")
+      except asyncpg.LockNotAvailableError:
+        LOG.info(f"[ROLLUP] {name} is busy, dropping it next run")
+        return
+    self.partitions_dropped += 1
+    LOG.info(f"[ROLLUP] Dropped expired partition {name}")
+
+  def metrics(self) -> dict:
+    return {
+      "last_run": self.last_run,
+      "last_duration": self.last_duration,
+      "lag_seconds": self.lag,
+      "rolled_up": self.rolled_up,
+      "pruned": self.pruned,
+      "partitions_dropped": self.partitions_dropped,
+      "retention_days": self.retention,
+      "failures": self.failures,
+    }
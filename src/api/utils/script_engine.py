@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import itertools
+import logging
+import time
+from typing import TYPE_CHECKING
+
+from .histogram import LatencyHistogram
+
+if TYPE_CHECKING:
+  from .data_classes import ConnectedMachine, MonitorPacket, Script
+
+LOG = logging.getLogger(__name__)
+
+
+class ScriptStats:
+  latency: LatencyHistogram
+  runs: int
+  timeouts: int
+  errors: int
+
+  def __init__(self) -> None:
+    self.latency = LatencyHistogram()
+    self.runs = 0
+    self.timeouts = 0
+    self.errors = 0
+
+  def metrics(self) -> dict:
+    return {
+      "runs": self.runs,
+      "timeouts": self.timeouts,
+      "errors": self.errors,
+      "latency": self.latency.metrics(),
+    }
+
+
+class ScriptEngine:
+  """Runs a machine's scripts for each packet.
+
+  Scripts are grouped into stages by priority, highest first. A stage only
+  starts once the one before it is done, and the scripts within a stage run
+  concurrently. Every script gets `timeout` seconds, or its own `timeout`,
+  after which it is cancelled and counted."""
+
+  timeout: float
+  stats: dict[str, ScriptStats]
+  # Machine's script list -> its stages. Lists are shared between packets.
+  _stages: dict[tuple[int, ...], list[list[Script]]]
+
+  def __init__(self, *, timeout: float = 5) -> None:
+    self.timeout = timeout
+    self.stats = {}
+    self._stages = {}
+
+  def stages(self, scripts: list[Script]) -> list[list[Script]]:
+    key = tuple(id(script) for script in scripts)
+    stages = self._stages.get(key)
+    if stages is None:
+      ordered = sorted(scripts, key=lambda script: script.priority, reverse=True)
+      stages = [
+        list(stage)
+        for _, stage in itertools.groupby(ordered, key=lambda script: script.priority)
+      ]
+      self._stages[key] = stages
+    return stages
+
+  async def run(
+    self, scripts: list[Script], packet: MonitorPacket, machine: ConnectedMachine
+  ) -> None:
+    for stage in self.stages(scripts):
+      if len(stage) == 1:
+        await self._run_one(stage[0], packet, machine)
+      else:
+        await asyncio.gather(
+          *(self._run_one(script, packet, machine) for script in stage)
+        )
+
+  async def _run_one(
+    self, script: Script, packet: MonitorPacket, machine: ConnectedMachine
+  ) -> None:
+    stats = self.stats.get(script.name)
+    if stats is None:
+      stats = self.stats[script.name] = ScriptStats()
+    timeout = script.timeout if script.timeout is not None else self.timeout
+    started = time.perf_counter()
+    try:
+      async with asyncio.timeout(timeout):
+        await script.run(packet, machine)
+    except TimeoutError:
+      stats.timeouts += 1
+      LOG.warning(f"[SCRIPTS] {script.name} overran {timeout}s for {machine.name}")
+    except Exception:
+      stats.errors += 1
+      LOG.exception(f"[SCRIPTS] {script.name} failed for {machine.name}")
+    finally:
+      stats.runs += 1
+      stats.latency.record(time.perf_counter() - started)
+
+  def metrics(self) -> dict:
+    return {
+      "timeout": self.timeout,
+      "scripts": {name: stats.metrics() for name, stats in self.stats.items()},
+    }
@@ -47,9 +47,16 @@ async def fetch_scripts(names: list[str], app: Application) -> list[Script]:
   for k,v in ALL_SCRIPTS.items():
     if not isinstance(v, Script):
       ALL_SCRIPTS[k] = v(app)
+      await ALL_SCRIPTS[k].setup()
     if k in names:
-      out.append(v)
+      out.append(ALL_SCRIPTS[k])
   out.sort(key=lambda p: p.priority, reverse=True)
   return out
 
+async def close_scripts() -> None:
+  "Close every script that has been created."
+  for script in ALL_SCRIPTS.values():
+    if isinstance(script, Script):
+      await script.close()
+
 print("[SCRIPTS] Loaded server scripts:", ALL_SCRIPTS.keys())
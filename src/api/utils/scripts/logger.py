@@ -1,17 +1,15 @@
 from __future__ import annotations
 
 import datetime
-import json
 import logging
 from typing import TYPE_CHECKING
 
 import pytz
 
 from api.utils.data_classes import Script
+from api.utils.timeseries import stats_row
 
 if TYPE_CHECKING:
-  from asyncpg import Connection
-
   from api.utils.data_classes import ConnectedMachine, MonitorPacket
 
 LOG = logging.getLogger(__name__)
@@ -19,20 +17,16 @@ LOG = logging.getLogger(__name__)
 class LoggerScript(Script, name="logger", priority=-9999):
   async def run(self, packet: MonitorPacket, machine: ConnectedMachine) -> None:
     # This script is only run when the machine explicitly calls for it.
-    # This simply puts both the raw packet and the processed packet into the database.
-
-    raw = packet.raw
-    out = await packet.out(machine.plugins, machine)
-
-    data = {
-      "raw": raw,
-      "processed": out
-    }
+    # The core stats go into typed columns, plugin output into JSONB.
+    record = self.app.machine_registry.get(machine.name)
+    if record is None:
+      return
 
-    str_data = json.dumps(data)
+    out = packet.current(machine)
     timestamp = datetime.datetime.now(tz=pytz.timezone(self.app.config.timezone))
+    row = stats_row(record.id, timestamp, packet, out.get("extras"))
 
-    async with self.pool.acquire() as conn:
-      conn: Connection
-      await conn.execute("INSERT INTO LoggedData (Name, Time, Data) VALUES ($1, $2, $3);", machine.name, timestamp, str_data)
-      LOG.debug(f"[Logger] Logged data for {machine.name}; Length {len(str_data)}")
\ No newline at end of file
+    # Buffered and written with COPY in batches, this only waits when the
+    # buffer is full.
+    if not await self.app.stats_writer.write(row):
+      LOG.warning(f"[Logger] Dropped data for {machine.name}, writer is backed up")
@@ -6,16 +6,14 @@ import logging
 import time
 from typing import TYPE_CHECKING
 
-import py_expression_eval
-
+from api.utils.alert_rules import AlertRuleCache, resolve
 from api.utils.data_classes import ConnectedMachine, MonitorPacket, Script
+from api.utils.recent import as_number
 from utils.extra_request import Application
-from utils.utils import validate_parameters
 
 if TYPE_CHECKING:
-  from typing import Any
-
   from api.utils.data_classes import ConnectedMachine, MonitorPacket
+  from api.utils.machine_registry import MachineRecord
 
 LOG = logging.getLogger(__name__)
 
@@ -32,6 +30,14 @@ def hash(message: str) -> str:
   return hashlib.sha512(message.encode()).digest().hex()
 
 
+def used_percent(stats: dict | None) -> float | None:
+  "Used percent of a ram or disk stats dict, None if it's missing or empty."
+  try:
+    return (stats["used"] / stats["total"]) * 100
+  except (TypeError, KeyError, ZeroDivisionError):
+    return None
+
+
 # extra_config["usagealert"] = {
 #   "alert_targets": ["Phone 1", "Phone 2"]
 #   "alert_interval": 86400 # Alert every 24 hours
@@ -49,30 +55,10 @@ def hash(message: str) -> str:
 #
 # }
 
-def get_value(d: dict, key: str, default: Any = None) -> Any:
-  "Extract a value from a dictionary, following / in key name."
-  if isinstance(key, str):
-    if "/" in key:
-      split: list[str] = key.split("/")
-      first_level = split.pop(0)
-      second_level = split[0]
-      rest = "/".join(split)
-      value = d.get(first_level, default)
-      if not isinstance(value, dict):
-        # We can't index a non-dict. Return and ignore recursion.
-        return value
-      elif second_level not in value:
-        return default
-      else:
-        return get_value(value, rest, default)
-    else:
-      return d.get(key, default)
-  else:
-    return d.get(key, default)
-
 # This script will alert phones when machine stat usage reaches a threshold (configured in extra_config or default to 90%)
 class UsageScript(Script, name="usage"):
-  evaluator: py_expression_eval.Parser
+  # raw_alert/processed_alert rules, compiled per machine config version
+  rules: AlertRuleCache
   sent_alerts: dict[
     str, tuple[int, str]
   ]  # Machine name: (Timestamp of last sent, Hash of message)
@@ -80,7 +66,8 @@ class UsageScript(Script, name="usage"):
   # Send a new message regardless of timestamp if hash doesnt match.
   def __init__(self, app: Application) -> None:
     super().__init__(app)
-    self.evaluator = py_expression_eval.Parser()
+    self.rules = AlertRuleCache()
+    app.metrics["alert_rules"] = self.rules.metrics
     self.sent_alerts = {}
 
   async def run(self, packet: MonitorPacket, machine: ConnectedMachine) -> None:
@@ -95,83 +82,49 @@ class UsageScript(Script, name="usage"):
 
     message = f"Alert for {machine.name}:\n"
 
-    if "cpu_threshold" in alert_config and alert_config["cpu_threshold"] > 0:
-      if packet.cpu["1m"] > alert_config["cpu_threshold"]:
-        alert = True
-        message += f"CPU @ {packet.cpu['1m']} (Over limit of {alert_config['cpu_threshold']})\n"
-
-    if "mem_threshold" in alert_config and alert_config["mem_threshold"] > 0:
-      ram_percent = (packet.ram["used"] / packet.ram["total"]) * 100
-      if ram_percent > alert_config["mem_threshold"]:
-        alert = True
-        message += f"RAM @ {round(ram_percent,1)}% (Over limit of {alert_config['mem_threshold']}%)\n"
-
-    if "disk_threshold" in alert_config and alert_config["disk_threshold"] > 0:
-      disk_percent = (packet.disk["used"] / packet.disk["total"]) * 100
-      if disk_percent > alert_config["disk_threshold"]:
-        alert = True
-        message += f"Disk @ {round(disk_percent,1)}% (Over limit of {alert_config['disk_threshold']}%)\n"
-
-    if "raw_alert" in alert_config:
-      for base_key, data in alert_config["raw_alert"].items():
-        # First check if all required values are present.
-        ok,missing = validate_parameters(data, ["value","message","threshold"])
-        if not ok:
-          LOG.warning(f"{machine.name} raw_alert for {base_key} is missing parameter {missing}!")
-          continue
+    # Packets without stats are only checked against the rules.
+    if packet.stats_valid:
+      if "cpu_threshold" in alert_config and alert_config["cpu_threshold"] > 0:
+        # statuscd sends load averages as strings.
+        cpu = as_number((packet.cpu or {}).get("1m"))
+        if cpu is not None and cpu > alert_config["cpu_threshold"]:
+          alert = True
+          message += f"CPU @ {cpu} (Over limit of {alert_config['cpu_threshold']})\n"
 
-        raw_data: dict = get_value(packet.raw, base_key)
-        if raw_data is None:
-          LOG.warning(f"{machine.name} raw alert for {base_key} couldn't find data in packet.raw!")
-          continue
+      if "mem_threshold" in alert_config and alert_config["mem_threshold"] > 0:
+        ram_percent = used_percent(packet.ram)
+        if ram_percent is not None and ram_percent > alert_config["mem_threshold"]:
+          alert = True
+          message += f"RAM @ {round(ram_percent,1)}% (Over limit of {alert_config['mem_threshold']}%)\n"
 
-        equation = data["value"]
-        variables = {}
-        for key,value in raw_data.items():
-          if isinstance(value, (int, float)):
-            variables[key] = value
-        
-        parsed: py_expression_eval.Expression = self.evaluator.parse(equation)
-        result = parsed.evaluate(variables)
-
-        threshold = data["threshold"]
-        if result > threshold:
-          alert_message: str = data["message"]
-          if not alert_message.endswith("\n"):
-            alert_message += "\n"
+      if "disk_threshold" in alert_config and alert_config["disk_threshold"] > 0:
+        disk_percent = used_percent(packet.disk)
+        if disk_percent is not None and disk_percent > alert_config["disk_threshold"]:
           alert = True
-          message += alert_message
-
-    if "processed_alert" in alert_config:
-      packet_out = await packet.out(machine.plugins, machine)
-      for base_key, data in alert_config["processed_alert"].items():
-        # First check if all required values are present.
-        ok,missing = validate_parameters(data, ["value","message","threshold"])
-        if not ok:
-          LOG.warning(f"{machine.name} processed_alert for {base_key} is missing parameter {missing}!")
+          message += f"Disk @ {round(disk_percent,1)}% (Over limit of {alert_config['disk_threshold']}%)\n"
+
+    rules = self.rules.get(machine, alert_config)
+    for section, rule_list in (
+      ("raw_alert", rules.raw_alert),
+      ("processed_alert", rules.processed_alert),
+    ):
+      if not rule_list:
+        continue
+      # Only build the processed packet if there's a rule to read it.
+      source = packet.raw if section == "raw_alert" else packet.current(machine)
+      for rule in rule_list:
+        data = resolve(source, rule.path)
+        if data is None:
+          LOG.warning(f"{machine.name} {section} for {rule.key} couldn't find data in the packet!")
           continue
-
-        raw_data: dict = get_value(packet_out, base_key)
-        if raw_data is None:
-          LOG.warning(f"{machine.name} processed alert for {base_key} couldn't find data in packet.out!")
+        try:
+          over = rule.check(data)
+        except Exception as e:
+          LOG.warning(f"{machine.name} {section} for {rule.key} failed: {e!r}")
           continue
-
-        equation = data["value"]
-        variables = {}
-        for key,value in raw_data.items():
-          if isinstance(value, (int, float)):
-            variables[key] = value
-        
-        parsed: py_expression_eval.Expression = self.evaluator.parse(equation)
-        result = parsed.evaluate(variables)
-
-        threshold = data["threshold"]
-        if result > threshold:
-          alert_message: str = data["message"]
-          if not alert_message.endswith("\n"):
-            alert_message += "\n"
+        if over:
           alert = True
-          message += alert_message
+          message += rule.message
 
     if not alert:
       return
@@ -193,4 +146,14 @@ class UsageScript(Script, name="usage"):
       if "ntfy" in alert_config["alert_targets"]:
         self.app.LOG.warning(f"Sending alert for {machine.name} over ntfy!")
         await self.send_ntfy_notification(message, title=f"{machine.name} alert", priority=4, click=machine.url(["basicstats"]))
-      self.sent_alerts[machine.name] = (time.time()+alert_config["alert_interval"], message_hash)
\ No newline at end of file
+      self.sent_alerts[machine.name] = (time.time()+alert_config["alert_interval"], message_hash)
+
+  async def setup(self) -> None:
+    self.app.machine_registry.listeners.append(self._registry_changed)
+
+  def _registry_changed(self, old: MachineRecord | None, new: MachineRecord | None) -> None:
+    "Forget machines that were deleted or renamed, rather than keep them forever."
+    if new is not None:
+      return
+    self.rules.forget(old.name)
+    self.sent_alerts.pop(old.name, None)
\ No newline at end of file
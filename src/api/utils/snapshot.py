@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+import gzip
+import secrets
+from typing import TYPE_CHECKING
+
+from utils import codec
+
+if TYPE_CHECKING:
+  from .feed import DashboardFeed
+
+
+class FleetSnapshot:
+  """/machines/get/all/ as ready-to-send bytes.
+
+  Every machine's card is encoded once when it changes. The full body, and
+  its gzipped copy, are only joined together when someone asks for them and
+  something changed since, so a burst of packets costs one build."""
+
+  # Machine name -> encoded `"name":{card}`
+  fragments: dict[str, bytes]
+  version: int
+  # Tells this process' versions apart from another worker's, or a restart's.
+  epoch: str
+  gzip_level: int
+  builds: int
+  # Requests answered with the body, and with 304 Not Modified.
+  served: int
+  not_modified: int
+  _body: bytes | None
+  _gzipped: bytes | None
+  _built_version: int | None
+
+  def __init__(self, feed: DashboardFeed, *, gzip_level: int = 6) -> None:
+    self.fragments = {name: self._encode(name, card) for name, card in feed.cards.items()}
+    self.version = 0
+    self.epoch = secrets.token_hex(4)
+    self.gzip_level = gzip_level
+    self.builds = 0
+    self.served = 0
+    self.not_modified = 0
+    self._body = None
+    self._gzipped = None
+    self._built_version = None
+    feed.listeners.append(self.changed)
+
+  @staticmethod
+  def _encode(name: str, card: dict) -> bytes:
+    return codec.dumps(name) + b":" + codec.dumps(card)
+
+  def changed(self, name: str, card: dict | None) -> None:
+    if card is None:
+      self.fragments.pop(name, None)
+    else:
+      self.fragments[name] = self._encode(name, card)
+    self.version += 1
+
+  @property
+  def etag(self) -> str:
+    return f'"{self.epoch}-{self.version}"'
+
+  def _build(self) -> None:
+    if self._built_version == self.version:
+      return
+    self._body = b"{" + b",".join(self.fragments.values()) + b"}"
+    self._gzipped = None
+    self._built_version = self.version
+    self.builds += 1
+
+  def body(self) -> bytes:
+    self._build()
+    return self._body
+
+  def gzipped(self) -> bytes:
+    self._build()
+    if self._gzipped is None:
+      self._gzipped = gzip.compress(self._body, self.gzip_level)
+    return self._gzipped
+
+  def metrics(self) -> dict:
+    return {
+      "version": self.version,
+      "machines": len(self.fragments),
+      "builds": self.builds,
+      "served": self.served,
+      "not_modified": self.not_modified,
+      "bytes": None if self._body is None else len(self._body),
+      "gzip_bytes": None if self._gzipped is None else len(self._gzipped),
+    }
@@ -0,0 +1,202 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import logging
+import time
+
+import asyncpg
+
+from .admission import WINDOW, DecayingCounter
+
+LOG = logging.getLogger(__name__)
+
+# Worth trying the batch again later, the database or the connection is the
+# problem, not the rows.
+TRANSIENT_ERRORS = (
+  OSError,
+  TimeoutError,
+  asyncpg.InterfaceError,
+  asyncpg.PostgresConnectionError,
+  asyncpg.CannotConnectNowError,
+  asyncpg.TooManyConnectionsError,
+)
+# Some rows will never go in, like ones for a machine deleted while they were
+# buffered. The batch is split until they are found, and they are dropped.
+BAD_ROW_ERRORS = (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError)
+
+
+class StatsWriter:
+  """Buffers rows in memory and writes them with COPY in batches.
+
+  A batch is flushed once `batch_size` rows are waiting or `interval` seconds
+  have passed, whichever comes first. When `max_buffered` rows are waiting
+  (the database is slow or down) writers wait for room, and give up on their
+  row after `max_wait` seconds so ingest can't stall forever.
+
+  Only connection and transient errors are retried. Rows the table rejects
+  are isolated and dropped, so one bad row can't hold up the rest."""
+
+  pool: asyncpg.Pool
+  table: str
+  columns: tuple[str, ...]
+  batch_size: int
+  interval: float
+  max_buffered: int
+  max_wait: float
+  buffer: list[tuple]
+  task: asyncio.Task | None
+  rows_written: int
+  rows_dropped: int
+  flushes: int
+  failures: int
+  # (rows, seconds) of the last few flushes
+  recent_flushes: collections.deque[tuple[int, float]]
+  _written_recently: DecayingCounter
+  _flush_requested: asyncio.Event
+  _room: asyncio.Condition
+  _flush_lock: asyncio.Lock
+
+  def __init__(
+    self,
+    pool: asyncpg.Pool,
+    table: str,
+    columns: tuple[str, ...],
+    *,
+    batch_size: int = 1000,
+    interval: float = 1,
+    max_buffered: int = 50000,
+    max_wait: float = 5,
+  ) -> None:
+    self.pool = pool
+    self.table = table
+    self.columns = columns
+    self.batch_size = batch_size
+    self.interval = interval
+    self.max_buffered = max(batch_size, max_buffered)
+    self.max_wait = max_wait
+    self.buffer = []
+    self.task = None
+    self.rows_written = 0
+    self.rows_dropped = 0
+    self.flushes = 0
+    self.failures = 0
+    self.recent_flushes = collections.deque(maxlen=100)
+    self._written_recently = DecayingCounter()
+    self._flush_requested = asyncio.Event()
+    self._room = asyncio.Condition()
+    self._flush_lock = asyncio.Lock()
+
+  def start(self) -> None:
+    self.task = asyncio.create_task(self._run())
+
+  async def close(self) -> None:
+    "Stop the background task and write whatever is still buffered."
+    if self.task is not None:
+      self.task.cancel()
+      await asyncio.gather(self.task, return_exceptions=True)
+      self.task = None
+    while self.buffer:
+      if not await self.flush():
+        LOG.error(f"[WRITER] Lost {len(self.buffer)} rows on shutdown")
+        self.rows_dropped += len(self.buffer)
+        self.buffer.clear()
+
+  async def write(self, row: tuple) -> bool:
+    "Queue a row. Returns False if it was dropped because the buffer stayed full."
+    if len(self.buffer) >= self.max_buffered:
+      try:
+        async with asyncio.timeout(self.max_wait), self._room:
+          await self._room.wait_for(lambda: len(self.buffer) < self.max_buffered)
+      except TimeoutError:
+        self.rows_dropped += 1
+        return False
+    self.buffer.append(row)
+    if len(self.buffer) >= self.batch_size:
+      self._flush_requested.set()
+    return True
+
+  async def _run(self) -> None:
+    while True:
+      try:
+        async with asyncio.timeout(self.interval):
+          await self._flush_requested.wait()
+      except TimeoutError:
+        pass
+      self._flush_requested.clear()
+      if self.buffer and not await self.flush():
+        # Back off instead of hammering a database that is struggling.
+        await asyncio.sleep(self.interval)
+
+  async def _copy(self, rows: list[tuple]) -> None:
+    async with self.pool.acquire() as conn:
+      conn: asyncpg.Connection
+      await conn.copy_records_to_table(self.table, records=rows, columns=self.columns)
+
+  async def flush(self) -> bool:
+    """Write one batch. Returns False if it hit a transient error, the rows that
+    weren't written then go back to the front of the buffer."""
+    async with self._flush_lock:
+      batch = self.buffer[: self.batch_size]
+      if not batch:
+        return True
+      del self.buffer[: len(batch)]
+      started = time.perf_counter()
+      written = 0
+      # Rows left to write, the last chunk goes next.
+      chunks = [batch]
+      try:
+        while chunks:
+          chunk = chunks.pop()
+          try:
+            await self._copy(chunk)
+          except TRANSIENT_ERRORS:
+            LOG.exception(f"[WRITER] Failed to write {len(chunk)} rows to {self.table}")
+            self.failures += 1
+            self.buffer[:0] = [row for rows in (chunk, *reversed(chunks)) for row in rows]
+            return False
+          except BAD_ROW_ERRORS as e:
+            if chunk is batch:
+              self.failures += 1
+            if len(chunk) > 1:
+              middle = len(chunk) // 2
+              chunks.append(chunk[middle:])
+              chunks.append(chunk[:middle])
+            else:
+              self.rows_dropped += 1
+              LOG.warning(f"[WRITER] Dropped a row {self.table} rejected: {e}")
+            continue
+          except Exception:
+            LOG.exception(f"[WRITER] Dropped {len(chunk)} rows {self.table} can't take")
+            self.failures += 1
+            self.rows_dropped += len(chunk)
+            continue
+          written += len(chunk)
+      finally:
+        async with self._room:
+          self._room.notify_all()
+
+      self.flushes += 1
+      self.rows_written += written
+      self._written_recently.add(written)
+      self.recent_flushes.append((written, time.perf_counter() - started))
+      if len(self.buffer) >= self.batch_size:
+        self._flush_requested.set()
+      return True
+
+  def metrics(self) -> dict:
+    sizes = [size for size, _ in self.recent_flushes]
+    latencies = [latency * 1000 for _, latency in self.recent_flushes]
+    return {
+      "buffered": len(self.buffer),
+      "max_buffered": self.max_buffered,
+      "rows_written": self.rows_written,
+      "rows_dropped": self.rows_dropped,
+      "rows_per_second": round(self._written_recently.get() / WINDOW, 2),
+      "flushes": self.flushes,
+      "failures": self.failures,
+      "batch_size_avg": round(sum(sizes) / len(sizes), 1) if sizes else None,
+      "batch_size_max": max(sizes, default=None),
+      "flush_ms_avg": round(sum(latencies) / len(latencies), 2) if latencies else None,
+      "flush_ms_max": round(max(latencies), 2) if latencies else None,
+    }
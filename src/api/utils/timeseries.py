@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import asyncio
+import datetime
+import logging
+from typing import TYPE_CHECKING
+
+from utils import codec
+
+from .recent import as_number
+
+if TYPE_CHECKING:
+  import asyncpg
+
+  from .data_classes import MonitorPacket
+
+LOG = logging.getLogger(__name__)
+
+# MachineStats is range partitioned on Time, see schema.sql. Typed columns
+# for the stats every client sends, JSONB for whatever plugins add.
+TABLE = "machinestats"
+COLUMNS = (
+  "machineid",
+  "time",
+  "cpu1m",
+  "cpu5m",
+  "cpu15m",
+  "ramused",
+  "ramtotal",
+  "diskused",
+  "disktotal",
+  "netin",
+  "netout",
+  "extras",
+)
+
+INTERVALS = ("day", "month")
+
+# Columns rolled up into the 1m/1h/1d tiers, the tiers use them as metric names.
+METRICS = ("cpu1m", "cpu5m", "cpu15m", "ramused", "diskused", "netin", "netout")
+
+
+def _integer(value: object) -> int | None:
+  number = as_number(value)
+  return None if number is None else int(number)
+
+
+def stats_row(
+  machine_id: int,
+  timestamp: datetime.datetime,
+  packet: MonitorPacket,
+  extras: dict | None,
+) -> tuple:
+  "One MachineStats row, in COLUMNS order."
+  cpu = ram = disk = current = {}
+  if packet.stats_valid:
+    cpu = packet.cpu or {}
+    ram = packet.ram or {}
+    disk = packet.disk or {}
+    current = packet.internet.current or {}
+  return (
+    machine_id,
+    timestamp,
+    as_number(cpu.get("1m")),
+    as_number(cpu.get("5m")),
+    as_number(cpu.get("15m")),
+    _integer(ram.get("used")),
+    _integer(ram.get("total")),
+    _integer(disk.get("used")),
+    _integer(disk.get("total")),
+    as_number(current.get("incoming")),
+    as_number(current.get("outgoing")),
+    codec.dumps_str(extras) if extras else None,
+  )
+
+
+def partition_bounds(
+  moment: datetime.datetime, interval: str
+) -> tuple[datetime.datetime, datetime.datetime, str]:
+  "The (start, end, name) of the partition holding `moment`, in UTC."
+  moment = moment.astimezone(datetime.UTC)
+  if interval == "day":
+    start = moment.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = start + datetime.timedelta(days=1)
+    name = f"{TABLE}_p{start:%Y_%m_%d}"
+  elif interval == "month":
+    start = moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    name = f"{TABLE}_p{start:%Y_%m}"
+  else:
+    raise ValueError(f"partition interval must be one of {INTERVALS}")
+  return start, end, name
+
+
+def partition_range(name: str) -> tuple[datetime.datetime, datetime.datetime] | None:
+  "(start, end) of a partition named by partition_bounds, None for anything else."
+  suffix = name.lower().removeprefix(f"{TABLE}_p")
+  for interval, pattern in (("day", "%Y_%m_%d"), ("month", "%Y_%m")):
+    try:
+      start = datetime.datetime.strptime(suffix, pattern).replace(tzinfo=datetime.UTC)
+    except ValueError:
+      continue
+    return partition_bounds(start, interval)[:2]
+  return None
+
+
+async def ensure_partitions(
+  conn: asyncpg.Connection, *, interval: str = "month", ahead: int = 2
+) -> list[str]:
+  """Create the current partition and `ahead` more after it.
+
+  They have to exist before their first row arrives. Rows landing in the
+  default partition would stop the real one being created later."""
+  created = []
+  moment = datetime.datetime.now(datetime.UTC)
+  for _ in range(ahead + 1):
+    start, end, name = partition_bounds(moment, interval)
+    exists = await conn.fetchval("SELECT to_regclass($1) IS NOT NULL;", name)
+    if not exists:
+      await conn.execute(
+        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {TABLE} "
+        f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}');"
+      )
+      created.append(name)
+    moment = end
+  return created
+
+
+async def maintain_partitions(
+  pool: asyncpg.Pool, *, interval: str = "month", ahead: int = 2
+) -> None:
+  "Keep partitions created ahead of time. Run on one worker only."
+  while True:
+    try:
+      async with pool.acquire() as conn:
+        created = await ensure_partitions(conn, interval=interval, ahead=ahead)
+      for name in created:
+        LOG.info(f"[TIMESERIES] Created partition {name}")
+    except Exception:
+      LOG.exception("[TIMESERIES] Failed to create partitions")
+    await asyncio.sleep(6 * 60 * 60)
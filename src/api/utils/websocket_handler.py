@@ -1,22 +1,35 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import time
 from typing import TYPE_CHECKING
 
+from .admission import reconnect_delays
 from .data_classes import BasicMachineStats, ConnectedMachine, MonitorPacket
+from .fanout import FanOut
+from .feed import DashboardFeed, machine_card
+from .fleet_index import FleetIndex
+from .ingest import IngestPipeline
+from .liveness import LivenessTracker
+from .plugin_timing import PluginTimings
+from .recent import extract_sample
+from .script_engine import ScriptEngine
+from .snapshot import FleetSnapshot
 
 if TYPE_CHECKING:
+  from collections.abc import Callable
   from logging import Logger
 
   from aiohttp import WSMessage
   from aiohttp.web import WebSocketResponse
-  from asyncpg import Connection
 
   from utils.extra_request import Application
 
+  from .cluster import Cluster
   from .data_classes import Plugin, Script
+  from .fanout import FanOutJob
+  from .machine_registry import MachineRecord
+  from .wire import WireFormat
 
 
 class WebsocketHandler:
@@ -26,41 +39,184 @@ class WebsocketHandler:
   current_stats: dict[str, BasicMachineStats]
   # A dictionary of all available plugins for a machine.
   app: Application
-  # Task to check which websockets are alive.
-  living_socket_task: asyncio.Task
-  # Handle packet tasks that are running
-  handle_packet_tasks: list[asyncio.Task]
+  # Marks machines offline once their heartbeat deadline passes.
+  liveness: LivenessTracker
+  liveness_task: asyncio.Task
+  # Called with (machine, online) whenever a machine goes online or offline.
+  state_listeners: list[Callable[[ConnectedMachine, bool], None]]
+  # Called with (machine, has_warnings) whenever a machine gains its first
+  # warning or loses its last one.
+  warning_listeners: list[Callable[[ConnectedMachine, bool], None]]
+  # Seconds without a packet before a machine is considered offline.
+  heartbeat_timeout: float
+  # Per-machine packet queues and the workers that drain them
+  ingest: IngestPipeline
+  # Counters for the delta protocol
+  delta_stats: dict[str, int]
+  # Time limits and timings for plugin code, run once per packet
+  plugin_timings: PluginTimings
+  # Runs scripts in priority stages, with a timeout per script
+  scripts: ScriptEngine
+  # Runs fleet-wide commands with bounded concurrency
+  fanout: FanOut
+  # The other worker processes, which hold the rest of the fleet
+  cluster: Cluster
+  # Pushes machine changes to open dashboards
+  feed: DashboardFeed
+  # /machines/get/all/, encoded ahead of time
+  snapshot: FleetSnapshot
+  # Machines by category, online and warning state, for filtered reads
+  index: FleetIndex
   # Logging instance
   log: Logger
 
   def __init__(self, app: Application) -> None:
     self.connected_machines = {}
     self.current_stats = {}
-    self.handle_packet_tasks = []
     self.app = app
     self.log = app.LOG
 
+    ingest_config: dict = app.config.srv.ingest or {}
+    self.ingest = IngestPipeline(
+      self._handle_packet,
+      workers=ingest_config.get("workers", 8),
+      queue_size=ingest_config.get("queue_size", 4),
+      policy=ingest_config.get("policy", "coalesce"),
+    )
+    app.metrics["ingest"] = self.ingest.metrics
+
+    self.delta_stats = {"keyframes": 0, "deltas": 0, "resyncs": 0}
+    app.metrics["delta"] = lambda: dict(self.delta_stats)
+
+    plugins_config: dict = app.config.srv.plugins or {}
+    self.plugin_timings = PluginTimings(
+      timeout=plugins_config.get("timeout", 0.5),
+      budget=plugins_config.get("budget", 2),
+    )
+    app.metrics["plugins"] = self.plugin_timings.metrics
+    scripts_config: dict = app.config.srv.scripts or {}
+    self.scripts = ScriptEngine(timeout=scripts_config.get("timeout", 5))
+    app.metrics["scripts"] = self.scripts.metrics
+
+    fanout_config: dict = app.config.srv.fanout or {}
+    self.fanout = FanOut(
+      concurrency=fanout_config.get("concurrency", 64),
+      timeout=fanout_config.get("timeout", 5),
+      keep_jobs=fanout_config.get("keep_jobs", 50),
+    )
+    app.metrics["fanout"] = self.fanout.metrics
+
+    liveness_config: dict = app.config.srv.liveness or {}
+    self.heartbeat_timeout = app.status_config.UPDATE_FREQUENCY * liveness_config.get(
+      "missed_heartbeats", 2
+    )
+    self.liveness = LivenessTracker(self._machine_expired)
+    self.state_listeners = [app.fleet_counters.online_changed]
+    self.warning_listeners = [app.fleet_counters.warning_changed]
+    app.metrics["liveness"] = self.liveness.metrics
+
+    self.cluster = app.cluster
+    self.cluster.register("owns", self._owns)
+    self.cluster.register("names", self._names)
+    self.cluster.register("get", self.get_data)
+    self.cluster.register("command", self._local_command)
+    self.cluster.register("job", self._job_report)
+    self.cluster.register("recent", self.get_recent)
+
+    feed_config: dict = app.config.srv.feed or {}
+    self.feed = DashboardFeed(
+      app.machine_registry, self.cluster, queue_size=feed_config.get("queue_size", 64)
+    )
+    self.state_listeners.append(lambda cm, online: self._feed_changed(cm))
+    self.warning_listeners.append(lambda cm, has_warnings: self._feed_changed(cm))
+    app.metrics["feed"] = self.feed.metrics
+    snapshot_config: dict = app.config.srv.snapshot or {}
+    self.snapshot = FleetSnapshot(
+      self.feed, gzip_level=snapshot_config.get("gzip_level", 6)
+    )
+    app.metrics["snapshot"] = self.snapshot.metrics
+    self.index = FleetIndex(self.feed)
+    app.machine_registry.listeners.append(self._registry_changed)
+
   async def setup(self) -> None:
-    self.living_socket_task = asyncio.create_task(self._check_living_sockets())
+    self.liveness_task = asyncio.create_task(self.liveness.run())
+    self.ingest.start()
 
   async def close(self) -> None:
-    names = [cm.name for cm in self.connected_machines.values()]
-    for name in names:
+    # The server is going away, probably to restart. Bring the fleet back
+    # at the rate the handshake endpoints will admit it.
+    delays = self.reconnect_delays(list(self.connected_machines), after=5)
+    job = await self.fanout.run(
+      "shutdown",
+      list(delays),
+      lambda name: self.reconnect_machine(name, reconnect_after=delays[name]),
+    )
+    for name, result in job.results.items():
+      if result != "ok":
+        self.app.LOG.error(f"Failed to disconnect {name}: {result}")
+    self.liveness_task.cancel()
+    await self.ingest.close()
+
+  def _set_online(self, cm: ConnectedMachine, online: bool) -> None:
+    "Record an online/offline transition and tell every listener about it."
+    if cm.online == online:
+      return
+    cm.online = online
+    self.log.info(f"[WSH][{cm.name}] is now {'online' if online else 'offline'}")
+    for listener in self.state_listeners:
       try:
-        await self.remove_machine(name)
+        listener(cm, online)
       except Exception:
-        self.app.LOG.error(f"Failed to disconnect {name}")
-    self.living_socket_task.cancel()
-
-  async def _check_living_sockets(self) -> None:
-    while True:
-      for cm in self.connected_machines.values():
-        # It is offline if the WS is closed, or it hasn't talked in 10 minutes.
-        is_online = (
-          not cm.ws.closed and cm.last_communication > time.time() - 600
-        )
-        cm.online = is_online
-      await asyncio.sleep(1)
+        self.log.exception(f"[WSH][{cm.name}] state listener failed")
+
+  def warnings_changed(self, cm: ConnectedMachine) -> None:
+    "Called by a machine when its warnings go from none to some or back."
+    if self.connected_machines.get(cm.name) is not cm:
+      # A script still running for a machine that has since been replaced.
+      return
+    self._notify_warnings(cm, bool(cm._warnings))
+
+  def _notify_warnings(self, cm: ConnectedMachine, has_warnings: bool) -> None:
+    for listener in self.warning_listeners:
+      try:
+        listener(cm, has_warnings)
+      except Exception:
+        self.log.exception(f"[WSH][{cm.name}] warning listener failed")
+
+  def _feed_changed(self, cm: ConnectedMachine) -> None:
+    if self.connected_machines.get(cm.name, cm) is not cm:
+      # The copy a reconnect replaced, the new one speaks for the machine.
+      return
+    self.feed.machine_changed(cm)
+
+  def _registry_changed(self, old: MachineRecord | None, new: MachineRecord | None) -> None:
+    "Hand edits made through the API to the machine, if it's connected here."
+    if new is None:
+      return
+    cm = self.connected_machines.get(new.name)
+    if cm is not None and cm.extra_config != new.extra_config:
+      cm.fill_data(new)
+
+  def _machine_expired(self, machine_name: str) -> None:
+    cm = self.connected_machines.get(machine_name)
+    if cm is not None:
+      self._set_online(cm, False)
+
+  def _heartbeat(self, cm: ConnectedMachine) -> None:
+    cm.last_communication = time.time()
+    if cm.ws.closed:
+      # A packet still queued from before the socket went away.
+      return
+    self.liveness.touch(cm.name, self.heartbeat_timeout)
+    self._set_online(cm, True)
+
+  def socket_closed(self, machine_name: str, ws: WebSocketResponse) -> None:
+    "Called when a machine's read loop ends, however it ended."
+    cm = self.connected_machines.get(machine_name)
+    # The machine may already have reconnected on a new socket.
+    if cm is not None and cm.ws is ws:
+      self.liveness.forget(machine_name)
+      self._set_online(cm, False)
 
   async def add_machine(
     self,
@@ -68,50 +224,67 @@ class WebsocketHandler:
     ws: WebSocketResponse,
     plugins: list[Plugin],
     scripts: list[Script],
+    wire: WireFormat,
   ) -> None:
     self.log.debug(f"[WSH][{machine_name}] called add_machine")
     cm = ConnectedMachine(
-      ws=ws, plugins=plugins, name=machine_name, app=self.app, scripts=scripts
+      ws=ws,
+      plugins=plugins,
+      name=machine_name,
+      app=self.app,
+      scripts=scripts,
+      wire=wire,
     )
-    cm.online = True
     self.log.debug(f"[WSH][{machine_name}] instantiated connectedmachine")
 
-    async with self.app.pool.acquire() as conn:
-      conn: Connection
-      self.log.debug(f"[WSH][{machine_name}] got connection")
-      record = await conn.fetchrow(
-        "SELECT * FROM Machines WHERE Name ILIKE $1;", machine_name
-      )
-      self.log.debug(f"[WSH][{machine_name}] filling data")
-      cm.fill_data(record)
-      self.log.debug(f"[WSH][{machine_name}] finished filling")
+    record = self.app.machine_registry.get(machine_name)
+    cm.fill_data(record)
+    self.log.debug(f"[WSH][{machine_name}] filled data from registry")
 
+    old = self.connected_machines.get(machine_name)
+    if old is not None:
+      self._set_online(old, False)
+      self._notify_warnings(old, False)
+      # A reconnect shouldn't wipe the machine's sparklines.
+      cm.recent = old.recent
     self.connected_machines[machine_name] = cm
+    self._heartbeat(cm)
     self.log.debug(f"[WSH][{machine_name}] inserted into cm dict")
 
-  async def remove_machine(self, machine_name: str) -> None:
-    if machine_name in self.connected_machines:
-      cm = self.connected_machines[machine_name]
-      await cm.ws.send_json(
-        {"type": "goodbye", "data": {"reconnect_after": "never"}, "error": 0}
-      )
+  async def _close_machine(self, machine_name: str, packet: dict) -> bool:
+    """Send a final packet and close the socket, within the fan-out timeout.
+
+    The machine is forgotten straight away, so a stuck socket can't be picked
+    up again by another command while it times out."""
+    cm = self.connected_machines.pop(machine_name, None)
+    if cm is None:
+      return False
+    self.ingest.forget(machine_name)
+    self.liveness.forget(machine_name)
+    self._set_online(cm, False)
+    self._notify_warnings(cm, False)
+    async with asyncio.timeout(self.fanout.timeout):
+      await cm.send(packet)
       await cm.ws.close()
-      self.connected_machines.pop(machine_name)
+    return True
+
+  async def remove_machine(self, machine_name: str) -> bool:
+    return await self._close_machine(
+      machine_name,
+      {"type": "goodbye", "data": {"reconnect_after": "never"}, "error": 0},
+    )
 
   async def reconnect_machine(
-    self, machine_name: str, *, reconnect_after: int = 5
-  ) -> None:
-    if machine_name in self.connected_machines:
-      cm = self.connected_machines[machine_name]
-      await cm.ws.send_json(
-        {
-          "type": "goodbye",
-          "data": {"reconnect_after": reconnect_after},
-          "error": 0,
-        }
-      )
-      await cm.ws.close()
-      self.connected_machines.pop(machine_name)
+    self, machine_name: str, *, reconnect_after: float = 5
+  ) -> bool:
+    return await self._close_machine(
+      machine_name,
+      {
+        "type": "goodbye",
+        "data": {"reconnect_after": reconnect_after},
+        "error": 0,
+      },
+    )
 
   async def _handle_packet(self, machine_name: str, message: WSMessage) -> None:
     self.app.LOG.info(
@@ -123,27 +296,47 @@ class WebsocketHandler:
     cm = self.connected_machines[machine_name]
     try:
       raw_data = message.data
-      if raw_data is None or not isinstance(raw_data, str):
+      if raw_data is None or not isinstance(raw_data, (str, bytes)):
         self.app.LOG.warning(
           f"raw packet from {machine_name} is not correct type; it is {type(raw_data)}"
         )
         return
-      data = json.loads(raw_data)
+      data = cm.wire.decode(message)
     except Exception:
-      print("Failed parsing data packet from", machine_name)
+      self.log.exception(f"[WSH][{machine_name}] failed parsing data packet")
       return
 
-    cm.last_communication = time.time()
+    self._heartbeat(cm)
 
     # This is a top level packet, so we'll have type, error, and data.
     packet_type = data.get("type")
     packet_data = data.get("data")
+    if packet_type == "monitor" and "seq" in data:
+      # Keyframe from a client speaking the delta protocol.
+      self.delta_stats["keyframes"] += 1
+      packet_data = cm.delta.keyframe(data["seq"], packet_data)
+    elif packet_type == "monitor_delta":
+      self.delta_stats["deltas"] += 1
+      packet_data = cm.delta.apply(data.get("seq"), packet_data)
+      if packet_data is None:
+        # Missed or dropped a packet, the rebuilt state can't be trusted.
+        if not cm.delta.awaiting_keyframe:
+          cm.delta.awaiting_keyframe = True
+          self.delta_stats["resyncs"] += 1
+          self.log.info(f"[WSH][{machine_name}] delta gap, requesting resync")
+          await cm.send({"type": "resync", "error": 0})
+        return
+      packet_type = "monitor"
+
     if packet_type == "monitor":
       mp = MonitorPacket(packet_data, log=self.log)
-      await mp.process_extras(cm.plugins, cm)
-      await mp.run_scripts(cm.scripts, cm)
+      previous = cm.stats.latest_packet if hasattr(cm, "stats") else None
+      await mp.process(cm.plugins, cm, timings=self.plugin_timings, previous=previous)
+      await self.scripts.run(cm.scripts, mp, cm)
       cm.last_communication = time.time()
       cm.stats = BasicMachineStats(mp)
+      cm.recent.add(cm.last_communication, extract_sample(mp))
+      self.feed.local_update(machine_card(cm))
     # self.app.LOG.info(f"Received packet from {cm.name}")
 
   def get_stats(self, name: str) -> BasicMachineStats:
@@ -170,49 +363,172 @@ class WebsocketHandler:
     if not hasattr(cm, "stats"):
       packet["data"] = "invalid stats"
     else:
-      packet["data"] = await cm.stats.latest_packet.out(cm.plugins, cm)
+      packet["data"] = cm.stats.latest_packet.current(cm)
     return packet
 
-  async def get_all_data(self) -> dict[str, dict]:
-    out = {}
-    for machine_name in self.connected_machines.keys():
-      try:
-        async with asyncio.timeout(0.05):
-          out[machine_name] = await self.get_data(machine_name)
-      except asyncio.TimeoutError:
-        self.app.LOG.warning(
-          f"{machine_name} took longer than 50ms to get_data!"
-        )
+  async def find_data(self, name: str) -> dict | None:
+    "Like get_data, but asks the other workers when this one isn't holding it."
+    packet = await self.get_data(name)
+    if _online(packet):
+      return packet
+    for reply in (await self.cluster.broadcast("get", name=name)).values():
+      if _online(reply):
+        return reply
+      packet = packet or reply
+    return packet
 
-    async with self.app.pool.acquire() as conn:
-      conn: Connection
-      all_machines = await conn.fetch("SELECT * FROM Machines;")
-      for record in all_machines:
-        if record.get("name") not in out:
-          out[record.get("name")] = {
-            "name": record.get("name"),
-            "category": record.get("category"),
-            "warning": [],
-            "data": {"online": False, "stats": "invalid stats"},
-          }
-    return out
-
-  async def update_client(self, machine_name: str) -> bool:
-    if machine_name in self.connected_machines:
-      cm = self.connected_machines[machine_name]
-      await cm.ws.send_json(
-        {
-          "type": "updateclient",
-          "error": 0,
-        }
-      )
-      await cm.ws.close()
-      self.connected_machines.pop(machine_name)
-      return True
-    return False
-
-  async def update_all_clients(self) -> bool:
-    names = [cm.name for cm in self.connected_machines.values()]
-    for name in names:
-      await self.update_client(name)
+  def get_recent(
+    self, name: str, fields: list[str] | None = None, points: int | None = None
+  ) -> dict | None:
+    cm = self.connected_machines.get(name)
+    if cm is None:
+      return None
+    return cm.recent.out(fields, points)
+
+  async def find_recent(
+    self, name: str, fields: list[str] | None = None, points: int | None = None
+  ) -> dict | None:
+    "Recent samples from whichever worker holds the machine."
+    if self._owns(name) or self.cluster.workers == 1:
+      return self.get_recent(name, fields, points)
+    replies = await self.cluster.broadcast(
+      "recent", name=name, fields=fields, points=points
+    )
+    local = self.get_recent(name, fields, points)
+    for reply in replies.values():
+      # Copies left behind on other workers stop growing, take the longest.
+      if reply is not None and (local is None or len(reply["time"]) > len(local["time"])):
+        local = reply
+    return local
+
+  def _owns(self, name: str) -> bool:
+    cm = self.connected_machines.get(name)
+    return cm is not None and cm.online
+
+  def _names(self) -> dict[str, bool]:
+    return {name: cm.online for name, cm in self.connected_machines.items()}
+
+  @property
+  def command_timeout(self) -> float:
+    """Seconds another worker gets for a command or job report. Closing a
+    socket there can take the whole fan-out timeout, so the call waits that
+    plus the usual cluster timeout. A stuck socket is then reported as a
+    timeout by the worker that holds it, not as that worker timing out."""
+    return self.fanout.timeout + self.cluster.timeout
+
+  def _job_report(self, job_id: str) -> dict | None:
+    job = self.fanout.get(job_id)
+    return None if job is None else job.report()
+
+  async def find_owner(self, name: str) -> int | None:
+    "The worker holding an online machine's connection, None if none is."
+    if self._owns(name):
+      return self.cluster.worker_id
+    for worker_id, owns in (await self.cluster.broadcast("owns", name=name)).items():
+      if owns:
+        return worker_id
+    return None
+
+  async def fleet_owners(self) -> dict[str, int]:
+    "Every connected machine on any worker -> the worker holding it."
+    replies = await self.cluster.broadcast("names")
+    replies[self.cluster.worker_id] = self._names()
+    owners: dict[str, int] = {}
+    online: set[str] = set()
+    for worker_id, names in replies.items():
+      for name, is_online in names.items():
+        # A machine that moved worker leaves an offline copy behind.
+        if name not in online and (is_online or name not in owners):
+          owners[name] = worker_id
+          if is_online:
+            online.add(name)
+    return owners
+
+  async def find_job(self, job_id: str) -> dict | None:
+    report = self._job_report(job_id)
+    if report is not None:
+      return report
+    replies = await self.cluster.broadcast(
+      "job", timeout=self.command_timeout, job_id=job_id
+    )
+    for reply in replies.values():
+      if reply is not None:
+        return reply
+    return None
+
+  def clear_warnings(self, machine_name: str) -> bool:
+    cm = self.connected_machines.get(machine_name)
+    if cm is None:
+      return False
+    cm.clear_warnings()
     return True
+
+  async def _local_command(
+    self, action: str, name: str, *, reconnect_after: float = 5
+  ) -> bool:
+    if action == "disconnect":
+      return await self.remove_machine(name)
+    if action == "reconnect":
+      return await self.reconnect_machine(name, reconnect_after=reconnect_after)
+    if action == "updateclient":
+      return await self.update_client(name, reconnect_after=reconnect_after)
+    if action == "clearwarnings":
+      return self.clear_warnings(name)
+    raise ValueError(f"unknown command {action!r}")
+
+  async def command(self, worker_id: int, action: str, name: str, **kwargs) -> bool:
+    "Run a machine command on the worker holding the machine."
+    return await self.cluster.call(
+      worker_id,
+      "command",
+      timeout=self.command_timeout,
+      action=action,
+      name=name,
+      **kwargs,
+    )
+
+  def reconnect_delays(
+    self,
+    names: list[str],
+    *,
+    after: float,
+    spread: float | None = None,
+    mode: str = "spread",
+  ) -> dict[str, float]:
+    "Per-machine delays for fleet commands. Default spread matches admission."
+    if spread is None:
+      # Every worker admits its share of the handshakes.
+      spread = len(names) / (self.app.admission.rate * self.cluster.workers)
+    return reconnect_delays(names, after=after, spread=spread, mode=mode)
+
+  async def update_client(
+    self, machine_name: str, *, reconnect_after: float = 0
+  ) -> bool:
+    return await self._close_machine(
+      machine_name,
+      {
+        "type": "updateclient",
+        "data": {"reconnect_after": reconnect_after},
+        "error": 0,
+      },
+    )
+
+  async def update_all_clients(
+    self, *, spread: float | None = None, mode: str = "spread"
+  ) -> FanOutJob:
+    names = list(self.connected_machines)
+    delays = self.reconnect_delays(names, after=0, spread=spread, mode=mode)
+    return await self.fanout.run(
+      "updateclient",
+      names,
+      lambda name: self.update_client(name, reconnect_after=delays[name]),
+      details={"reconnect_after": delays},
+    )
+
+
+def _online(packet: dict | None) -> bool:
+  return (
+    packet is not None
+    and isinstance(packet.get("data"), dict)
+    and bool(packet["data"].get("online"))
+  )
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import zlib
+from typing import TYPE_CHECKING
+
+from aiohttp import WSMsgType
+
+from utils import codec
+
+if TYPE_CHECKING:
+  from typing import Any
+
+  from aiohttp import WSMessage
+  from aiohttp.web import WebSocketResponse
+
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
+# Everything the server knows how to speak, in order of preference.
+# "json" always works, as it is what clients used before negotiation existed.
+FORMATS: list[str] = ["msgpack", "json"] if msgpack is not None else ["json"]
+# "zlib" compresses each frame's payload, "deflate" is the websocket
+# permessage-deflate extension, negotiated by aiohttp during the handshake.
+COMPRESSIONS: list[str] = ["zlib", "deflate", "none"]
+
+# Guard against decompression bombs. Matches aiohttp's default max_msg_size.
+MAX_DECOMPRESSED_SIZE = 4 * 1024 * 1024
+
+
+class WireFormat:
+  format: str
+  compression: str
+
+  def __init__(self, format: str = "json", compression: str = "none") -> None:
+    if format not in FORMATS:
+      raise ValueError(f"unsupported wire format {format!r}")
+    if compression not in COMPRESSIONS:
+      raise ValueError(f"unsupported compression {compression!r}")
+    self.format = format
+    self.compression = compression
+
+  @property
+  def binary(self) -> bool:
+    return self.format != "json" or self.compression == "zlib"
+
+  def encode(self, data: Any) -> str | bytes:
+    if self.format == "msgpack":
+      payload = msgpack.packb(data)
+    else:
+      payload = codec.dumps(data)
+    if self.compression == "zlib":
+      return zlib.compress(payload)
+    if self.binary:
+      return payload
+    return payload.decode()
+
+  def decode(self, message: WSMessage) -> Any:
+    # Text frames are always plain JSON, so older clients keep working no
+    # matter what was negotiated.
+    if message.type == WSMsgType.TEXT:
+      return codec.loads(message.data)
+    if message.type != WSMsgType.BINARY:
+      raise ValueError(f"cannot decode {WSMsgType(message.type).name} frame")
+
+    payload = message.data
+    if self.compression == "zlib":
+      decompressor = zlib.decompressobj()
+      payload = decompressor.decompress(payload, MAX_DECOMPRESSED_SIZE)
+      if decompressor.unconsumed_tail:
+        raise ValueError("decompressed frame is too large")
+    if self.format == "msgpack":
+      return msgpack.unpackb(payload)
+    return codec.loads(payload)
+
+  async def send(self, ws: WebSocketResponse, data: Any) -> None:
+    encoded = self.encode(data)
+    if isinstance(encoded, bytes):
+      await ws.send_bytes(encoded)
+    else:
+      await ws.send_str(encoded)
+
+  def query(self) -> dict[str, str]:
+    return {"format": self.format, "compression": self.compression}
+
+  def __repr__(self) -> str:
+    return f"WireFormat({self.format!r}, {self.compression!r})"
+
+
+def negotiate(
+  offered_formats: list[str],
+  offered_compressions: list[str],
+  *,
+  formats: list[str] = None,
+  compressions: list[str] = None,
+) -> WireFormat:
+  "Pick the server's most preferred option that the client also offered."
+  if formats is None:
+    formats = FORMATS
+  if compressions is None:
+    compressions = COMPRESSIONS
+
+  chosen_format = next(
+    (f for f in formats if f in FORMATS and f in offered_formats), "json"
+  )
+  chosen_compression = next(
+    (
+      c
+      for c in compressions
+      if c in COMPRESSIONS and c in offered_compressions
+    ),
+    "none",
+  )
+  return WireFormat(chosen_format, chosen_compression)
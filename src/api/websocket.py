@@ -1,24 +1,45 @@
 from __future__ import annotations
 
+import math
+import os
 import urllib.parse
 from typing import TYPE_CHECKING
-import time
 
 from aiohttp import web
 from aiohttp.web import Response, WebSocketResponse, WSMsgType
 from yarl import URL
 
+from utils import codec
+from utils.pg_pool_middleware import no_pool
+
+from .utils.admission import AdmissionController
+from .utils.cluster import TOKEN_SECRET_ENV
+from .utils.connect_token import ConnectTokenSigner
 from .utils.plugins import ALL_PLUGINS, fetch_plugins
 from .utils.scripts import fetch_scripts
 from .utils.websocket_handler import WebsocketHandler
+from .utils.wire import WireFormat, negotiate
 
 if TYPE_CHECKING:
   from utils.extra_request import Request
 
 routes = web.RouteTableDef()
 
+def too_busy(retry_after: float) -> Response:
+  "Tell a client to back off and try the handshake again later."
+  return codec.json_response(
+    {"retry_after": round(retry_after, 2)},
+    status=503,
+    headers={"Retry-After": str(math.ceil(retry_after))},
+  )
+
 @routes.get("/ws/start/")
+@no_pool
 async def get_ws_start(request: Request) -> Response:
+  retry_after = request.app.admission.admit()
+  if retry_after is not None:
+    return too_busy(retry_after)
+
   query = request.query
 
   machine_name = query.get("name", None)
@@ -37,15 +58,11 @@ async def get_ws_start(request: Request) -> Response:
 
   parsed_name = urllib.parse.unquote_plus(machine_name)
   
-  addons_record = await request.conn.fetchrow("SELECT Addons,CollectStats FROM Machines WHERE Name ILIKE $1;", parsed_name)
-  if addons_record is None:
+  machine_record = request.app.machine_registry.get(parsed_name)
+  if machine_record is None:
     return Response(status=400, text="machine not found!")
 
-  database_addons = addons_record.get("addons", [])
-  if database_addons is None:
-    database_addons = []
-
-  addons_list.extend(database_addons)
+  addons_list.extend(machine_record.addons)
   super_list = list(set(addons_list))
   good_list: list[str] = []
   bad_list: list[str] = []
@@ -56,64 +73,127 @@ async def get_ws_start(request: Request) -> Response:
     else:
       bad_list.append(plugin_name)
 
+  # Clients that predate negotiation don't offer anything, and get plain JSON.
+  wire_config: dict = request.app.config.srv.wire or {}
+  wire = negotiate(
+    request.query.get("formats", "json").split(","),
+    request.query.get("compression", "none").split(","),
+    formats=wire_config.get("formats"),
+    compressions=wire_config.get("compression"),
+  )
+
+  # A keyframe interval of 0 tells the client to send full packets only.
+  keyframe_interval = 0
+  if query.get("delta") == "1":
+    delta_config: dict = request.app.config.srv.delta or {}
+    keyframe_interval = delta_config.get("keyframe_interval", 12)
+
   query = {"name":machine_name}
   if good_list:
     query["addons"] = ",".join(good_list)
+  query.update(wire.query())
+  query["token"] = request.app.connect_tokens.issue(
+    {
+      "name": machine_record.name,
+      "id": machine_record.id,
+      "plugins": sorted(good_list),
+      "scripts": machine_record.scripts,
+      "v": machine_record.version,
+      "format": wire.format,
+      "compression": wire.compression,
+    }
+  )
   scheme = "ws" if request.url.scheme == "http" else "wss"
   url = URL.build(scheme=scheme, port=request.url.port, host=request.url.host, path="/api/ws/connect/", query=query)
 
   packet = {
     "url": str(url),
     "update_frequency": request.app.status_config.UPDATE_FREQUENCY,
-    "collect_stats": addons_record.get("collectstats"),
-    "missed_plugins": ",".join(bad_list) # If the server is missing some plugins, let the client know.
+    "collect_stats": machine_record.collect_stats,
+    "missed_plugins": ",".join(bad_list), # If the server is missing some plugins, let the client know.
+    "format": wire.format,
+    "compression": wire.compression,
+    "keyframe_interval": keyframe_interval,
   }
 
-  return web.json_response(packet)
+  return codec.json_response(packet)
 
 @routes.get("/ws/connect/")
+@no_pool
 async def get_ws_connect(request: Request) -> Response:
   query = request.query
 
   machine_name = query.get("name", None)
-  addons = query.get("addons", None)
+  token = query.get("token", None)
 
   request.LOG.debug(f"[WS][{machine_name}] received connect call")
 
-  if addons is not None:
+  if token is not None:
+    # Everything was resolved and signed by /ws/start/, just check it.
     try:
-      addons_list: list[str] = addons.split(",")
-    except Exception:
-      return Response(status=400, text="failed to parse addons list")
+      claims = request.app.connect_tokens.verify(token)
+    except ValueError as e:
+      return Response(status=401, text=str(e))
+
+    parsed_name: str = claims["name"]
+    addons_list: list[str] = claims["plugins"]
+    script_names: list[str] = claims["scripts"]
+    wire = WireFormat(claims["format"], claims["compression"])
+
+    machine_record = request.app.machine_registry.get(parsed_name)
+    if machine_record is None or machine_record.version != claims["v"]:
+      return Response(status=409, text="machine changed, restart handshake")
   else:
-    addons_list = []
+    # Clients that were handed a URL before tokens existed. Nothing checked
+    # them at /ws/start/, so they count against the limit here.
+    retry_after = request.app.admission.admit()
+    if retry_after is not None:
+      return too_busy(retry_after)
+
+    addons = query.get("addons", None)
+    if addons is not None:
+      try:
+        addons_list = addons.split(",")
+      except Exception:
+        return Response(status=400, text="failed to parse addons list")
+    else:
+      addons_list = []
 
-  plugins_list = await fetch_plugins(addons_list, request.app.pool)
-  request.LOG.debug(f"[WS][{machine_name}] {plugins_list}")
+    try:
+      wire = WireFormat(query.get("format", "json"), query.get("compression", "none"))
+    except ValueError as e:
+      return Response(status=400, text=str(e))
 
-  if machine_name is None:
-    return Response(status=400, text="missing name in query")
+    if machine_name is None:
+      return Response(status=400, text="missing name in query")
 
-  parsed_name = urllib.parse.unquote_plus(machine_name)
+    parsed_name = urllib.parse.unquote_plus(machine_name)
 
-  exists = (await request.conn.fetchrow("SELECT EXISTS (SELECT Name) FROM Machines WHERE Name = $1;", parsed_name))["exists"]
+    machine_record = request.app.machine_registry.get(parsed_name)
+    if machine_record is None:
+      return Response(status=400, text="machine not registered")
+    script_names = machine_record.scripts
 
-  if not exists:
-    return Response(status=400, text="machine not registered")
+  plugins_list = await fetch_plugins(addons_list, request.app.pool)
+  request.LOG.debug(f"[WS][{machine_name}] {plugins_list}")
 
-  scripts = await request.conn.fetchrow("SELECT Scripts FROM Machines WHERE Name ILIKE $1;", parsed_name)
-  scripts_list = await fetch_scripts(scripts["scripts"], request.app)
+  scripts_list = await fetch_scripts(script_names, request.app)
 
   request.LOG.debug(f"[WS][{machine_name}] machine exists, websocket it")
 
-  ws = WebSocketResponse(autoclose=False)
+  # aiohttp pings the client and closes the socket if it stops answering,
+  # which ends the read loop below and marks the machine offline.
+  liveness_config: dict = request.app.config.srv.liveness or {}
+  ws = WebSocketResponse(
+    autoclose=False, heartbeat=liveness_config.get("ping_interval", 30) or None
+  )
   await ws.prepare(request)
 
   request.LOG.debug(f"[WS][{machine_name}] prepared websocket")
 
   ws_handler = request.app.websocket_handler
 
-  await ws_handler.add_machine(parsed_name, ws, plugins_list, scripts_list)
+  await ws_handler.add_machine(parsed_name, ws, plugins_list, scripts_list, wire)
 
   request.LOG.debug(f"[WS][{machine_name}] added machine")
 
@@ -121,28 +201,39 @@ async def get_ws_connect(request: Request) -> Response:
     request.LOG.debug(f"raw packet from {machine_name}: {WSMsgType(message.type).name}")
     if message.type in (WSMsgType.CLOSING, WSMsgType.CLOSED):
       break
-    elif message.type != WSMsgType.TEXT:
+    elif message.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
       request.LOG.error(
         f"Received invalid message type {WSMsgType(message.type).name}; {hasattr(message,'data') and message.data or 'no data'}"
       )
-    try:
-      #ws_handler.handle_packet_tasks.append(
-      #  asyncio.create_task(request.app.websocket_handler._handle_packet(parsed_name, message))
-      #)
-      start = time.time()
-      await ws_handler._handle_packet(parsed_name, message)
-      total = time.time() - start
-      request.LOG.info(f"Handling packet for {parsed_name} took {total}s.")
-    except Exception:
-      request.LOG.exception(f"Failed handling packet for {parsed_name}")
+      continue
+    # Processing happens on the ingest workers, so a slow plugin or script
+    # never holds up reading from this socket.
+    ws_handler.ingest.submit(parsed_name, message)
 
+  ws_handler.socket_closed(parsed_name, ws)
   return ws
 
 async def setup(app: web.Application) -> None:
   websocket_handler = WebsocketHandler(app)
+  await websocket_handler.setup()
 
   app.websocket_handler = websocket_handler
 
+  # The limits are for the whole server, each worker admits its share.
+  admission_config: dict = app.config.srv.admission or {}
+  app.admission = AdmissionController(
+    rate=admission_config.get("rate", 50) / app.cluster.workers,
+    burst=admission_config.get("burst", 100) / app.cluster.workers,
+  )
+  app.metrics["admission"] = app.admission.metrics
+
+  token_config: dict = app.config.srv.tokens or {}
+  app.connect_tokens = ConnectTokenSigner(
+    token_config.get("secret") or os.environ.get(TOKEN_SECRET_ENV),
+    ttl=token_config.get("ttl", 60),
+  )
+  app.metrics["connect_tokens"] = app.connect_tokens.metrics
+
   for route in routes:
     app.LOG.info(f"  ↳ {route}")
   app.add_routes(routes)
\ No newline at end of file
@@ -243,10 +243,20 @@ async function pull_config() {
 }
 
 async function setup() {
-  let data;
+  // Only the names are needed for the menu, a page at a time.
+  let data = [];
   try {
-    let request = await fetch("/api/machines/get/all/");
-    data = await request.json();
+    let after = null;
+    do {
+      let url = "/api/machines/list/?fields=names&limit=1000";
+      if (after != null) {
+        url += "&after=" + encodeURIComponent(after);
+      }
+      let request = await fetch(url);
+      let page = await request.json();
+      data.push(...page["machines"]);
+      after = page["next"];
+    } while (after != null);
   } catch (e) {
     console.error(e);
   }
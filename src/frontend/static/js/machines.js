@@ -1,5 +1,12 @@
 let selected_machine = "";
 let open_plugin_tabs = {};
+// Every machine in the selected category, kept up to date by the feed.
+let machines = {};
+let categories = [];
+let machine_cells = {};
+let feed = null;
+let feed_snapshot_callback = null;
+let preview_opened = false;
 
 function remove_children(element) {
   while (element.firstChild) {
@@ -7,17 +14,92 @@ function remove_children(element) {
   }
 }
 
-async function setup_category(data, search_params) {
-  // First we need to get the actual category names
-  let category_names = [];
-  for (let entry of Object.values(data)) {
-    if (!category_names.includes(entry["category"])) {
-      category_names.push(entry["category"])
+function apply_delta(base, delta) {
+  // Same format as the machines' delta protocol, see api/utils/delta.py
+  for (let [path, value] of delta["set"]) {
+    let node = base;
+    for (let key of path.slice(0, -1)) {
+      if (typeof node[key] !== "object" || node[key] === null || Array.isArray(node[key])) {
+        node[key] = {};
+      }
+      node = node[key];
+    }
+    node[path[path.length - 1]] = value;
+  }
+
+  for (let path of delta["unset"]) {
+    let node = base;
+    for (let key of path.slice(0, -1)) {
+      node = node[key];
+      if (typeof node !== "object" || node === null) {
+        break;
+      }
+    }
+    if (typeof node === "object" && node !== null) {
+      delete node[path[path.length - 1]];
     }
   }
-  category_names = category_names.sort().reverse()
+}
+
+function open_feed(on_snapshot) {
+  if (feed != null) {
+    feed.close();
+  }
+  feed_snapshot_callback = on_snapshot || null;
+
+  let search_params = new URLSearchParams(window.location.search);
+  let selected_category = search_params.get("c");
+  let url = "/api/machines/feed/";
+  if (selected_category != null) {
+    url += "?categories=" + encodeURIComponent(selected_category).replace("%20","+");
+  }
+
+  // EventSource reconnects by itself, and every connection starts with a snapshot.
+  feed = new EventSource(url);
+  feed.onmessage = async function(message) {
+    await handle_feed_event(JSON.parse(message.data));
+  };
+}
+
+async function handle_feed_event(event) {
+  let name = event["name"];
+  switch (event["type"]) {
+    case "snapshot":
+      machines = event["machines"];
+      categories = event["categories"];
+      await setup_category();
+      await display_machines();
+      if (feed_snapshot_callback != null) {
+        feed_snapshot_callback();
+        feed_snapshot_callback = null;
+      }
+      break;
+    case "machine":
+      machines[name] = event["data"];
+      await display_machines();
+      break;
+    case "delta":
+      if (name in machines) {
+        apply_delta(machines[name], event["data"]);
+        update_machine(name);
+      }
+      break;
+    case "remove":
+      delete machines[name];
+      await display_machines();
+      break;
+    case "categories":
+      categories = event["data"];
+      await setup_category();
+      break;
+  }
+}
+
+async function setup_category() {
+  let category_names = categories.slice().sort().reverse();
   const menu_list = document.getElementById("menu_list");
 
+  let search_params = new URLSearchParams(window.location.search);
   let selected_category = search_params.get("c")
 
   remove_children(menu_list)
@@ -34,27 +116,29 @@ async function setup_category(data, search_params) {
       const url = new URL(window.location.href);
       url.searchParams.set("c", a.innerText);
       window.history.replaceState(null, null, url);
-      await display_machines();
+      open_feed();
     }
 
     li.appendChild(a);
     menu_list.appendChild(li);
   }
 
-  if (selected_category == null) {
-    let new_params = new URLSearchParams(window.location.search);
-    new_params.set("c", category_names[0]);
-    window.location.search = new_params.toString();
-    await display_machines();
+  if (selected_category == null && category_names.length > 0) {
+    const url = new URL(window.location.href);
+    url.searchParams.set("c", category_names[0]);
+    window.history.replaceState(null, null, url);
+    open_feed();
   }
 }
 
 async function refresh_machines(button) {
   button.classList.add("is-loading");
   button.setAttribute("disabled",true);
-  await display_machines();
-  button.classList.remove("is-loading");
-  button.removeAttribute("disabled");
+  // A new connection starts with a fresh snapshot.
+  open_feed(function() {
+    button.classList.remove("is-loading");
+    button.removeAttribute("disabled");
+  });
 }
 
 async function close_machine_modal() {
@@ -255,42 +339,59 @@ async function toggle_modal_box(element_id) {
   }
 }
 
-async function display_machines() {
-  let data;
-  try {
-    let request = await fetch("/api/machines/get/all/");
-    data = await request.json();
-  } catch (e) {
-    console.error(e);
+function selected_machines() {
+  let search_params = new URLSearchParams(window.location.search);
+  let selected_category = search_params.get("c");
+  let selected = {};
+  for (let [name, machine_info] of Object.entries(machines)) {
+    if (machine_info["category"] == selected_category) {
+      selected[name] = machine_info;
+    }
   }
+  return selected;
+}
 
+function update_stats_title() {
   let search_params = new URLSearchParams(window.location.search);
-
-  await setup_category(data, search_params);
-
   let selected_category = search_params.get("c");
-  let selected_machines = {};
   let online_machines = 0, total_machines = 0;
+  for (let machine_info of Object.values(selected_machines())) {
+    total_machines++;
+    if (machine_info["data"]["online"]) online_machines++;
+  }
 
-  for (let [name, machine_info] of Object.entries(data)) {
-    if (machine_info["category"] == selected_category) {
-      selected_machines[name] = machine_info;
-      total_machines++;
-      if (machine_info["data"]["online"]) online_machines++;
-    }
+  const stats_title = document.getElementById("stats_title");
+  stats_title.innerText = format(stats_title.getAttribute("text"), selected_category, online_machines, total_machines);
+}
+
+function update_machine(name) {
+  // Only the changed machine's cell is rebuilt.
+  let old_cell = machine_cells[name];
+  let machine_info = machines[name];
+  if (old_cell == null || !(name in selected_machines())) {
+    display_machines();
+    return;
   }
+  let cell = create_machine_cell(name, machine_info);
+  old_cell.replaceWith(cell);
+  machine_cells[name] = cell;
+  update_stats_title();
+}
+
+async function display_machines() {
+  let search_params = new URLSearchParams(window.location.search);
 
   // Sort the machines by name
-  selected_machines = Object.keys(selected_machines).sort().reduce(
+  let selected = selected_machines();
+  selected = Object.keys(selected).sort().reduce(
     (obj, key) => { 
-      obj[key] = selected_machines[key]; 
+      obj[key] = selected[key]; 
       return obj;
     }, 
     {}
   );
 
-  const stats_title = document.getElementById("stats_title");
-  stats_title.innerText = format(stats_title.getAttribute("text"), selected_category, online_machines, total_machines);
+  update_stats_title();
 
   const machine_grid = document.getElementById("machine_grid");
 
@@ -298,199 +399,203 @@ async function display_machines() {
     machine_grid.removeChild(machine_grid.lastChild);
   }
 
-  for (let [name, machine_info] of Object.entries(selected_machines)) {
-    const cell = document.createElement("div");
-    cell.classList.add("cell", "box", "is-col-span-2");
-
-    if (machine_info.warning.length > 0) {
-      cell.classList.add("has-background-danger");
-    } else {
-      cell.classList.add("has-background-grey");
-    }
+  machine_cells = {};
+  for (let [name, machine_info] of Object.entries(selected)) {
+    let cell = create_machine_cell(name, machine_info);
+    machine_cells[name] = cell;
+    machine_grid.appendChild(cell);
+  }
 
-    cell.style.width = "fit-content";
-    cell.style.height = "fit-content";
-
-    const top_level = document.createElement("div");
-    top_level.classList.add("level", "mb-0");
-    const top_level_left = document.createElement("div");
-    top_level_left.classList.add("level-left");
-    const top_level_right = document.createElement("div");
-    top_level_right.classList.add("level-right");
-    const top_level_left_item = document.createElement("div");
-    top_level_left_item.classList.add("level-item");
-    const top_level_right_item = document.createElement("div");
-    top_level_right_item.classList.add("level-item", "ml-4");
-
-    top_level.appendChild(top_level_left);
-    top_level.appendChild(top_level_right);
-    top_level_left.appendChild(top_level_left_item);
-    top_level_right.appendChild(top_level_right_item);
-
-
-    const machine_title = document.createElement("h1");
-    machine_title.innerText = name;
-    machine_title.classList.add("title", "is-4");
-    machine_title.style.color = "white";
-
-    const online_icon = document.createElement("iconify-icon");
-    online_icon.setAttribute("icon", "ph:globe");
-    online_icon.setAttribute("width", "2em");
-    online_icon.setAttribute("height", "2em");
-    online_icon.style.color = machine_info["data"]["online"] ? "lime" : "red";
-    online_icon.title = machine_info["data"]["online"] ? "This machine is online" : "This machine is offline";
-
-    top_level_left_item.appendChild(machine_title);
-    top_level_right_item.appendChild(online_icon);
-
-    const hr = document.createElement("hr");
-    hr.classList.add("my-1", "has-background-grey-lighter");
-
-    // Display basic stats if stat monitor is enabled
-    const stats_div = document.createElement("div");
-    if (machine_info["data"]["stats"] != "invalid stats" && machine_info["data"]["stats"] != null) {
-      const stats_level = document.createElement("div");
-      stats_level.classList.add("level","m-0");
-
-      // CPU
-      const cpu = machine_info["data"]["stats"]["cpu"];
-      const cpu_level_item = document.createElement("div");
-      cpu_level_item.classList.add("level-item");
-      const cpu_icon = document.createElement("iconify-icon");
-      cpu_icon.setAttribute("icon","ph:cpu");
-      cpu_icon.setAttribute("width", "1.5em");
-      cpu_icon.setAttribute("height", "1.5em");
-      const cpu_text = document.createElement("p");
-      cpu_text.innerText = cpu["1m"];
-      cpu_text.style.color = "white";
-      cpu_icon.style.color = "white";
-      cpu_level_item.appendChild(cpu_icon);
-      cpu_level_item.appendChild(cpu_text);
-      stats_level.appendChild(cpu_level_item);
-
-      // RAM
-      const ram = machine_info["data"]["stats"]["ram"];
-      const ram_level_item = document.createElement("div");
-      ram_level_item.classList.add("level-item");
-      const ram_icon = document.createElement("iconify-icon");
-      ram_icon.setAttribute("icon","ph:memory");
-      ram_icon.setAttribute("width", "1.5em");
-      ram_icon.setAttribute("height", "1.5em");
-
-      let percent_ram_used = +((ram["used"]/ram["total"])*100).toFixed(1);
-      const ram_text = document.createElement("p");
-      ram_text.innerText = percent_ram_used + "%";
-
-      let percent_ram_used_hover = format("{0}/{1}", format_bytes(ram["used"], 1), format_bytes(ram["total"], 1));
-      ram_text.title = percent_ram_used_hover;
-      ram_icon.title = percent_ram_used_hover;
-
-      if (percent_ram_used >= 85) {
-        ram_icon.style.color = "red";
-        ram_text.style.color = "red";
-      } else if (percent_ram_used >= 50) {
-        ram_icon.style.color = "yellow";
-        ram_text.style.color = "yellow";
-      } else {
-        ram_icon.style.color = "white";
-        ram_text.style.color = "white";
-      }
+  let preview_machine = search_params.get("m");
+  if (preview_machine != null && !preview_opened) {
+    preview_opened = true;
+    await display_machine_modal(preview_machine);
+  }
+}
 
-      ram_level_item.appendChild(ram_icon);
-      ram_level_item.appendChild(ram_text);
-      stats_level.appendChild(ram_level_item);
-
-      // Disk
-      const disk = machine_info["data"]["stats"]["disk"];
-      const disk_level_item = document.createElement("div");
-      disk_level_item.classList.add("level-item");
-      const disk_icon = document.createElement("iconify-icon");
-      disk_icon.setAttribute("icon","carbon:vmdk-disk");
-      disk_icon.setAttribute("width", "1.5em");
-      disk_icon.setAttribute("height", "1.5em");
-
-      let percent_disk_used = +((disk["used"]/disk["total"])*100).toFixed(1);
-      const disk_text = document.createElement("p");
-      disk_text.innerText = percent_disk_used + "%";
-
-      let percent_disk_used_hover = format("{0}/{1}", format_bytes(disk["used"]), format_bytes(disk["total"]));
-      disk_text.title = percent_disk_used_hover;
-      disk_icon.title = percent_disk_used_hover;
-
-      if (percent_disk_used >= 85) {
-        disk_icon.style.color = "red";
-        disk_text.style.color = "red";
-      } else if (percent_disk_used >= 50) {
-        disk_icon.style.color = "yellow";
-        disk_text.style.color = "yellow";
-      } else {
-        disk_icon.style.color = "white";
-        disk_text.style.color = "white";
-      }
+function create_machine_cell(name, machine_info) {
+  const cell = document.createElement("div");
+  cell.classList.add("cell", "box", "is-col-span-2");
 
-      disk_level_item.appendChild(disk_icon);
-      disk_level_item.appendChild(disk_text);
-      stats_level.appendChild(disk_level_item);
+  if (machine_info.warning.length > 0) {
+    cell.classList.add("has-background-danger");
+  } else {
+    cell.classList.add("has-background-grey");
+  }
 
-      // Open modal button
-      const open_level_item = document.createElement("div");
-      open_level_item.classList.add("level-item");
-      const open_button = document.createElement("button");
+  cell.style.width = "fit-content";
+  cell.style.height = "fit-content";
+
+  const top_level = document.createElement("div");
+  top_level.classList.add("level", "mb-0");
+  const top_level_left = document.createElement("div");
+  top_level_left.classList.add("level-left");
+  const top_level_right = document.createElement("div");
+  top_level_right.classList.add("level-right");
+  const top_level_left_item = document.createElement("div");
+  top_level_left_item.classList.add("level-item");
+  const top_level_right_item = document.createElement("div");
+  top_level_right_item.classList.add("level-item", "ml-4");
+
+  top_level.appendChild(top_level_left);
+  top_level.appendChild(top_level_right);
+  top_level_left.appendChild(top_level_left_item);
+  top_level_right.appendChild(top_level_right_item);
+
+
+  const machine_title = document.createElement("h1");
+  machine_title.innerText = name;
+  machine_title.classList.add("title", "is-4");
+  machine_title.style.color = "white";
+
+  const online_icon = document.createElement("iconify-icon");
+  online_icon.setAttribute("icon", "ph:globe");
+  online_icon.setAttribute("width", "2em");
+  online_icon.setAttribute("height", "2em");
+  online_icon.style.color = machine_info["data"]["online"] ? "lime" : "red";
+  online_icon.title = machine_info["data"]["online"] ? "This machine is online" : "This machine is offline";
+
+  top_level_left_item.appendChild(machine_title);
+  top_level_right_item.appendChild(online_icon);
+
+  const hr = document.createElement("hr");
+  hr.classList.add("my-1", "has-background-grey-lighter");
+
+  // Display basic stats if stat monitor is enabled
+  const stats_div = document.createElement("div");
+  if (machine_info["data"]["stats"] != "invalid stats" && machine_info["data"]["stats"] != null) {
+    const stats_level = document.createElement("div");
+    stats_level.classList.add("level","m-0");
+
+    // CPU
+    const cpu = machine_info["data"]["stats"]["cpu"];
+    const cpu_level_item = document.createElement("div");
+    cpu_level_item.classList.add("level-item");
+    const cpu_icon = document.createElement("iconify-icon");
+    cpu_icon.setAttribute("icon","ph:cpu");
+    cpu_icon.setAttribute("width", "1.5em");
+    cpu_icon.setAttribute("height", "1.5em");
+    const cpu_text = document.createElement("p");
+    cpu_text.innerText = cpu["1m"];
+    cpu_text.style.color = "white";
+    cpu_icon.style.color = "white";
+    cpu_level_item.appendChild(cpu_icon);
+    cpu_level_item.appendChild(cpu_text);
+    stats_level.appendChild(cpu_level_item);
+
+    // RAM
+    const ram = machine_info["data"]["stats"]["ram"];
+    const ram_level_item = document.createElement("div");
+    ram_level_item.classList.add("level-item");
+    const ram_icon = document.createElement("iconify-icon");
+    ram_icon.setAttribute("icon","ph:memory");
+    ram_icon.setAttribute("width", "1.5em");
+    ram_icon.setAttribute("height", "1.5em");
+
+    let percent_ram_used = +((ram["used"]/ram["total"])*100).toFixed(1);
+    const ram_text = document.createElement("p");
+    ram_text.innerText = percent_ram_used + "%";
+
+    let percent_ram_used_hover = format("{0}/{1}", format_bytes(ram["used"], 1), format_bytes(ram["total"], 1));
+    ram_text.title = percent_ram_used_hover;
+    ram_icon.title = percent_ram_used_hover;
+
+    if (percent_ram_used >= 85) {
+      ram_icon.style.color = "red";
+      ram_text.style.color = "red";
+    } else if (percent_ram_used >= 50) {
+      ram_icon.style.color = "yellow";
+      ram_text.style.color = "yellow";
+    } else {
+      ram_icon.style.color = "white";
+      ram_text.style.color = "white";
+    }
 
-      const copied_name = (" " + name).slice(1);
-      open_button.onclick = async function() {
-        selected_machine = copied_name;
-        await display_machine_modal(copied_name);
-      }
+    ram_level_item.appendChild(ram_icon);
+    ram_level_item.appendChild(ram_text);
+    stats_level.appendChild(ram_level_item);
+
+    // Disk
+    const disk = machine_info["data"]["stats"]["disk"];
+    const disk_level_item = document.createElement("div");
+    disk_level_item.classList.add("level-item");
+    const disk_icon = document.createElement("iconify-icon");
+    disk_icon.setAttribute("icon","carbon:vmdk-disk");
+    disk_icon.setAttribute("width", "1.5em");
+    disk_icon.setAttribute("height", "1.5em");
+
+    let percent_disk_used = +((disk["used"]/disk["total"])*100).toFixed(1);
+    const disk_text = document.createElement("p");
+    disk_text.innerText = percent_disk_used + "%";
+
+    let percent_disk_used_hover = format("{0}/{1}", format_bytes(disk["used"]), format_bytes(disk["total"]));
+    disk_text.title = percent_disk_used_hover;
+    disk_icon.title = percent_disk_used_hover;
+
+    if (percent_disk_used >= 85) {
+      disk_icon.style.color = "red";
+      disk_text.style.color = "red";
+    } else if (percent_disk_used >= 50) {
+      disk_icon.style.color = "yellow";
+      disk_text.style.color = "yellow";
+    } else {
+      disk_icon.style.color = "white";
+      disk_text.style.color = "white";
+    }
 
-      const open_icon = document.createElement("iconify-icon");
-      open_icon.setAttribute("icon","majesticons:open");
-      open_icon.setAttribute("width","1.5em");
-      open_icon.setAttribute("height","1.5em");
-      open_icon.style.color = "white";
-      open_icon.title = "Open details";
+    disk_level_item.appendChild(disk_icon);
+    disk_level_item.appendChild(disk_text);
+    stats_level.appendChild(disk_level_item);
 
-      open_button.appendChild(open_icon);
-      open_level_item.appendChild(open_button);
-      stats_level.appendChild(open_level_item);
+    // Open modal button
+    const open_level_item = document.createElement("div");
+    open_level_item.classList.add("level-item");
+    const open_button = document.createElement("button");
 
-      stats_div.appendChild(stats_level);
-    } else {
-      const p = document.createElement("p");
-      p.innerText = "Machine has invalid stats.";
-      p.style.color = "white";
-      stats_div.appendChild(p);
+    const copied_name = (" " + name).slice(1);
+    open_button.onclick = async function() {
+      selected_machine = copied_name;
+      await display_machine_modal(copied_name);
     }
 
-    cell.appendChild(top_level);
-    cell.append(hr);
-    cell.append(stats_div);
+    const open_icon = document.createElement("iconify-icon");
+    open_icon.setAttribute("icon","majesticons:open");
+    open_icon.setAttribute("width","1.5em");
+    open_icon.setAttribute("height","1.5em");
+    open_icon.style.color = "white";
+    open_icon.title = "Open details";
 
-    const warning_tags = document.getElementById("warning_tags");
-    remove_children(warning_tags);
+    open_button.appendChild(open_icon);
+    open_level_item.appendChild(open_button);
+    stats_level.appendChild(open_level_item);
 
-    for (let warn of machine_info.warning) {
-      let tag = document.createElement("span");
-      tag.classList.add("tag", "is-danger");
-      tag.innerText = warn;
-      warning_tags.appendChild(tag);
-    }
-    
-    machine_grid.appendChild(cell);
+    stats_div.appendChild(stats_level);
+  } else {
+    const p = document.createElement("p");
+    p.innerText = "Machine has invalid stats.";
+    p.style.color = "white";
+    stats_div.appendChild(p);
   }
 
-  let preview_machine = search_params.get("m");
-  if (preview_machine != null) {
-    await display_machine_modal(preview_machine);
+  cell.appendChild(top_level);
+  cell.append(hr);
+  cell.append(stats_div);
+
+  const warning_tags = document.getElementById("warning_tags");
+  remove_children(warning_tags);
+
+  for (let warn of machine_info.warning) {
+    let tag = document.createElement("span");
+    tag.classList.add("tag", "is-danger");
+    tag.innerText = warn;
+    warning_tags.appendChild(tag);
   }
+  
+  return cell;
 }
 
 async function setup() {
-  await display_machines();
-  setInterval(async function() {
-    let button = document.getElementById("refresh_machines_button");
-    await refresh_machines(button);
-  }, 60000);
+  open_feed();
 }
 
 if (document.readyState == "loading") {
@@ -4,6 +4,7 @@ import asyncio
 import logging
 import math
 import os
+import sys
 import tomllib
 
 import aiohttp
@@ -12,6 +13,14 @@ import coloredlogs
 import uvloop
 from aiohttp import web
 
+from api.utils.cluster import WORKER_ID_ENV, WORKERS_ENV, Cluster, supervise
+from api.utils.fleet_counters import FleetCounters
+from api.utils.machine_registry import MachineRegistry
+from api.utils.notifier import NotificationDispatcher
+from api.utils.rollups import RollupJob
+from api.utils.scripts import close_scripts
+from api.utils.stats_writer import StatsWriter
+from api.utils.timeseries import COLUMNS, TABLE, maintain_partitions
 from utils.extra_request import StatusConfig
 from utils.get_routes import get_module
 from utils.logger import CustomWebLogger
@@ -21,6 +30,9 @@ from utils.table import Table
 LOGFMT = "[%(filename)s][%(asctime)s][%(levelname)s] %(message)s"
 LOGDATEFMT = "%Y/%m/%d-%H:%M:%S"
 
+if WORKER_ID_ENV in os.environ:
+  LOGFMT = f"[worker {os.environ[WORKER_ID_ENV]}]{LOGFMT}"
+
 handlers = [
   logging.StreamHandler()
 ]
@@ -90,6 +102,97 @@ async def startup():
 
     app.LOG = logging
     api_app.LOG = logging
+
+    # Components register a callable here that returns their counters.
+    metrics = {}
+    app.metrics = metrics
+    api_app.metrics = metrics
+
+    # Scripts queue notifications here instead of posting them inline.
+    notify_config: dict = config["notify"]
+    notifier = NotificationDispatcher(
+      session,
+      notify_config["url"],
+      token=notify_config.get("token"),
+      default_topic=notify_config["topic"],
+      window=notify_config.get("window", 10),
+      max_pending=notify_config.get("max_pending", 1000),
+      rate=notify_config.get("rate", 1),
+      burst=notify_config.get("burst", 5),
+      retries=notify_config.get("retries", 5),
+      backoff=notify_config.get("backoff", 1),
+      max_backoff=notify_config.get("max_backoff", 60),
+      dead_letters=notify_config.get("dead_letters", 100),
+    )
+    notifier.start()
+    app.notifier = notifier
+    api_app.notifier = notifier
+    metrics["notify"] = notifier.metrics
+
+    # The other worker processes, if the supervisor started more than one.
+    cluster = Cluster.from_environment(
+      timeout=config["srv"].get("cluster", {}).get("timeout", 2)
+    )
+    app.cluster = cluster
+    api_app.cluster = cluster
+    metrics["cluster"] = cluster.metrics
+
+    registry = MachineRegistry(api_app.pool if api_app.POSTGRES_ENABLED else None)
+    # Counters have to be listening before the first load.
+    counters = FleetCounters()
+    registry.listeners.append(counters.registry_changed)
+    await registry.load()
+    # Every worker loads the table itself, only later changes are passed on.
+    cluster.watch_registry(registry)
+    cluster.register("counters", counters.out)
+    app.machine_registry = registry
+    api_app.machine_registry = registry
+    app.fleet_counters = counters
+    api_app.fleet_counters = counters
+    metrics["registry"] = registry.metrics
+    if api_app.POSTGRES_ENABLED:
+      counters.start_sampling_db_size(
+        api_app.pool,
+        config["srv"].get("counters", {}).get("db_size_interval", 300),
+      )
+    if api_app.POSTGRES_ENABLED:
+      # Logged stats are written in batches, shared by every machine.
+      writer_config: dict = config["srv"].get("writer", {})
+      stats_writer = StatsWriter(
+        api_app.pool,
+        TABLE,
+        COLUMNS,
+        batch_size=writer_config.get("batch_size", 1000),
+        interval=writer_config.get("interval", 1),
+        max_buffered=writer_config.get("max_buffered", 50000),
+        max_wait=writer_config.get("max_wait", 5),
+      )
+      stats_writer.start()
+      app.stats_writer = stats_writer
+      api_app.stats_writer = stats_writer
+      metrics["writer"] = stats_writer.metrics
+    if api_app.POSTGRES_ENABLED and cluster.primary:
+      timeseries_config: dict = config["srv"].get("timeseries", {})
+      partitions_task = asyncio.create_task(
+        maintain_partitions(
+          api_app.pool,
+          interval=timeseries_config.get("partition_interval", "month"),
+          ahead=timeseries_config.get("partitions_ahead", 2),
+        )
+      )
+
+      rollups_config: dict = config["srv"].get("rollups", {})
+      rollups = RollupJob(
+        api_app.pool,
+        retention=rollups_config.get("retention"),
+        interval=rollups_config.get("interval", 60),
+        delay=rollups_config.get("delay", 60),
+        batch_size=rollups_config.get("batch_size", 5000),
+        batch_pause=rollups_config.get("batch_pause", 0.1),
+      )
+      rollups.start()
+      metrics["rollups"] = rollups.metrics
+
     disabled_cogs: list[str] = []
 
     for cog in [
@@ -107,6 +210,9 @@ async def startup():
 
     app.add_subapp("/api/", api_app)
 
+    # Only answer peers once every cog has registered its handlers.
+    await cluster.start()
+
     LOG.info("Loading frontend...")
     try:
       lib = get_module("frontend.routes")
@@ -121,6 +227,8 @@ async def startup():
       runner,
       config['srv']['host'],
       config['srv']['port'],
+      # Workers share the port, the kernel spreads connections between them.
+      reuse_port=cluster.enabled,
     )
     await site.start()
     print(f"Started server on http://{config['srv']['host']}:{config['srv']['port']}...\nPress ^C to close...")
@@ -132,12 +240,33 @@ async def startup():
   finally:
     try: await api_app.websocket_handler.close()   # noqa: E701
     except: pass #noqa: E722, E701
+    try: await close_scripts()   # noqa: E701
+    except: pass  # noqa: E722, E701
+    # After the websocket handler, so rows from the last packets get written.
+    try: await app.stats_writer.close()   # noqa: E701
+    except: pass  # noqa: E722, E701
+    try: await app.notifier.close()   # noqa: E701
+    except: pass  # noqa: E722, E701
+    try: app.fleet_counters.stop()   # noqa: E701
+    except: pass  # noqa: E722, E701
+    try: partitions_task.cancel()   # noqa: E701
+    except: pass  # noqa: E722, E701
+    try: rollups.stop()   # noqa: E701
+    except: pass  # noqa: E722, E701
+    try: await app.cluster.close()   # noqa: E701
+    except: pass  # noqa: E722, E701
     try: await site.stop()   # noqa: E701
     except: pass  # noqa: E722, E701
     try: await session.close()   # noqa: E701
     except: pass  # noqa: E722, E701
 
-try:
-  uvloop.run(startup(), debug=True)
-except KeyboardInterrupt:
-  print("Server shut down.")
\ No newline at end of file
+processes = int(os.environ.get(WORKERS_ENV, config["srv"].get("processes", 1)))
+if processes > 1 and WORKER_ID_ENV not in os.environ:
+  # Supervisor: run the workers and keep them alive, serve nothing itself.
+  supervise(processes, sys.argv)
+  print("Server shut down.")
+else:
+  try:
+    uvloop.run(startup(), debug=True)
+  except KeyboardInterrupt:
+    print("Server shut down.")
\ No newline at end of file
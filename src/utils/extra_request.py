@@ -6,10 +6,18 @@ from aiohttp.web import Application as BaseApplication
 from aiohttp.web import Request as BaseRequest
 
 if TYPE_CHECKING:
+  from collections.abc import Callable
   from logging import Logger
   from aiohttp import ClientSession
 
   from asyncpg import Connection, Pool
+  from api.utils.admission import AdmissionController
+  from api.utils.cluster import Cluster
+  from api.utils.connect_token import ConnectTokenSigner
+  from api.utils.fleet_counters import FleetCounters
+  from api.utils.machine_registry import MachineRegistry
+  from api.utils.notifier import NotificationDispatcher
+  from api.utils.stats_writer import StatsWriter
   from api.utils.websocket_handler import WebsocketHandler
 
 class StatusConfig:
@@ -23,6 +31,14 @@ class Application(BaseApplication):
   status_config: StatusConfig
   config: dict # config.toml
   websocket_handler: WebsocketHandler
+  machine_registry: MachineRegistry
+  fleet_counters: FleetCounters
+  stats_writer: StatsWriter
+  notifier: NotificationDispatcher
+  connect_tokens: ConnectTokenSigner
+  admission: AdmissionController
+  cluster: Cluster
+  metrics: dict[str, Callable[[], dict]]
 
 class Request(BaseRequest):
   app: Application
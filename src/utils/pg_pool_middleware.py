@@ -10,11 +10,20 @@ if TYPE_CHECKING:
   from aiohttp.web import Request
   from asyncpg import Connection
 
+def no_pool(handler):
+  "Mark a handler that never touches the database, so no connection is held."
+  handler.no_pool = True
+  return handler
+
 @middleware
 async def pg_pool_middleware(request: Request, handler):
   request.LOG = request.app.LOG
   request.session = request.app.cs
-  if request.app.POSTGRES_ENABLED:
+  # Websockets live for hours; holding a pool connection for each one would
+  # exhaust the pool long before the fleet is connected.
+  if request.app.POSTGRES_ENABLED and not getattr(
+    request.match_info.handler, "no_pool", False
+  ):
     async with request.app.pool.acquire() as conn:
       conn: Connection
       request.conn = conn
@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import pathlib
+import random
+import sys
+import time
+from typing import TYPE_CHECKING
+
+import py_expression_eval
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[2] / "src"))
+
+from api.utils.alert_rules import AlertRuleCache, resolve  # noqa: E402
+
+if TYPE_CHECKING:
+  from typing import Any
+
+### UsageScript raw_alert rules, parsed per packet (the old way) vs compiled once
+# per machine config version by api/utils/alert_rules.py. One interval is a
+# packet from every machine, each checked against every rule:
+#   python tools/benchmarks/bench_alert_rules.py [machines] [rules]
+# Defaults to 10000 machines with 20 rules each.
+
+EXPRESSIONS = [
+  "(used/total)*100",
+  "100-(free/total)*100",
+  "(used+reserved)/total*100",
+  "max(read,write)/1048576",
+  "sqrt(read^2+write^2)/1024",
+  # Data keys named like parser functions, the data has to win.
+  "current/max*100",
+]
+
+
+def get_value(d: dict, key: str, default: Any = None) -> Any:
+  "The recursive lookup the rules used to go through."
+  if isinstance(key, str):
+    if "/" in key:
+      split: list[str] = key.split("/")
+      first_level = split.pop(0)
+      second_level = split[0]
+      rest = "/".join(split)
+      value = d.get(first_level, default)
+      if not isinstance(value, dict):
+        return value
+      elif second_level not in value:
+        return default
+      else:
+        return get_value(value, rest, default)
+    else:
+      return d.get(key, default)
+  else:
+    return d.get(key, default)
+
+
+class Machine:
+  name: str
+  config_version: int
+
+  def __init__(self, name: str) -> None:
+    self.name = name
+    self.config_version = 1
+
+
+def make_packet(rules: int) -> dict:
+  disks = {}
+  for i in range(rules):
+    total = random.randint(1 << 30, 1 << 40)
+    disks[f"sd{i}"] = {
+      "used": random.randint(0, total),
+      "free": random.randint(0, total),
+      "reserved": random.randint(0, 1 << 28),
+      "total": total,
+      "read": random.random() * 1e8,
+      "write": random.random() * 1e8,
+      "model": "bench",
+    }
+    if "current" in EXPRESSIONS[i % len(EXPRESSIONS)]:
+      disks[f"sd{i}"].update(current=random.randint(0, 100), max=100)
+  return {"extra": {"extendedstats": {"disk": disks}}}
+
+
+def make_config(rules: int) -> dict:
+  return {
+    "raw_alert": {
+      f"extra/extendedstats/disk/sd{i}": {
+        "value": EXPRESSIONS[i % len(EXPRESSIONS)],
+        "threshold": 90,
+        "message": f"disk {i} is over 90%",
+      }
+      for i in range(rules)
+    }
+  }
+
+
+def legacy(parser: py_expression_eval.Parser, packet: dict, config: dict) -> int:
+  alerts = 0
+  for base_key, data in config["raw_alert"].items():
+    raw_data: dict = get_value(packet, base_key)
+    variables = {}
+    for key, value in raw_data.items():
+      if isinstance(value, (int, float)):
+        variables[key] = value
+    if parser.parse(data["value"]).evaluate(variables) > data["threshold"]:
+      alerts += 1
+  return alerts
+
+
+def compiled(cache: AlertRuleCache, machine: Machine, packet: dict, config: dict) -> int:
+  alerts = 0
+  for rule in cache.get(machine, config).raw_alert:
+    if rule.check(resolve(packet, rule.path)):
+      alerts += 1
+  return alerts
+
+
+def main(machines: int, rules: int) -> None:
+  random.seed(0)
+  # Machines share a few packet shapes, building 10k distinct ones is slow and
+  # doesn't change the per-rule work.
+  packets = [make_packet(rules) for _ in range(16)]
+  fleet = [Machine(f"machine-{i}") for i in range(machines)]
+  config = make_config(rules)
+  print(f"{machines} machines x {rules} rules = {machines * rules} checks per interval")
+
+  parser = py_expression_eval.Parser()
+  began = time.perf_counter()
+  expected = [legacy(parser, packets[i % len(packets)], config) for i in range(machines)]
+  print(f"  parse per packet  {(time.perf_counter() - began) * 1000:9.1f} ms")
+
+  cache = AlertRuleCache()
+  began = time.perf_counter()
+  for i, machine in enumerate(fleet):
+    compiled(cache, machine, packets[i % len(packets)], config)
+  print(f"  first interval    {(time.perf_counter() - began) * 1000:9.1f} ms (compiling)")
+
+  for _ in range(3):
+    began = time.perf_counter()
+    got = [
+      compiled(cache, machine, packets[i % len(packets)], config)
+      for i, machine in enumerate(fleet)
+    ]
+    print(f"  compiled          {(time.perf_counter() - began) * 1000:9.1f} ms")
+  assert got == expected, "compiled rules disagree with the parser"
+
+
+if __name__ == "__main__":
+  args = [int(arg) for arg in sys.argv[1:]]
+  main(*(args + [10000, 20][len(args) :]))
@@ -0,0 +1,131 @@
+from __future__ import annotations
+
+import json
+import random
+import sys
+import timeit
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+  from collections.abc import Callable
+  from typing import Any
+
+### Compares the JSON backends supported by src/utils/codec.py.
+# Run from anywhere: python tools/benchmarks/bench_codec.py [machines ...]
+
+backends: dict[str, tuple[Callable[[Any], Any], Callable[[Any], Any]]] = {
+  "json": (
+    lambda obj: json.dumps(obj, separators=(",", ":")).encode(),
+    json.loads,
+  ),
+}
+
+try:
+  import orjson
+
+  backends["orjson"] = (
+    lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+    orjson.loads,
+  )
+except ImportError:
+  pass
+
+try:
+  import msgspec
+
+  backends["msgspec"] = (msgspec.json.Encoder().encode, msgspec.json.Decoder().decode)
+except ImportError:
+  pass
+
+
+def make_stats() -> dict:
+  return {
+    "cpu": {
+      "1m": round(random.uniform(0, 8), 2),
+      "5m": round(random.uniform(0, 8), 2),
+      "15m": round(random.uniform(0, 8), 2),
+    },
+    "ram": {
+      "used": random.randint(1 << 28, 1 << 34),
+      "free": random.randint(1 << 28, 1 << 34),
+      "total": 1 << 35,
+    },
+    "disk": {
+      "used": random.randint(1 << 30, 1 << 40),
+      "free": random.randint(1 << 30, 1 << 40),
+      "total": 1 << 41,
+    },
+    "boot_time": 1712345678.0,
+    "internet": {
+      "current": {"outgoing": random.random() * 1e6, "incoming": random.random() * 1e6},
+      "5m": {"outgoing": random.random() * 1e6, "incoming": random.random() * 1e6},
+    },
+  }
+
+
+def make_xmrig() -> dict:
+  return {
+    "hashrate": {"current": 4512.3, "1m": 4498.1, "15m": 4501.7, "peak": 4620.0},
+    "version": "6.21.0",
+    "worker_id": "rig-01",
+    "uptime": 123456,
+    "shares": {"total": 1234, "good": 1230, "avg_time_ms": 31250, "hashes_total": 987654321},
+  }
+
+
+def make_frame() -> dict:
+  return {
+    "type": "monitor",
+    "data": {"stats": make_stats(), "extras": {"xmrig": make_xmrig()}},
+    "error": 0,
+  }
+
+
+def make_fleet(machines: int) -> dict:
+  return {
+    f"machine-{i}": {
+      "name": f"machine-{i}",
+      "category": f"category-{i % 10}",
+      "warning": [],
+      "data": {
+        "online": True,
+        "stats": make_stats(),
+        "extras": {"xmrig": make_xmrig()},
+      },
+    }
+    for i in range(machines)
+  }
+
+
+def per_call(func: Callable[[], Any], number: int) -> float:
+  "Best of 5 runs, in microseconds per call."
+  return min(timeit.repeat(func, number=number, repeat=5)) / number * 1e6
+
+
+def main(sizes: list[int]) -> None:
+  frame = make_frame()
+  print(f"backends: {', '.join(backends)}")
+
+  print("\nper packet (decode one monitor frame):")
+  for name, (dumps, loads) in backends.items():
+    raw = dumps(frame).decode()
+    print(f"  {name:8} {per_call(lambda: loads(raw), 20000):8.2f} us")
+
+  for size in sizes:
+    fleet = make_fleet(size)
+    number = max(1, 20000 // size)
+    print(f"\nper response (/machines/get/all/, {size} machines):")
+    for name, (dumps, loads) in backends.items():
+      body = dumps(fleet)
+      encode = per_call(lambda: dumps(fleet), number) / 1000
+      print(f"  {name:8} {encode:8.2f} ms encode, {len(body) / 1024:8.0f} KiB")
+
+    print(f"\nper fleet interval (decode {size} frames):")
+    raw = backends["json"][0](frame).decode()
+    for name, (dumps, loads) in backends.items():
+      decode = per_call(lambda: loads(raw), 20000) * size / 1000
+      print(f"  {name:8} {decode:8.2f} ms")
+
+
+if __name__ == "__main__":
+  main([int(arg) for arg in sys.argv[1:]] or [1000, 10000])
@@ -3,7 +3,9 @@ from __future__ import annotations
 import asyncio
 import json
 import logging
+import random
 import sys
+import zlib
 from typing import TYPE_CHECKING
 
 import aiofiles
@@ -14,14 +16,25 @@ from aiohttp.web import WSMsgType
 from config import MACHINE_NAME, SERVER_URL
 from plugins import fetch_plugins
 
+try:
+  import msgpack
+except ImportError:
+  msgpack = None
+
 if TYPE_CHECKING:
-  pass
+  from typing import Any
 
 ### Status Client Daemon - Monitoring tool for client machines.
 
 reconnect_after = "never"
 update_frequency = 5
 collect_stats = True
+# Wire format offered to the server, most preferred first. The server picks.
+offered_formats = ["msgpack", "json"] if msgpack is not None else ["json"]
+offered_compression = ["zlib", "deflate", "none"]
+# Send a full keyframe every N packets and only changed values in between.
+# Set by the server, 0 means always send full packets.
+keyframe_interval = 0
 
 fmt = "[%(filename)s][%(asctime)s][%(levelname)s] %(message)s"
 datefmt = "%Y/%m/%d-%H:%M:%S"
@@ -113,13 +126,88 @@ async def get_stats() -> dict:
   return stats_info
 
 
+class WireFormat:
+  "Mirror of the server's api/utils/wire.py, for the negotiated format."
+  format: str
+  compression: str
+
+  def __init__(self, format: str = "json", compression: str = "none") -> None:
+    self.format = format
+    self.compression = compression
+
+  def encode(self, data: Any) -> str | bytes:
+    if self.format == "msgpack":
+      payload = msgpack.packb(data)
+    else:
+      payload = json.dumps(data, separators=(",", ":")).encode()
+    if self.compression == "zlib":
+      return zlib.compress(payload)
+    if self.format == "json":
+      return payload.decode()
+    return payload
+
+  def decode(self, message: aiohttp.WSMessage) -> Any:
+    if message.type == WSMsgType.TEXT:
+      return json.loads(message.data)
+    payload = message.data
+    if self.compression == "zlib":
+      payload = zlib.decompress(payload)
+    if self.format == "msgpack":
+      return msgpack.unpackb(payload)
+    return json.loads(payload)
+
+  async def send(self, ws: aiohttp.ClientWebSocketResponse, data: Any) -> None:
+    encoded = self.encode(data)
+    if isinstance(encoded, bytes):
+      await ws.send_bytes(encoded)
+    else:
+      await ws.send_str(encoded)
+
+
+def diff_packet(old: dict, new: dict, path: tuple = ()) -> tuple[list, list]:
+  "Leaf values that changed (or appeared) and paths that disappeared."
+  changed = []
+  removed = []
+  for key, value in new.items():
+    key_path = path + (key,)
+    if key not in old:
+      changed.append([list(key_path), value])
+    elif isinstance(value, dict) and isinstance(old[key], dict):
+      sub_changed, sub_removed = diff_packet(old[key], value, key_path)
+      changed.extend(sub_changed)
+      removed.extend(sub_removed)
+    elif old[key] != value:
+      changed.append([list(key_path), value])
+  for key in old:
+    if key not in new:
+      removed.append(list(path + (key,)))
+  return changed, removed
+
+
 async def main(cs: aiohttp.ClientSession):
+  global reconnect_after
   plugins = None
-  async with cs.get(SERVER_URL, params={"name": MACHINE_NAME}) as ws:
+  params = {
+    "name": MACHINE_NAME,
+    "formats": ",".join(offered_formats),
+    "compression": ",".join(offered_compression),
+    "delta": "1",
+  }
+  async with cs.get(SERVER_URL, params=params) as ws:
+    if ws.status == 503:
+      # The server is admitting a reconnect storm, come back when told to.
+      data = await ws.json()
+      reconnect_after = data.get("retry_after") or int(ws.headers.get("Retry-After", 5))
+      logging.info(f"Server is busy, retrying in {reconnect_after}s")
+      return
     data = await ws.json()
     TARGET_URL = data.get("url")
     update_frequency = data.get("update_frequency")
     collect_stats = data.get("collect_stats")
+    # Servers that predate negotiation only understand JSON text frames.
+    wire = WireFormat(data.get("format", "json"), data.get("compression", "none"))
+    global keyframe_interval
+    keyframe_interval = data.get("keyframe_interval", 0)
     addons = yarl.URL(TARGET_URL).query.get("addons")
     logging.info(f"requested plugins: {addons}")
     if addons is not None:
@@ -129,10 +217,25 @@ async def main(cs: aiohttp.ClientSession):
     logging.info(f"update frequency set to {update_frequency}s")
     logging.info(f"collect stats set to {collect_stats}")
     logging.info(f"loaded plugins: {[plugin.name for plugin in plugins]}")
+    logging.info(f"wire format set to {wire.format}, compression {wire.compression}")
+    logging.info(f"keyframe interval set to {keyframe_interval}")
   try:
-    async with cs.ws_connect(TARGET_URL) as ws:
+    compress = 15 if wire.compression == "deflate" else 0
+    async with cs.ws_connect(TARGET_URL, compress=compress) as ws:
+      # Delta protocol state, reset for every connection.
+      last_sent = None
+      seq = -1
+      since_keyframe = 0
+      # Sender and receiver both send packets; sequence numbers must go out
+      # in order.
+      send_lock = asyncio.Lock()
 
-      async def send_data():
+      async def send_data(force_keyframe: bool = False):
+        async with send_lock:
+          await _send_data(force_keyframe)
+
+      async def _send_data(force_keyframe: bool):
+        nonlocal last_sent, seq, since_keyframe
         logging.debug("Send_data called")
         monitor_packet = {}
         if collect_stats:
@@ -153,10 +256,30 @@ async def main(cs: aiohttp.ClientSession):
             logging.exception(f"Failed to run {plugin.name}")
         logging.debug("Finished running plugins")
 
-        packet = {"type": "monitor", "data": monitor_packet, "error": 0}
+        if keyframe_interval <= 0:
+          packet = {"type": "monitor", "data": monitor_packet, "error": 0}
+        elif (
+          force_keyframe
+          or last_sent is None
+          or since_keyframe >= keyframe_interval - 1
+        ):
+          seq += 1
+          since_keyframe = 0
+          packet = {"type": "monitor", "seq": seq, "data": monitor_packet, "error": 0}
+        else:
+          seq += 1
+          since_keyframe += 1
+          changed, removed = diff_packet(last_sent, monitor_packet)
+          packet = {
+            "type": "monitor_delta",
+            "seq": seq,
+            "data": {"set": changed, "unset": removed},
+            "error": 0,
+          }
+        last_sent = monitor_packet
 
-        logging.info("Sending monitor packet to server...")
-        await ws.send_json(packet)
+        logging.info(f"Sending {packet['type']} packet to server...")
+        await wire.send(ws, packet)
 
       async def sender_func():
         logging.debug("Sender started, waiting 1s")
@@ -167,6 +290,7 @@ async def main(cs: aiohttp.ClientSession):
           await asyncio.sleep(update_frequency)
 
       async def receiver_func():
+        global reconnect_after
         running = True
         while running:
           try:
@@ -179,9 +303,10 @@ async def main(cs: aiohttp.ClientSession):
               running = False
               print("Received CLOSE/CLOSING/CLOSED message.")
               continue
-            elif message.type != WSMsgType.TEXT:
+            elif message.type not in (WSMsgType.TEXT, WSMsgType.BINARY):
               logging.error(f"Received invalid message type {WSMsgType(message.type).name}; {hasattr(message,'data') and message.data or 'no data'}")
-            message_data = json.loads(message.data)
+              continue
+            message_data = wire.decode(message)
           except Exception:
             logging.exception("Failed parsing message from websocket")
             continue
@@ -198,14 +323,20 @@ async def main(cs: aiohttp.ClientSession):
               logging.info(f"collect stats set to {collect_stats}")
           elif message_type == "info":
             await send_data()
+          elif message_type == "resync":
+            logging.info("server requested a keyframe")
+            await send_data(force_keyframe=True)
           elif message_type == "goodbye":
             data = message_data.get("data")
             logging.info(f"got goodbye {data}")
-            global reconnect_after
             reconnect_after = data["reconnect_after"]
             raise asyncio.CancelledError
           elif message_type == "updateclient":
-            logging.info("got updateclient")
+            data = message_data.get("data") or {}
+            # The server staggers updates so the fleet doesn't come back at once.
+            delay = data.get("reconnect_after", 0)
+            logging.info(f"got updateclient, updating in {delay}s")
+            await asyncio.sleep(delay)
             proc = await asyncio.create_subprocess_shell("./update.sh")
             await proc.communicate()
             reconnect_after = "update"
@@ -214,6 +345,17 @@ async def main(cs: aiohttp.ClientSession):
       sender_task = asyncio.create_task(sender_func())
       receiver_task = asyncio.create_task(receiver_func())
       await asyncio.gather(sender_task, receiver_task)
+  except aiohttp.WSServerHandshakeError as e:
+    # 401: the connect token expired, 409: the machine's config changed since
+    # the handshake, 503: the server is busy. Either way, start over.
+    retry_after = 5
+    if e.status == 503 and e.headers is not None:
+      try:
+        retry_after = float(e.headers.get("Retry-After", 5))
+      except ValueError:
+        pass
+    reconnect_after = round(retry_after + random.uniform(0, 5), 2)
+    logging.warning(f"Server refused the websocket (HTTP{e.status}), handshaking again in {reconnect_after}s")
   except Exception:
     logging.exception("ws died")
 
@@ -231,8 +373,10 @@ async def _main():
       except asyncio.CancelledError:
         pass
       except aiohttp.ClientConnectorError:
-        logging.info("Failed to connect. Waiting 5 seconds.")
-        reconnect_after = 5 # Wait a bit and try to reconnect
+        # Wait a bit and try to reconnect, jittered so a restarting server
+        # isn't hit by every machine in the same second.
+        reconnect_after = round(5 + random.uniform(0, 5), 2)
+        logging.info(f"Failed to connect. Waiting {reconnect_after} seconds.")
       logging.info("Main ended")
     if reconnect_after == "never":
       logging.info("Told to never reconnect.")
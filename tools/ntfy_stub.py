@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+### Stand-in for an ntfy server, to try notifications without the network.
+# Point [notify] url at it and watch what the server sends:
+#   python tools/ntfy_stub.py --port 8099
+#   [notify] url = "http://127.0.0.1:8099/"
+# GET /messages lists everything received, DELETE /messages clears it.
+# --fail-rate, --status and --latency make it misbehave, to exercise
+# retries, backoff and the dead-letter buffer.
+
+
+def make_app(args: argparse.Namespace) -> web.Application:
+  received: list[dict] = []
+
+  async def publish(request: web.Request) -> web.Response:
+    if args.latency:
+      await asyncio.sleep(args.latency)
+    if random.random() < args.fail_rate:
+      print(f"[STUB] failing with HTTP{args.status}")
+      return web.Response(status=args.status, text="stub failure")
+
+    try:
+      message = await request.json()
+    except json.JSONDecodeError:
+      # Plain text publish to /<topic>
+      message = {
+        "topic": request.match_info.get("topic"),
+        "message": await request.text(),
+        "title": request.headers.get("Title"),
+      }
+    message["received"] = time.time()
+    message["authorization"] = request.headers.get("Authorization")
+    received.append(message)
+    print(f"[STUB] {message.get('topic')}: {message.get('title')!r}\n{message.get('message')}\n")
+    return web.json_response({"id": str(len(received)), "event": "message"})
+
+  async def list_messages(request: web.Request) -> web.Response:
+    return web.json_response(received)
+
+  async def clear_messages(request: web.Request) -> web.Response:
+    received.clear()
+    return web.Response(status=204)
+
+  app = web.Application()
+  app.add_routes(
+    [
+      web.get("/messages", list_messages),
+      web.delete("/messages", clear_messages),
+      web.post("/", publish),
+      web.post("/{topic}", publish),
+      web.put("/{topic}", publish),
+    ]
+  )
+  return app
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=8099)
+  parser.add_argument("--fail-rate", type=float, default=0, help="share of publishes to fail, 0-1")
+  parser.add_argument("--status", type=int, default=503, help="status to fail with")
+  parser.add_argument("--latency", type=float, default=0, help="seconds before answering")
+  args = parser.parse_args()
+  web.run_app(make_app(args), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+  main()